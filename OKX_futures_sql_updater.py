@@ -5,6 +5,9 @@ import orjson
 from db import create_futures_db_connection, insert_or_update_futures_thread
 from tg import send_telegram_error
 from wsocket import process_websocket
+from metrics import start_metrics_server
+from subscriptions import SubscriptionManager
+from latency import latency_recorder
 from time import time_ns
 from sql_config import DB_CONFIG
 from exchanges.okx import OkxFuturesExchange
@@ -16,10 +19,29 @@ TOKENS_LIST = exchange.tokens
 
 # Dictionary to store updates
 update_dict = exchange.create_update_dict()
+latency = latency_recorder(exchange.table_name)
+
+WS_SHARD_SIZE = 40  # tokens per connection, 3 channels each
+
+# OKX acks every arg separately and answers an error with the id of the request, the frame is limited to 64 KB
+subscriptions = SubscriptionManager('OKX', max_args=300,
+                                    build_frame=lambda args, request_id: {"id": str(request_id), "op": "subscribe",
+                                                                          "args": args},
+                                    arg_key=lambda arg: (arg['channel'], arg['instId']),
+                                    symbol_of=lambda arg: arg['instId'])
 
 
 def on_message(ws, message):
     data = orjson.loads(message)
+    if data.get('event') == 'subscribe':
+        subscriptions.ack(arg=data['arg'])
+        return
+    if data.get('event') == 'error':
+        # {"id": "1", "event": "error", "code": "60018", "msg": "...doesn't exist.", "connId": "..."}
+        request_id = str(data.get('id', ''))
+        if not (request_id.isdigit() and subscriptions.ack(int(request_id), ok=False, error=data.get('msg'))):
+            send_telegram_error(f"OKX_futures_sql_updater.py\nerror\n{data}")
+        return
     if 'arg' not in data:
         logging.warning(data)
         return
@@ -47,6 +69,14 @@ def on_message(ws, message):
         send_telegram_error(f"OKX_futures_sql_updater.py\nUnknown channel\n{data}")
 
 
+def record_latency(item, current_time):
+    # ts is the push time of the data
+    exchange_time = int(item['ts']) if 'ts' in item else None
+    if exchange_time:
+        latency.record(exchange_time, current_time)
+    return exchange_time
+
+
 def handle_funding_rate_update(data, instId):
 
     if len(data['data']) == 1:
@@ -55,13 +85,18 @@ def handle_funding_rate_update(data, instId):
         funding_time = int(item['fundingTime'])  # funding time of a previous settlement
         next_funding_time = int(item['nextFundingTime'])
         funding_period = (next_funding_time-funding_time)//3600000
-        
-        update_dict[instId].update({
-            'funding_annual_percent': funding_rate / funding_period * 876000,  #* 24 * 365 * 100,
-            'nextFundingTime': next_funding_time,
-            "funding_period" : funding_period,
-            'time_funding_refresh' : time_ns()//1_000_000,
-        })
+        slot = update_dict.index[instId]
+        current_time = time_ns()//1_000_000
+        exchange_time = record_latency(item, current_time)
+
+        with update_dict.lock:
+            update_dict.funding_annual_percent[slot] = funding_rate / funding_period * 876000  #* 24 * 365 * 100
+            update_dict.nextFundingTime[slot] = next_funding_time
+            update_dict.funding_period[slot] = funding_period
+            update_dict.time_funding_refresh[slot] = current_time
+            if exchange_time:
+                update_dict.time_exchange[slot] = exchange_time
+            update_dict.dirty[slot] = 1
     
     else:
         send_telegram_error("OKX_futures_sql_updater\nlen(data['data']) == 1 error")
@@ -69,54 +104,56 @@ def handle_funding_rate_update(data, instId):
 
 def handle_tickers_update(data, instId):
     # print(data)
+    slot = update_dict.index[instId]
     for item in data['data']:
         bid_price = float(item['bidPx'])
         ask_price = float(item['askPx'])
         volume_24h = int(float(item['volCcy24h']))*bid_price # !!! 24h trading volume, with a unit of currency. 24h trading volume, with a unit of currency. If it is a derivatives contract, the value is the number of base currency. If it is SPOT/MARGIN, the value is the quantity in quote currency.
+        current_time = time_ns()//1_000_000
+        exchange_time = record_latency(item, current_time)
 
-        update_dict[instId].update({
-            'bidPrice': bid_price,
-            'askPrice': ask_price,
-            'volume24h': volume_24h,
-            'time_bid_ask_refresh': time_ns()//1_000_000,
-        })
+        with update_dict.lock:
+            update_dict.bidPrice[slot] = bid_price
+            update_dict.askPrice[slot] = ask_price
+            update_dict.volume24h[slot] = volume_24h
+            update_dict.time_bid_ask_refresh[slot] = current_time
+            if exchange_time:
+                update_dict.time_exchange[slot] = exchange_time
+            update_dict.dirty[slot] = 1
 
 
 def handle_interest_update(data, instId):
     # print(data)
+    slot = update_dict.index[instId]
     for item in data['data']:
-        openInterest = float(item['oi'])
-        update_dict[instId].update({
-            'openInterest': openInterest,
-            'time_openInterest_refresh': time_ns()//1_000_000,
+        open_interest = float(item['oi'])
+        current_time = time_ns()//1_000_000
+        exchange_time = record_latency(item, current_time)
+        with update_dict.lock:
+            update_dict.openInterest[slot] = open_interest
+            update_dict.time_openInterest_refresh[slot] = current_time
+            if exchange_time:
+                update_dict.time_exchange[slot] = exchange_time
+            update_dict.dirty[slot] = 1
 
-        })
 
 
-
-def on_open(ws):
-    for token in TOKENS_LIST:
-        for channel in ['funding-rate', 'tickers', "open-interest"]:
-            message = {
-                "op": "subscribe",
-                "args": [
-                    {
-                        "channel": channel,
-                        "instId": token
-                    }
-                ]
-            }
-            ws.send(orjson.dumps(message))
+def on_open(ws, tokens=TOKENS_LIST, shard=0):
+    args = [{"channel": channel, "instId": token}
+            for token in tokens for channel in ['funding-rate', 'tickers', "open-interest"]]
+    subscriptions.subscribe(ws, args, label=f' shard {shard}')
 
 
 if __name__ == '__main__':
-
+    start_metrics_server()
     CONNECTION = create_futures_db_connection(db_config=DB_CONFIG, table_name=exchange.table_name)
 
     insert_or_update_futures_thread(CONNECTION, exchange.table_name, update_dict)
 
     process_websocket(
-        url="wss://ws.okx.com:8443/ws/v5/public",
+        url=exchange.ws_url,
         on_open=on_open,
-        on_message=on_message
+        on_message=on_message,
+        symbols=TOKENS_LIST,
+        shard_size=WS_SHARD_SIZE,
     )
@@ -0,0 +1,175 @@
+"""
+Export of the collected tables into compressed parquet files, one directory per table and day:
+
+    <EXPORT_DIR>/<table>/date=<YYYY-MM-DD>/part-<first id>.parquet
+
+Tables are read in insertion order (the auto increment `id`) in chunks of EXPORT_CHUNK_ROWS, so memory
+does not depend on the history size. The last exported id of every table is kept in
+<EXPORT_DIR>/export_state.json and the next run continues from it. The time columns are not used for
+that: the rows replayed from the spool keep their old time_insert and the spot `time` is the last
+tick of the token, both can be older than rows already exported.
+
+    python archive_export.py                     # all tables
+    python archive_export.py Binance_fut_data    # some of them
+
+The first run adds the `id` column to the tables created before it, a one time copy of the table.
+"""
+from dataclasses import dataclass, fields
+from datetime import datetime, timezone
+import logging
+import os
+import sys
+from contextlib import closing
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from db import DAY_MS, ConnectionPool, ensure_id_column
+from models.future_data import FutureData
+from models.spot_data import SpotData
+from exchanges.binance import BinanceFuturesExchange, BinanceSpotExchange
+from exchanges.bybit import BybitFuturesExchange
+from exchanges.deribit import DeribitFuturesExchange
+from exchanges.dydx import DydxFuturesExchange
+from exchanges.okx import OkxFuturesExchange
+from exchanges.vertexprotocol import VertexprotocolFuturesExchange
+
+
+EXPORT_DIR = 'archive'
+EXPORT_CHUNK_ROWS = 100_000     # rows per query
+EXPORT_COMPRESSION = 'zstd'
+
+try:
+    from local_settings import *
+except ImportError:
+    pass
+
+log = logging.getLogger('archive_export')
+
+
+@dataclass
+class ExportTable:
+    name: str
+    model: type
+    time_column: str    # the day directory of a row
+
+
+EXPORT_TABLES = [
+    ExportTable(exchange.table_name, FutureData, 'time_insert')
+    for exchange in (BinanceFuturesExchange, BybitFuturesExchange, DeribitFuturesExchange, DydxFuturesExchange,
+                     OkxFuturesExchange, VertexprotocolFuturesExchange)
+] + [
+    ExportTable(BinanceSpotExchange.table_name, SpotData, 'time'),
+]
+
+
+def arrow_schema(model: type):
+    types = {str: pa.string(), float: pa.float64(), int: pa.int64()}
+    return pa.schema([(field.name, types[field.type]) for field in fields(model)])
+
+
+class ExportState:
+    def __init__(self, root: str):
+        os.makedirs(root, exist_ok=True)
+        self.path = os.path.join(root, 'export_state.json')
+        self.data = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as file:
+                self.data = orjson.loads(file.read())
+
+    def get(self, table_name: str):
+        return self.data.get(table_name)
+
+    def set(self, table_name: str, last_id: int):
+        self.data[table_name] = last_id
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(orjson.dumps(self.data))
+        os.replace(tmp_path, self.path)
+
+
+def last_id(connection, table: ExportTable) -> int:
+    # the writer of a table is serialized, a write in progress gets ids above every committed row
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(f"SELECT max(id) FROM {table.name}")
+        value = cursor.fetchone()[0]
+    connection.commit()
+    return value or 0
+
+
+def read_chunk(connection, table: ExportTable, after_id: int, end_id: int) -> list[tuple]:
+    columns = ', '.join(field.name for field in fields(table.model))
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(f"""
+            SELECT id, {columns} FROM {table.name}
+            WHERE id > %s AND id <= %s
+            ORDER BY id
+            LIMIT %s
+        """, (after_id, end_id, EXPORT_CHUNK_ROWS))
+        rows = cursor.fetchall()
+    connection.commit()
+    return rows
+
+
+def write_day(root: str, table: ExportTable, first_id: int, rows: list[tuple]):
+    schema = arrow_schema(table.model)
+    time_index = schema.get_field_index(table.time_column)
+    day = datetime.fromtimestamp(max(rows[0][time_index], 0) / 1000, timezone.utc)
+    directory = os.path.join(root, table.name, f'date={day:%Y-%m-%d}')
+    os.makedirs(directory, exist_ok=True)
+
+    columns = list(zip(*rows))
+    arrow_table = pa.Table.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+    pq.write_table(arrow_table, os.path.join(directory, f'part-{first_id}.parquet'), compression=EXPORT_COMPRESSION)
+
+
+def export_table(pool: ConnectionPool, table: ExportTable, root: str = None, state: ExportState = None) -> int:
+    root = root or EXPORT_DIR
+    state = state or ExportState(root)
+    pool.run(ensure_id_column, table.name)
+    end_id = pool.run(last_id, table)
+    after_id = state.get(table.name) or 0
+    exported = 0
+
+    time_index = [field.name for field in fields(table.model)].index(table.time_column)
+    while after_id < end_id:
+        rows = pool.run(read_chunk, table, after_id, end_id)
+        if not rows:
+            break
+
+        day_rows = []
+        first_id = rows[0][0]
+        for row in rows:
+            if row[1 + time_index] < 0:
+                continue  # the placeholder of tokens without data
+            if day_rows and row[1 + time_index] // DAY_MS != day_rows[0][time_index] // DAY_MS:
+                write_day(root, table, first_id, day_rows)
+                day_rows = []
+                first_id = row[0]
+            day_rows.append(row[1:])
+        if day_rows:
+            write_day(root, table, first_id, day_rows)
+
+        exported += len(rows)
+        after_id = rows[-1][0]
+        state.set(table.name, after_id)
+        log.info(f'{table.name}: exported {exported} rows up to id {after_id}')
+
+    return exported
+
+
+def main(table_names: list[str]):
+    logging.basicConfig(level='INFO', format='%(asctime)s %(levelname)s: %(message)s')
+    from sql_config import DB_CONFIG
+
+    pool = ConnectionPool(DB_CONFIG)
+    state = ExportState(EXPORT_DIR)
+    for table in EXPORT_TABLES:
+        if not table_names or table.name in table_names:
+            export_table(pool, table, EXPORT_DIR, state)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
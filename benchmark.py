@@ -0,0 +1,306 @@
+"""
+Throughput of the message handlers on synthetic messages, compared with a stored baseline.
+
+    python benchmark.py                         # all the cases, compared with benchmark_baseline.json if it exists
+    python benchmark.py okx bybit               # some of them
+    python benchmark.py --save-baseline         # store the results as the new baseline
+    python benchmark.py --recording okx=recordings/ws.okx.com-1700000000.rec.gz   # recorded frames, see recorder.py
+
+For every case it prints messages/s, ns/message and the peak bytes allocated while handling one message
+(tracemalloc, in a separate pass). The exit code is 1 when a case got slower than the baseline by more than
+--tolerance, so it can run before a deployment. The timings depend on the machine, so the baseline is
+not committed: save it on the machine that runs the check, from the version deployed there.
+
+The updater modules are imported as in production, so sql_config.py and tg_bot_config.py must exist.
+"""
+import argparse
+import importlib
+import logging
+import platform
+import random
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from time import perf_counter_ns, time_ns
+from typing import Callable
+
+import orjson
+
+BASELINE_PATH = 'benchmark_baseline.json'
+BENCHMARK_MESSAGES = 200_000    # handled messages per case
+ALLOC_MESSAGES = 1_000          # messages of the allocation pass
+SEED = 1
+
+
+@dataclass
+class Fixture:
+    call: Callable              # call(item) handles one item
+    items: list
+    units: int = 1              # messages per item (the notifier checks all the notifies per call)
+
+
+CASES: dict[str, Callable[[random.Random], Fixture]] = {}
+
+
+def case(name: str):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def now_ms() -> int:
+    return time_ns() // 1_000_000
+
+
+def price(rnd: random.Random) -> str:
+    return f'{rnd.uniform(0.01, 70000):.4f}'
+
+
+def message_case(name: str, module_name: str, messages: Callable, handler: str = None):
+    """
+    Registers a case feeding messages(rnd, module) to an updater module: as json text to
+    on_message(ws, text), or as dicts straight to the function named by handler.
+    """
+    def setup(rnd: random.Random) -> Fixture:
+        module = importlib.import_module(module_name)
+        items = messages(rnd, module)
+        if handler:
+            return Fixture(getattr(module, handler), items)
+        items = [orjson.dumps(item).decode() for item in items]
+        return Fixture(lambda message: module.on_message(None, message), items)
+    CASES[name] = setup
+
+
+def per_token(message: Callable, repeat: int) -> Callable:
+    # message(rnd, token) repeat times for every token of the module, shuffled
+    def messages(rnd: random.Random, module) -> list:
+        items = [message(rnd, token) for token in module.TOKENS_LIST for _ in range(repeat)]
+        rnd.shuffle(items)
+        return items
+    return messages
+
+
+def binance_book_ticker(rnd: random.Random, token: str) -> dict:
+    return {'e': 'bookTicker', 'u': rnd.randrange(10 ** 12), 's': token, 'b': price(rnd), 'B': '1.5',
+            'a': price(rnd), 'A': '2.5', 'T': now_ms(), 'E': now_ms()}
+
+
+def binance_mark_prices(rnd: random.Random, module) -> list:
+    # the !markPrice@arr@1s frame, all the symbols of the exchange in one message
+    symbols = module.TOKENS_LIST + [f'X{n}USDT' for n in range(200)]
+    return [[{
+        'e': 'markPriceUpdate', 'E': now_ms(), 's': symbol, 'p': price(rnd), 'P': price(rnd), 'i': price(rnd),
+        'r': f'{rnd.uniform(-0.001, 0.001):.8f}', 'T': now_ms() + 3_600_000,
+    } for symbol in symbols] for _ in range(20)]
+
+
+def binance_spot_book_ticker(rnd: random.Random, token: str) -> dict:
+    return {'u': rnd.randrange(10 ** 12), 's': token, 'b': price(rnd), 'B': '1.5', 'a': price(rnd), 'A': '2.5'}
+
+
+def okx_messages(rnd: random.Random, module) -> list:
+    # 20 tickers, a funding rate and an open interest per token
+    items = []
+    for token in module.TOKENS_LIST:
+        for _ in range(20):
+            items.append({'arg': {'channel': 'tickers', 'instId': token}, 'data': [{
+                'instType': 'SWAP', 'instId': token, 'bidPx': price(rnd), 'askPx': price(rnd),
+                'volCcy24h': f'{rnd.uniform(0, 10 ** 6):.2f}', 'ts': str(now_ms()),
+            }]})
+        funding_time = now_ms() // 28_800_000 * 28_800_000
+        items.append({'arg': {'channel': 'funding-rate', 'instId': token}, 'data': [{
+            'instId': token, 'fundingRate': f'{rnd.uniform(-0.001, 0.001):.8f}', 'fundingTime': str(funding_time),
+            'nextFundingTime': str(funding_time + 28_800_000), 'ts': str(now_ms()),
+        }]})
+        items.append({'arg': {'channel': 'open-interest', 'instId': token}, 'data': [{
+            'instId': token, 'oi': f'{rnd.uniform(0, 10 ** 6):.2f}', 'ts': str(now_ms()),
+        }]})
+    rnd.shuffle(items)
+    return items
+
+
+def bybit_ticker(rnd: random.Random, token: str) -> dict:
+    return {'topic': f'tickers.{token}', 'type': 'delta', 'ts': now_ms(), 'data': {
+        'symbol': token, 'bid1Price': price(rnd), 'ask1Price': price(rnd), 'volume24h': '1000',
+        'turnover24h': f'{rnd.uniform(0, 10 ** 8):.2f}', 'fundingRate': f'{rnd.uniform(-0.001, 0.001):.6f}',
+        'nextFundingTime': str(now_ms() + 3_600_000), 'openInterest': f'{rnd.uniform(0, 10 ** 6):.2f}',
+    }}
+
+
+def deribit_ticker(rnd: random.Random, token: str) -> dict:
+    return {'jsonrpc': '2.0', 'method': 'subscription', 'params': {'channel': f'ticker.{token}.raw', 'data': {
+        'instrument_name': token, 'timestamp': now_ms(), 'current_funding': rnd.uniform(-0.001, 0.001),
+        'best_bid_price': float(price(rnd)), 'best_ask_price': float(price(rnd)),
+        'stats': {'volume_usd': rnd.uniform(0, 10 ** 8)}, 'open_interest': rnd.uniform(0, 10 ** 6),
+    }}}
+
+
+message_case('binance_futures', 'binance_futures_sql_updater', per_token(binance_book_ticker, 20))
+message_case('binance_futures_mark_price', 'binance_futures_sql_updater', binance_mark_prices)
+message_case('binance_spot', 'binance_spot_sql_updater', per_token(binance_spot_book_ticker, 50))
+message_case('okx', 'OKX_futures_sql_updater', okx_messages)
+message_case('bybit', 'bybit_futures_sql_updater', per_token(bybit_ticker, 20), handler='handle_tickers_update')
+message_case('deribit', 'deribit_futures_sql_updater', per_token(deribit_ticker, 500), handler='handle_tickers_update')
+
+
+@case('dydx_order_book')
+def dydx_order_book(rnd: random.Random) -> Fixture:
+    module = importlib.import_module('dydx_futures_sql_updater')
+    order_book = module.OrderBook()
+    offset = 1000
+    mids = {}
+    for token in module.TOKENS_LIST:
+        mid = mids[token] = rnd.uniform(1, 1000)
+        order_book.process_initial_data({'id': token, 'contents': {
+            'bids': [{'price': f'{mid - level * 0.01:.2f}', 'offset': str(offset), 'size': '1'} for level in range(1, 100)],
+            'asks': [{'price': f'{mid + level * 0.01:.2f}', 'offset': str(offset), 'size': '1'} for level in range(1, 100)],
+        }})
+
+    items = []
+    for _ in range(20_000):
+        offset += 1
+        token = rnd.choice(module.TOKENS_LIST)
+        mid = mids[token]
+        items.append({'id': token, 'type': 'channel_data', 'contents': {
+            'offset': str(offset),
+            'bids': [[f'{mid - rnd.randrange(1, 100) * 0.01:.2f}', rnd.choice(['0', '1.5'])]],
+            'asks': [[f'{mid + rnd.randrange(1, 100) * 0.01:.2f}', rnd.choice(['0', '2.5'])]],
+        }})
+    return Fixture(lambda update: order_book.update_order_book_and_best_bid_ask(update, module.update_dict), items)
+
+
+@case('notifier')
+def notifier(rnd: random.Random) -> Fixture:
+    import notifier
+    from models.future_data import FutureData
+    from models.notify import NotifyRule, NotifyType
+    from models.tax_data import TaxData
+
+    n = notifier.Notifier(db_config={})
+    exchanges = list(notifier.futures_exchanges_map)
+    tokens = sorted({coin for exchange in notifier.futures_exchanges_map.values() for coin in exchange.coins})
+    # thresholds which never fire, a fired notify would be sent to telegram
+    rules = [
+        NotifyRule(tokens, exchanges, NotifyType.price_alerts_only, sx=-100.),
+        NotifyRule(tokens, exchanges, NotifyType.funding_rates_alerts_only, fx=10. ** 9),
+        NotifyRule(tokens, exchanges, NotifyType.price_and_funding_rates_alerts, sx=-100., fx=10. ** 9),
+        NotifyRule(tokens, exchanges, NotifyType.funding_margin_rates_alerts, mf1=10. ** 9, mf2=10. ** 9),
+    ]
+    n.update_notifies(notifier.rules_to_notifies(rules))
+    now = now_ms()
+    n.data = {
+        name: {coin: FutureData(token=exchange.coin2token(coin), funding_annual_percent=rnd.uniform(-50, 50),
+                                nextFundingTime=now, funding_period=8, bidPrice=100., askPrice=100.1,
+                                volume_24h=10 ** 6, time_funding_refresh=now, time_bid_ask_refresh=now,
+                                time_insert=now, openInterest=10. ** 5, time_openInterest_refresh=now)
+               for coin in exchange.coins}
+        for name, exchange in notifier.futures_exchanges_map.items()
+    }
+    n.tax_data = {
+        name: {coin: TaxData(token=coin, tax=rnd.uniform(0, 20), timestamp=now) for coin in exchange.coins + ['USDT']}
+        for name, exchange in notifier.tax_exchanges_map.items()
+    }
+    return Fixture(lambda _: n.check_notifies(), [None] * 20, units=len(n._notifies))
+
+
+def recording_case(module_name: str, path: str) -> Callable[[random.Random], Fixture]:
+    def setup(rnd: random.Random) -> Fixture:
+        from recorder import prepare_replay, read_frames
+
+        module = importlib.import_module(module_name)
+        prepare_replay(module)
+        items = [frame.decode() for received_ns, frame in read_frames(path)]
+        return Fixture(lambda message: module.on_message(None, message), items)
+    return setup
+
+
+def run_case(fixture: Fixture, messages: int) -> dict:
+    call, items = fixture.call, fixture.items
+    for item in items:  # warm up, fills the state
+        call(item)
+
+    rounds = max(1, messages // (len(items) * fixture.units))
+    start = perf_counter_ns()
+    for _ in range(rounds):
+        for item in items:
+            call(item)
+    elapsed = perf_counter_ns() - start
+    handled = rounds * len(items) * fixture.units
+
+    tracemalloc.start()
+    allocated = 0
+    alloc_items = items[:max(1, ALLOC_MESSAGES // fixture.units)]
+    for item in alloc_items:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        call(item)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    return {
+        'messages': handled,
+        'messages_per_second': handled / elapsed * 1e9,
+        'ns_per_message': elapsed / handled,
+        'alloc_bytes_per_message': allocated / (len(alloc_items) * fixture.units),
+    }
+
+
+def environment() -> dict:
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'node': platform.node()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='handler throughput benchmark')
+    parser.add_argument('cases', nargs='*', help=f'cases to run, from {list(CASES)}')
+    parser.add_argument('--messages', type=int, default=BENCHMARK_MESSAGES)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown of ns/message, 0.2 is 20%%')
+    parser.add_argument('--recording', action='append', default=[], metavar='MODULE_CASE=PATH',
+                        help='extra case of recorded frames, e.g. okx=recording.rec.gz')
+    args = parser.parse_args()
+    logging.basicConfig(level='WARNING')
+
+    cases = {name: CASES[name] for name in args.cases or CASES}
+    for recording in args.recording:
+        name, path = recording.split('=', 1)
+        module_name = importlib.import_module('collector').FEEDS[name][0]
+        cases[f'{name}_recording'] = recording_case(module_name, path)
+
+    try:
+        with open(args.baseline, 'rb') as file:
+            baseline = orjson.loads(file.read())
+    except FileNotFoundError:
+        baseline = None
+        print(f'no baseline at {args.baseline}, nothing to compare with; run --save-baseline on this machine first')
+    if baseline and baseline['environment'] != environment():
+        print(f"baseline from another environment {baseline['environment']}, the comparison is approximate")
+
+    results = {}
+    regressions = []
+    print(f"{'case':<28}{'msgs/s':>12}{'ns/msg':>12}{'alloc B/msg':>13}{'baseline':>12}{'change':>9}")
+    for name, setup in cases.items():
+        result = results[name] = run_case(setup(random.Random(SEED)), args.messages)
+        line = (f"{name:<28}{result['messages_per_second']:>12.0f}{result['ns_per_message']:>12.0f}"
+                f"{result['alloc_bytes_per_message']:>13.0f}")
+        base = baseline and baseline['results'].get(name)
+        if base:
+            change = result['ns_per_message'] / base['ns_per_message'] - 1
+            line += f"{base['ns_per_message']:>12.0f}{change:>+9.1%}"
+            if change > args.tolerance:
+                regressions.append(name)
+        print(line)
+
+    if args.save_baseline:
+        with open(args.baseline, 'wb') as file:
+            file.write(orjson.dumps({'environment': environment(), 'results': results}, option=orjson.OPT_INDENT_2))
+        print(f'baseline saved to {args.baseline}')
+
+    if regressions:
+        print(f'slower than the baseline by more than {args.tolerance:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,16 @@
-from time import sleep, time_ns
-from threading import Event, Thread, RLock
+from functools import partial
+from time import time_ns
+from threading import Event, Thread
 
 import orjson
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 
 from db import create_futures_db_connection, insert_or_update_futures_thread
 from tg import send_telegram_error, start_telegram_worker
 from wsocket import process_websocket
+from metrics import start_metrics_server
+from latency import latency_recorder
+from rest import binance_funding_rate, binance_weight, client
+from metadata_cache import MetadataCache, refresh_loop
 
 from sql_config import DB_CONFIG
 from exchanges.binance import BinanceFuturesExchange
@@ -19,45 +21,45 @@ TOKENS_LIST = exchange.tokens
 
 # Dictionary to store updates
 update_dict = exchange.create_update_dict()
+latency = latency_recorder(exchange.table_name)
 
 active_threads = []
 stop_event = Event()
-lock = RLock()
+lock = update_dict.lock  # guards the columns against a torn snapshot
+WS_SHARD_SIZE = 60  # bookTicker streams per connection
+# e.g. {'workers': 2, 'decode_processes': 2} to decode and apply the messages off the websocket threads,
+# in order per symbol, see QueueWorker
+WS_QUEUE_OPTIONS = None
+FUNDING_PERIOD_TTL = 3600  # seconds, the funding periods are kept in the metadata cache between the runs
+metadata = MetadataCache(exchange.table_name)
 
+client.limit(exchange.rest_url, binance_weight)
+client.limit(f'{exchange.rest_url}/fapi/v1/fundingRate', binance_funding_rate)
 
-def make_binance_API_request(session, binance_api_endpoint, retry_attempts: int = 5, params=None):
-    for i in range(retry_attempts):
-        try:
 
-            response = session.get(binance_api_endpoint, params=params, timeout=10)
-
-            if response.status_code == 200:
-                return response
-            if response.status_code == 400:
-                return None
-        except requests.RequestException as e:
-            print(f"Request failed due to {e}. Retrying...")
-
-        # Exponential back-off logic
-        sleep(0.5 * (2 ** i))
+def on_message(ws, message):
+    on_data(ws, orjson.loads(message))
 
-    return None
 
+def message_key(ws, data):
+    # the queue partition, bookTicker of one symbol stays in order
+    return data.get('s') if isinstance(data, dict) else None
 
-def on_message(ws, message):
-    data = orjson.loads(message)
 
+def on_data(ws, data):
     # print(data)
     if isinstance(data, dict):
         if "e" in data and data['e'] == 'bookTicker':
-            symbol = data['s']
+            slot = update_dict.index[data['s']]
+            current_time = time_ns() // 1_000_000  # time in milliseconds
+            latency.record(data['E'], current_time)
 
             with lock:
-                update_dict[symbol].update({
-                    'bidPrice': float(data['b']),
-                    'askPrice': float(data['a']),
-                    'time_bid_ask_refresh': time_ns() // 1_000_000  # time in milliseconds
-                })
+                update_dict.bidPrice[slot] = float(data['b'])
+                update_dict.askPrice[slot] = float(data['a'])
+                update_dict.time_bid_ask_refresh[slot] = current_time
+                update_dict.time_exchange[slot] = data['E']
+                update_dict.dirty[slot] = 1
         elif data['result']:  # None means the subscribe message {'result': None, 'id': 2}
             send_telegram_error(f"binance_futures_sql_updater.py\nif e in data and data['e'] == 'bookTicker'\n{data}")
 
@@ -68,35 +70,38 @@ def on_message(ws, message):
 
 
 def handle_mark_price_update(data_initial, update_dict):
+    index = update_dict.index
+    funding_period = update_dict.funding_period
+    current_time = time_ns() // 1_000_000  # time in milliseconds
+    if data_initial:
+        latency.record(data_initial[0]['E'], current_time)
     for data in data_initial:
-        symbol = data['s']
+        slot = index.get(data['s'])
 
-        if not (symbol in TOKENS_LIST):
+        if slot is None:
             continue
 
-        funding_annual_percent = float(data['r']) / update_dict[symbol]['funding_period'] * 876000  # *24*365*100
+        funding_annual_percent = float(data['r']) / funding_period[slot] * 876000  # *24*365*100
         next_funding_time = int(data['T'])
 
         with lock:
-            update_dict[symbol].update({
-                'funding_annual_percent': funding_annual_percent,
-                'nextFundingTime': next_funding_time,
-                'time_funding_refresh': time_ns() // 1_000_000  # time in milliseconds
-            })
+            update_dict.funding_annual_percent[slot] = funding_annual_percent
+            update_dict.nextFundingTime[slot] = next_funding_time
+            update_dict.time_funding_refresh[slot] = current_time
+            update_dict.time_exchange[slot] = data['E']
+            update_dict.dirty[slot] = 1
 
 
 # Quote asset should be in USD to get volume in USD
-def thread_volume24h_data(session, tokens_list, update_dict, stop_event):
+def thread_volume24h_data(client, tokens_list, update_dict, stop_event):
     while not stop_event.is_set():
-        responce = make_binance_API_request(session,
-                                            binance_api_endpoint='https://fapi.binance.com/fapi/v1/ticker/24hr')
+        data = client.get_json(f'{exchange.rest_url}/fapi/v1/ticker/24hr', weight=40, stop_event=stop_event)
 
-        data = responce.json()
-        print(responce.headers['x-mbx-used-weight-1m'])
-        with lock:
-            for row in data:
-                if row["symbol"] in tokens_list:
-                    update_dict[row["symbol"]].update({"volume24h": float(row["quoteVolume"])})
+        if data:
+            with lock:
+                for row in data:
+                    if row["symbol"] in update_dict:
+                        update_dict.update(row["symbol"], volume24h=float(row["quoteVolume"]))
 
         if stop_event.wait(3600):
             break
@@ -105,7 +110,7 @@ def thread_volume24h_data(session, tokens_list, update_dict, stop_event):
 # def thread_openInterest_data(session, tokens_list, update_dict, stop_event):
 #     while not stop_event.is_set():
 #         responce = make_binance_API_request(session,
-#                                             binance_api_endpoint='https://fapi.binance.com/fapi/v1/openInterest')
+#                                             binance_api_endpoint=f'{exchange.rest_url}/fapi/v1/openInterest')
 #
 #         data = responce.json()
 #
@@ -119,97 +124,87 @@ def thread_volume24h_data(session, tokens_list, update_dict, stop_event):
 #         if stop_event.wait(3600):
 #             break
 
-def thread_openInterest_data(session, tokens_list, update_dict, stop_event):
+def thread_openInterest_data(client, tokens_list, update_dict, stop_event):
+    url = f'{exchange.rest_url}/fapi/v1/openInterest'
     while not stop_event.is_set():
-
-        base_url = 'https://fapi.binance.com/fapi/v1/openInterest'
-
-
-        for token in tokens_list:
-            params = {
-                'symbol': token,
-
-            }
-            response = session.get(base_url, params=params)
-            data = response.json()
-            with lock:
-                update_dict[data["symbol"]].update({"openInterest": float(data["openInterest"])})
-                update_dict[data["symbol"]].update({"time_openInterest_refresh": time_ns() // 1_000_000})
+        # concurrent within the weight budget, every symbol is applied as soon as it arrives
+        for params, data in client.fetch_each(url, [{'symbol': token} for token in tokens_list], stop_event=stop_event):
+            if data:
+                update_dict.update(data["symbol"], openInterest=float(data["openInterest"]),
+                                   time_openInterest_refresh=time_ns() // 1_000_000)
 
         if stop_event.wait(60*5):
             break
 
-            # Gets funding period based on 2 last funding times
-
-
-def thread_funding_period_data(session, tokens_list, update_dict, stop_event):
-    while not stop_event.is_set():
-
-        base_url = 'https://fapi.binance.com/fapi/v1/fundingRate'
-        limit = 2  # Fetching the two most recent funding rates
-
-        for token in tokens_list:
-            params = {
-                'symbol': token,
-                'limit': limit
-            }
-            response = session.get(base_url, params=params)
-            data = response.json()
-            # print(response.headers)
 
+# Gets funding period based on 2 last funding times
+def fetch_funding_periods(client, tokens_list, update_dict, stop_event):
+    url = f'{exchange.rest_url}/fapi/v1/fundingRate'
+    limit = 2  # Fetching the two most recent funding rates
+    periods = {}
+    for params, data in client.fetch_each(url, [{'symbol': token, 'limit': limit} for token in tokens_list],
+                                          stop_event=stop_event):
+        if data and len(data) == limit:
             # Calculate the difference in hours between the two funding times
-            funding_time_diff = (data[1]['fundingTime'] - data[0]['fundingTime']) // (
-                        1000 * 3600)  # Converting to hours
-            with lock:
-                update_dict[token].update({'funding_period': funding_time_diff})
-
-        if stop_event.wait(3600):
-            break
-
-
-def on_open(ws):
+            funding_time_diff = (data[1]['fundingTime'] - data[0]['fundingTime']) // (1000 * 3600)
+            periods[params['symbol']] = funding_time_diff
+            update_dict.update(params['symbol'], funding_period=funding_time_diff)
+    # the symbols which failed keep their cached period
+    return {**(metadata.get('funding_period') or {}), **periods} if periods else None
+
+
+def thread_funding_period_data(client, tokens_list, update_dict, stop_event):
+    # the cached periods right away, the sweep only once they are older than FUNDING_PERIOD_TTL
+    for token, period in (metadata.get('funding_period') or {}).items():
+        if token in update_dict:
+            update_dict.update(token, funding_period=period)
+    refresh_loop(metadata, 'funding_period', FUNDING_PERIOD_TTL,
+                 partial(fetch_funding_periods, client, tokens_list, update_dict, stop_event), stop_event)
+
+
+def on_open(ws, tokens=TOKENS_LIST, shard=0):
+    params = [f"{token.lower()}@bookTicker" for token in tokens]
+    if shard == 0:
+        params.append('!markPrice@arr@1s')  # all the symbols at once, one connection is enough
     subscribe_message = orjson.dumps({
         "method": "SUBSCRIBE",
-        "params": [f"{token.lower()}@bookTicker" for token in TOKENS_LIST] + ['!markPrice@arr@1s'],
+        "params": params,
         "id": 2
     })
     ws.send(subscribe_message)
 
 
+def rest_pollers(client, stop_event):
+    # blocking REST loops, started as threads here or on the executor of collector.py
+    return [
+        partial(thread_volume24h_data, client, TOKENS_LIST, update_dict, stop_event),
+        partial(thread_funding_period_data, client, TOKENS_LIST, update_dict, stop_event),
+        partial(thread_openInterest_data, client, TOKENS_LIST, update_dict, stop_event),
+    ]
+
+
 if __name__ == '__main__':
+    start_metrics_server()
     start_telegram_worker(stop_event)
     CONNECTION = create_futures_db_connection(db_config=DB_CONFIG,
                                               table_name=exchange.table_name)
 
-    session = requests.Session()
-    retry_strategy = Retry(
-        total=100,  # Number of retries
-        backoff_factor=10,  # Delay between retries
-        status_forcelist=[401, 402, 403, 500, 502, 503, 504])
-
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
-
-    thread1 = Thread(target=thread_volume24h_data, args=(session, TOKENS_LIST, update_dict, stop_event))
-    thread1.start()
-    active_threads.append(thread1)
-
-    thread2 = Thread(target=thread_funding_period_data,
-                     args=(session, TOKENS_LIST, update_dict, stop_event))
-    thread2.start()
-    active_threads.append(thread2)
-
-    thread3 = Thread(target=thread_openInterest_data,
-                     args=(session, TOKENS_LIST, update_dict, stop_event))
-    thread3.start()
-    active_threads.append(thread3)
+    for poller in rest_pollers(client, stop_event):
+        thread = Thread(target=poller)
+        thread.start()
+        active_threads.append(thread)
 
     insert_or_update_futures_thread(CONNECTION, exchange.table_name, update_dict)
 
-    process_websocket(url="wss://fstream.binance.com/ws",
+    queue_options = WS_QUEUE_OPTIONS and dict(WS_QUEUE_OPTIONS, decode=orjson.loads, partition=message_key)
+
+    process_websocket(url=exchange.ws_url,
                       on_open=on_open,
-                      on_message=on_message,
+                      on_message=on_data if queue_options else on_message,
+                      use_queue=bool(queue_options),
+                      queue_options=queue_options,
                       stop_event=stop_event,
                       active_threads=active_threads,
+                      symbols=TOKENS_LIST,
+                      shard_size=WS_SHARD_SIZE,
                       )
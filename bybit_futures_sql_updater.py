@@ -1,13 +1,17 @@
-import websocket
 import orjson
 import threading
 import traceback
-import sys
 from ColoredOutput import ColoredOutput
 from sql_config import DB_CONFIG
 from tg import send_telegram_error, start_telegram_worker
 from db import create_futures_db_connection, insert_or_update_futures_thread
-import requests
+from wsocket import process_websocket
+from metrics import start_metrics_server
+from subscriptions import SubscriptionManager
+from latency import latency_recorder
+from rest import client
+from metadata_cache import MetadataCache, refresh_loop
+from functools import partial
 from time import time_ns
 from exchanges.bybit import BybitFuturesExchange
 
@@ -15,12 +19,27 @@ from exchanges.bybit import BybitFuturesExchange
 exchange = BybitFuturesExchange()
 TOKENS_LIST = exchange.tokens
 update_dict = exchange.create_update_dict()
+latency = latency_recorder(exchange.table_name)
+FUNDING_PERIOD_TTL = 7200  # seconds, the funding periods are kept in the metadata cache between the runs
+INSTRUMENTS_PAGE_LIMIT = 1000  # the maximum of instruments-info
+metadata = MetadataCache(exchange.table_name)
+
+active_threads = []
+stop_event = threading.Event()
+
+# linear topics are limited to 10 args per subscribe request, acked by req_id
+subscriptions = SubscriptionManager('Bybit', max_args=10,
+                                    build_frame=lambda args, request_id: {"op": "subscribe", "req_id": str(request_id),
+                                                                          "args": args},
+                                    symbol_of=lambda arg: arg.split('.')[1])
 
 
 def on_message(ws, message):
     data = orjson.loads(message)
 
-    if 'success' == list(data.keys())[0]:
+    if 'success' in data:
+        if data.get('op') == 'subscribe' and data.get('req_id'):
+            subscriptions.ack(int(data['req_id']), ok=data['success'], error=data.get('ret_msg'))
         return
 
     # print(data) 
@@ -36,74 +55,105 @@ def handle_tickers_update(data):
     global update_dict
 
     item = data['data']
-    symbol = item['symbol']
+    slot = update_dict.index[item['symbol']]
 
-    # Preparing the updates in a single dictionary
-    updates = {}
     current_time = time_ns() // 1_000_000  # time in milliseconds
+    latency.record(data['ts'], current_time)
 
-    if 'bid1Price' in item:
-        updates['bidPrice'] = float(item['bid1Price'])
-        updates['time_bid_ask_refresh'] = current_time  # time in milliseconds
+    with update_dict.lock:
+        update_dict.time_exchange[slot] = data['ts']
+        if 'bid1Price' in item:
+            update_dict.bidPrice[slot] = float(item['bid1Price'])
+            update_dict.time_bid_ask_refresh[slot] = current_time  # time in milliseconds
 
-    if 'ask1Price' in item:
-        updates['askPrice'] = float(item['ask1Price'])
-        updates['time_bid_ask_refresh'] = current_time  # time in milliseconds
+        if 'ask1Price' in item:
+            update_dict.askPrice[slot] = float(item['ask1Price'])
+            update_dict.time_bid_ask_refresh[slot] = current_time  # time in milliseconds
 
-    if 'volume24h' in item:
-        updates['volume24h'] = float(item['turnover24h'])
+        if 'volume24h' in item:
+            update_dict.volume24h[slot] = float(item['turnover24h'])
 
-    if 'fundingRate' in item:
-        updates['funding_annual_percent'] = float(item['fundingRate']) / update_dict[symbol]['funding_period'] * 876000
-        updates['time_funding_refresh'] = current_time  # time in milliseconds
+        if 'fundingRate' in item:
+            update_dict.funding_annual_percent[slot] = float(item['fundingRate']) / update_dict.funding_period[slot] * 876000
+            update_dict.time_funding_refresh[slot] = current_time  # time in milliseconds
 
-    if 'nextFundingTime' in item:
-        updates['nextFundingTime'] = float(item['nextFundingTime'])
-    if 'openInterest' in item:
-        # print('openInterest', float(item['openInterest']))
-        updates['openInterest'] = float(item['openInterest'])
-        updates['time_openInterest_refresh'] = current_time  # time in milliseconds
+        if 'nextFundingTime' in item:
+            update_dict.nextFundingTime[slot] = int(item['nextFundingTime'])
+        if 'openInterest' in item:
+            # print('openInterest', float(item['openInterest']))
+            update_dict.openInterest[slot] = float(item['openInterest'])
+            update_dict.time_openInterest_refresh[slot] = current_time  # time in milliseconds
 
-    # Applying the updates in a single call
-    update_dict[symbol].update(updates)
+        update_dict.dirty[slot] = 1
 
 
 def on_open(ws):
+    # Subscribe to tickers topic
+    subscriptions.subscribe(ws, [f"tickers.{token}" for token in TOKENS_LIST])
+
+
+def fetch_instruments(client, stop_event):
+    # the whole linear category in pages of INSTRUMENTS_PAGE_LIMIT, None when a page fails
+    url = f"{exchange.rest_url}/v5/market/instruments-info"
+    params = {"category": "linear", "limit": INSTRUMENTS_PAGE_LIMIT}
+    items = []
+    cursors = set()
+    while True:
+        data = client.get_json(url, params=params, stop_event=stop_event)
+        if not data or data.get('retCode') != 0:
+            return None
+        items.extend(data["result"]["list"])
+        cursor = data["result"].get("nextPageCursor")
+        if not cursor or cursor in cursors:
+            return items
+        cursors.add(cursor)
+        params['cursor'] = cursor
+
+
+def fetch_funding_period(client, token, stop_event):
+    # single symbol fallback for the ones missing in the bulk pages
+    data = client.get_json(f"{exchange.rest_url}/v5/market/instruments-info",
+                           params={"category": "linear", "symbol": token}, stop_event=stop_event)
+    try:
+        return int(data["result"]["list"][0]["fundingInterval"]) // 60
+    except (TypeError, KeyError, IndexError, ValueError):
+        return None
+
+
+def fetch_funding_periods(client, stop_event):
+    periods = {}
+    for item in fetch_instruments(client, stop_event) or []:
+        if item["symbol"] in update_dict and int(item.get("fundingInterval") or 0) > 0:
+            periods[item["symbol"]] = int(item["fundingInterval"]) // 60
+
+    missing = []
     for token in TOKENS_LIST:
-        # Subscribe to tickers topic
-        message = {
-            "op": "subscribe",
-            "args": [
-                f"tickers.{token}"
-            ]
-        }
-        ws.send(orjson.dumps(message))
-
-
-def update_funding_period(stop_event):
-    url = "https://api.bybit.com/v5/market/instruments-info"
-    params = {
-        "category": "linear",
-        "limit": 1
-    }
-
-    while not stop_event.is_set():
-
-        try:
-            for token in TOKENS_LIST:
-                params['symbol'] = token
-                response = requests.get(url, params=params)
-                data = response.json()
-                item = data["result"]["list"][0]
-                update_dict[item["symbol"]].update({'funding_period': int(item["fundingInterval"]) // 60})
-
-        except Exception as e:
-            send_telegram_error(f"bybit_futures_sql_updater.p\nupdate_funding_period error\n{e}")
-
-        ColoredOutput.green("FR period updated")
-
-        if stop_event.wait(7200):  # 2 hours
-            break
+        if token not in periods and not stop_event.is_set():
+            period = fetch_funding_period(client, token, stop_event)
+            if period:
+                periods[token] = period
+            else:
+                missing.append(token)
+    if missing and not stop_event.is_set():
+        send_telegram_error(f"bybit_futures_sql_updater.py\nno funding period for {missing}")
+
+    # all the symbols at once, a snapshot never mixes two sweeps
+    with update_dict.lock:
+        for token, period in periods.items():
+            update_dict.update(token, funding_period=period)
+
+    ColoredOutput.green(f"FR period updated {len(periods)}/{len(TOKENS_LIST)}")
+    # the symbols which failed keep their cached period
+    return {**(metadata.get('funding_period') or {}), **periods} if periods else None
+
+
+def update_funding_period(client, stop_event):
+    # the cached periods right away, the requests only once they are older than FUNDING_PERIOD_TTL
+    for token, period in (metadata.get('funding_period') or {}).items():
+        if token in update_dict:
+            update_dict.update(token, funding_period=period)
+    refresh_loop(metadata, 'funding_period', FUNDING_PERIOD_TTL, partial(fetch_funding_periods, client, stop_event),
+                 stop_event)
 
 
 def on_error(ws, error):
@@ -117,37 +167,30 @@ def on_error(ws, error):
     send_telegram_error(error_message)
 
 
-def on_close(ws, close_status_code=None, close_msg=None):
-    stop_event.set()
-
-    for t in active_threads:
-        t.join()
+def rest_pollers(client, stop_event):
+    # blocking REST loops, started as threads here or on the executor of collector.py
+    return [partial(update_funding_period, client, stop_event)]
 
-    ws.close()
-    error_messsage = f"### WebSocket closed ###\n{ws.url}\nAll threads are closed."
-    send_telegram_error(error_messsage)
-    sys.exit()
-
-
-# Database connection and initialization
-CONNECTION = create_futures_db_connection(db_config=DB_CONFIG, table_name=exchange.table_name)
-active_threads = []
-stop_event = threading.Event()
-start_telegram_worker(stop_event)
 
-# Start funding period update
-thread1 = threading.Thread(target=update_funding_period, args=(stop_event,))
-thread1.start()
-active_threads.append(thread1)
+if __name__ == '__main__':
+    start_metrics_server()
+    # Database connection and initialization
+    CONNECTION = create_futures_db_connection(db_config=DB_CONFIG, table_name=exchange.table_name)
+    start_telegram_worker(stop_event)
 
-# Start database update thread
-insert_or_update_futures_thread(CONNECTION, exchange.table_name, update_dict)
+    # Start funding period update
+    for poller in rest_pollers(client, stop_event):
+        thread = threading.Thread(target=poller)
+        thread.start()
+        active_threads.append(thread)
 
-# WebSocket configuration
-ws = websocket.WebSocketApp("wss://stream.bybit.com/v5/public/linear",  # Update the URL as needed
-                            on_open=on_open,
-                            on_message=on_message,
-                            on_error=on_error,
-                            on_close=on_close)
+    # Start database update thread
+    insert_or_update_futures_thread(CONNECTION, exchange.table_name, update_dict)
 
-ws.run_forever()
+    # WebSocket configuration
+    process_websocket(url=exchange.ws_url,
+                      on_open=on_open,
+                      on_message=on_message,
+                      on_error=on_error,
+                      stop_event=stop_event,
+                      active_threads=active_threads)
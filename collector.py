@@ -0,0 +1,210 @@
+"""
+All the exchange feeds in one process on one asyncio event loop, instead of a container per script:
+
+    python collector.py                              # all feeds
+    python collector.py binance_futures okx bybit    # some of them
+
+Every feed keeps its module (binance_futures_sql_updater.py, ...) with the same on_open/on_message
+handlers and live state, the websockets are read by aiohttp on the loop. The blocking REST loops of
+the modules (rest_pollers) run on a thread pool, a poller which raises is reported and restarted. All feeds
+share one REST client (rest.py), one database pool and one scheduler for the snapshots.
+
+The single scripts still work as before.
+"""
+import asyncio
+import importlib
+import logging
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Event
+from time import perf_counter
+
+import aiohttp
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from db import ConnectionPool, create_futures_db_connection, create_spot_db_connection, \
+    insert_or_update_futures_thread, insert_or_update_spot_thread
+from tg import send_telegram_error, start_telegram_worker
+from metrics import start_metrics_server
+from rest import client
+from wsocket import ConnectionStats, connection_stats, default_on_error, reconnect_delay, split_shards
+
+
+# feed name: (module, table kind)
+FEEDS = {
+    'binance_spot': ('binance_spot_sql_updater', 'spot'),
+    'binance_futures': ('binance_futures_sql_updater', 'futures'),
+    'okx': ('OKX_futures_sql_updater', 'futures'),
+    'bybit': ('bybit_futures_sql_updater', 'futures'),
+    'deribit': ('deribit_futures_sql_updater', 'futures'),
+    'dydx': ('dydx_futures_sql_updater', 'futures'),
+    'vertex': ('vertexprotocol_sql_updater', 'futures'),
+}
+COLLECTOR_DB_POOL_SIZE = 4
+POLLER_RESTART_DELAY = 30   # seconds before a failed REST poller is started again
+
+try:
+    from local_settings import *
+except ImportError:
+    pass
+
+log = logging.getLogger('collector')
+
+
+class AsyncWebSocket:
+    """
+    The part of WebSocketApp the handlers use (url, send) on top of an aiohttp websocket.
+
+    send() only queues the frame, so it can be called from the loop and from the REST threads
+    (vertex asks for the prices from its funding poller).
+    """
+
+    def __init__(self, url: str, loop: asyncio.AbstractEventLoop):
+        self.url = url
+        self.loop = loop
+        self._queue = asyncio.Queue()
+
+    def send(self, data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, data)
+
+    async def sender(self, ws: aiohttp.ClientWebSocketResponse):
+        while True:
+            await ws.send_str(await self._queue.get())
+
+
+async def run_feed(module, http: aiohttp.ClientSession, tokens: list[str] = None, shard: int = 0):
+    loop = asyncio.get_running_loop()
+    url = module.exchange.ws_url
+    heartbeat = getattr(module, 'WS_PING_INTERVAL', None)
+    on_open = module.on_open if tokens is None else partial(module.on_open, tokens=tokens, shard=shard)
+    stats = ConnectionStats(url, shard=shard)
+    connection_stats.append(stats)
+    attempt = 0
+
+    while True:
+        ws_app = AsyncWebSocket(url, loop)
+        messages = stats.messages
+        try:
+            async with http.ws_connect(url, heartbeat=heartbeat, max_msg_size=0) as ws:
+                sender = asyncio.create_task(ws_app.sender(ws))
+                try:
+                    stats.on_connect()
+                    on_open(ws_app)
+
+                    async for message in ws:
+                        if message.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                            stats.on_frame()
+                            start = perf_counter()
+                            try:
+                                module.on_message(ws_app, message.data)
+                            except Exception as e:
+                                default_on_error(ws_app, e)
+                            stats.handler_seconds += perf_counter() - start
+                        elif message.type == aiohttp.WSMsgType.ERROR:
+                            raise ws.exception()
+                finally:
+                    sender.cancel()
+            log.warning(f'WebSocket {url} closed: {ws.close_code}')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            default_on_error(ws_app, e)
+
+        stats.on_disconnect()
+        # a connection which delivered data resets the backoff
+        attempt = 0 if stats.messages > messages else attempt + 1
+        delay = reconnect_delay(attempt)
+        log.warning(f'{url} shard {shard} disconnected, reconnect #{stats.reconnects + 1} in {delay:.1f}s')
+        await asyncio.sleep(delay)
+        stats.reconnects += 1
+
+
+async def run_poller(poller, executor: ThreadPoolExecutor, stop_event: Event):
+    # a poller ends only on stop_event, one which raised would leave its fields stale without a word
+    loop = asyncio.get_running_loop()
+    name = getattr(poller, 'func', poller).__name__
+    while not stop_event.is_set():
+        try:
+            await loop.run_in_executor(executor, poller)
+            return
+        except Exception as e:
+            log.exception(f'REST poller {name} failed')
+            send_telegram_error(f"collector.py\nREST poller {name} failed, restart in {POLLER_RESTART_DELAY}s\n{e!r}")
+        await asyncio.sleep(POLLER_RESTART_DELAY)
+
+
+async def main(feed_names: list[str]):
+    from sql_config import DB_CONFIG
+
+    loop = asyncio.get_running_loop()
+    stop_event = Event()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    unknown = set(feed_names) - set(FEEDS)
+    if unknown:
+        raise SystemExit(f'unknown feeds {sorted(unknown)}, choose from {list(FEEDS)}')
+    feeds = {name: FEEDS[name] for name in feed_names or FEEDS}
+
+    start_telegram_worker(stop_event)
+    start_metrics_server()
+    pool = ConnectionPool(DB_CONFIG, size=COLLECTOR_DB_POOL_SIZE)
+    scheduler = BackgroundScheduler()
+
+    modules = {}
+    for name, (module_name, kind) in feeds.items():
+        module = modules[name] = importlib.import_module(module_name)
+        table_name = module.exchange.table_name
+        if kind == 'spot':
+            create_spot_db_connection(DB_CONFIG, table_name, pool=pool)
+            insert_or_update_spot_thread(pool, table_name, module.update_dict, scheduler=scheduler)
+        else:
+            create_futures_db_connection(DB_CONFIG, table_name, pool=pool)
+            insert_or_update_futures_thread(pool, table_name, module.update_dict, scheduler=scheduler)
+
+    pollers = []
+    for module in modules.values():
+        if hasattr(module, 'prepare'):
+            await loop.run_in_executor(None, module.prepare, client)
+        if hasattr(module, 'rest_pollers'):
+            pollers.extend(module.rest_pollers(client, stop_event))
+
+    executor = ThreadPoolExecutor(max_workers=max(len(pollers), 1), thread_name_prefix='rest')
+    poller_tasks = [asyncio.create_task(run_poller(poller, executor, stop_event)) for poller in pollers]
+    scheduler.start()
+
+    # the websockets get their own session, the REST connector bounds the connections per host
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+        tasks = []
+        for name, module in modules.items():
+            if hasattr(module, 'WS_SHARD_SIZE'):
+                # the same sharding as process_websocket, a connection per WS_SHARD_SIZE tokens
+                for shard, tokens in enumerate(split_shards(module.TOKENS_LIST, module.WS_SHARD_SIZE)):
+                    tasks.append(asyncio.create_task(run_feed(module, http, tokens, shard), name=f'{name}-{shard}'))
+            else:
+                tasks.append(asyncio.create_task(run_feed(module, http), name=name))
+        log.info(f'collecting {list(modules)}')
+        await stopping.wait()
+
+        log.info('stopping')
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    stop_event.set()
+    for task in poller_tasks:
+        task.cancel()
+    await asyncio.gather(*poller_tasks, return_exceptions=True)
+    scheduler.shutdown()
+    executor.shutdown(wait=True)
+    pool.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level='INFO', format='%(asctime)s %(levelname)s: %(message)s')
+    asyncio.run(main(sys.argv[1:]))
@@ -1,21 +1,168 @@
 from dataclasses import dataclass
+from datetime import datetime, timezone
 import logging
+import os
+from tempfile import NamedTemporaryFile
 
 import pymysql
 from pymysql.connections import Connection
 from pymysql.cursors import DictCursor
 from ColoredOutput import ColoredOutput
-from contextlib import closing
+from collections import deque
+from contextlib import closing, contextmanager
+from functools import partial
+from threading import BoundedSemaphore, Lock
+from typing import Callable
 from apscheduler.schedulers.background import BackgroundScheduler
-from time import time_ns
+from array import array
+from itertools import islice, repeat
+from math import isnan, nan
+from time import monotonic, perf_counter, time_ns
 
 from models.future_data import FutureData
 from models.tax_data import TaxData
 from exchanges import Exchange
+from snapshot_store import SnapshotStore
+from spool import Spool
 
 
 logging.basicConfig(format='[%(asctime)s] %(name)s %(levelname)-8s %(message).10240s', level='INFO')
 
+INSERT_CHUNK_ROWS = 1000        # rows per multi-row INSERT statement
+LOAD_DATA_MIN_ROWS = 5000       # batches from this size are sent with LOAD DATA LOCAL INFILE
+# LOAD DATA reads a file, keep it in memory where the OS allows it
+LOAD_DATA_TMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+STORAGE_MAINTENANCE = True      # daily partitions, retention and downsampling of the futures history tables
+HISTORY_RETENTION_DAYS = 180    # daily partitions older than this are dropped
+PARTITION_DAYS_AHEAD = 3        # empty partitions created in advance
+DOWNSAMPLE_INTERVALS = {        # aggregate table suffix: bucket size in ms
+    '1h': 3_600_000,
+    '1d': 86_400_000,
+}
+SPOOL_DIR = 'spool'             # failed snapshot batches are kept here until the database is back
+SPOOL_MAX_BYTES = 512 * 1024 * 1024
+SNAPSHOT_DELTA_MODE = False     # write only the tokens whose values changed since the previous snapshot
+SNAPSHOT_INTERVAL = 300         # seconds between snapshots, down to 1
+SNAPSHOT_INTERVALS = {}         # per exchange interval, table name: seconds
+SNAPSHOT_TRIGGER_MID_PERCENT = None     # flush early when a mid price moved more than this % since the last snapshot
+SNAPSHOT_TRIGGER_FUNDING = None         # flush early when funding_annual_percent moved more than this
+SNAPSHOT_TRIGGER_MIN_INTERVAL = 1.      # seconds between triggered snapshots, bursts are coalesced
+STORE_EXCHANGE_TIME = False     # add the exchange event time of the last update (time_exchange) to the futures rows
+
+try:
+    from local_settings import *
+except ImportError:
+    pass
+
+DAY_MS = 86_400_000
+# insertion order of the history rows, archive_export.py resumes from it
+ID_COLUMN = 'id BIGINT NOT NULL AUTO_INCREMENT, INDEX idx_id (id)'
+
+_unpartitioned = set()  # tables maintain_partitions warned about
+
+# registries of the process, exported by metrics.py
+pools: list = []                            # ConnectionPool instances
+snapshot_stores: dict[str, SnapshotStore] = {}   # table name: live state
+write_stats: dict[str, dict] = {}           # table name: totals of the snapshot writes
+
+
+class ConnectionPool:
+    """
+    Small pool of pymysql connections shared by the snapshot jobs and the notifier.
+
+    Every connection is pinged before use and reopened if the server dropped it
+    (wait_timeout, network blip), so one outage does not break all later writes.
+    """
+    errors = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+    def __init__(self, db_config: dict, size: int = 2):
+        self.db_config = db_config
+        self.size = size
+        self._idle: deque[Connection] = deque()
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(size)
+        self.metrics = {'created': 0, 'reused': 0, 'reconnects': 0, 'errors': 0, 'in_use': 0}
+        pools.append(self)
+
+    def connect(self) -> Connection:
+        connection = pymysql.connect(
+            host=self.db_config['host'],
+            port=self.db_config['port'],
+            user=self.db_config['user'],
+            password=self.db_config['password'],
+            db=self.db_config['db'],
+        )
+        self._count('created')
+        return connection
+
+    def _count(self, metric: str, value: int = 1):
+        with self._lock:
+            self.metrics[metric] += value
+
+    def _acquire(self) -> Connection:
+        with self._lock:
+            connection = self._idle.popleft() if self._idle else None
+        if connection is None:
+            return self.connect()
+        try:
+            # no silent reconnect inside ping, a dead connection is replaced and counted here
+            connection.ping(reconnect=False)
+        except pymysql.err.Error:
+            self._count('reconnects')
+            if connection.open:
+                connection.close()
+            return self.connect()
+        self._count('reused')
+        return connection
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        self._count('in_use')
+        connection = None
+        try:
+            connection = self._acquire()
+            yield connection
+        except self.errors:
+            # the connection is broken, do not return it to the pool
+            self._count('errors')
+            if connection is not None and connection.open:
+                connection.close()
+            connection = None
+            raise
+        except BaseException:
+            # do not leave a half-done transaction for the next user
+            try:
+                if connection is not None:
+                    connection.rollback()
+            except self.errors:
+                connection.close()
+                connection = None
+            raise
+        finally:
+            if connection is not None:
+                with self._lock:
+                    self._idle.append(connection)
+            self._count('in_use', -1)
+            self._slots.release()
+
+    def run(self, func, *args, retries: int = 1):
+        """Call func(connection, *args), retrying with a fresh connection if the connection fails"""
+        for attempt in range(retries + 1):
+            try:
+                with self.connection() as connection:
+                    return func(connection, *args)
+            except self.errors as err:
+                if attempt == retries:
+                    raise
+                logging.warning(f'DB connection error, reconnecting: {err} {self.metrics}')
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.popleft().close()
+
 
 # import time
 
@@ -29,20 +176,20 @@ logging.basicConfig(format='[%(asctime)s] %(name)s %(levelname)-8s %(message).10
 #     return wrapper
 
 
-def create_spot_db_connection(db_config, table_name):
-    return create_db_connection(db_config, table_name, table_structure=f"""
+def create_spot_db_connection(db_config, table_name, pool: ConnectionPool = None):
+    return create_db_connection(db_config, table_name, pool=pool, table_structure=f"""
                                                                             CREATE TABLE IF NOT EXISTS {table_name} (
                                                                                 token VARCHAR(32),
                                                                                 bidPrice FLOAT,
                                                                                 askPrice FLOAT,
                                                                                 volume_24h BIGINT,
-                                                                                time BIGINT
+                                                                                time BIGINT,
+                                                                                {ID_COLUMN}
                                                                                 )""")
 
 
-def create_futures_db_connection(db_config, table_name):
-    return create_db_connection(db_config, table_name, table_structure=f"""
-                                                                            CREATE TABLE IF NOT EXISTS {table_name} (
+def create_futures_db_connection(db_config, table_name, pool: ConnectionPool = None):
+    columns = """
                                                                                 token VARCHAR(32),
                                                                                 funding_annual_percent FLOAT, 
                                                                                 nextFundingTime BIGINT,
@@ -54,81 +201,394 @@ def create_futures_db_connection(db_config, table_name):
                                                                                 time_bid_ask_refresh BIGINT,
                                                                                 time_insert BIGINT,
                                                                                 openInterest float,
-                                                                                time_openInterest_refresh bigint
-                                                                                )""")
+                                                                                time_openInterest_refresh bigint"""
+    pool = create_db_connection(db_config, table_name, pool=pool, table_structure=[
+        f"""
+                                                                            CREATE TABLE IF NOT EXISTS {table_name} ({columns},
+                                                                                {ID_COLUMN},
+                                                                                INDEX idx_time_insert_token (time_insert, token)
+                                                                                )""",
+        # the last snapshot of every token, upserted together with the history rows
+        f"""
+                                                                            CREATE TABLE IF NOT EXISTS {latest_table_name(table_name)} ({columns},
+                                                                                PRIMARY KEY (token)
+                                                                                )""",
+    ])
+    # tables created before the index was added to the structure
+    pool.run(ensure_index, table_name, 'idx_time_insert_token', ('time_insert', 'token'))
+    if STORE_EXCHANGE_TIME:
+        for table in (table_name, latest_table_name(table_name)):
+            pool.run(ensure_column, table, 'time_exchange', 'BIGINT')
+    pool.run(seed_latest_table, table_name)
+    return pool
+
+
+def latest_table_name(table_name):
+    return f'{table_name}_latest'
+
+
+def ensure_index(connection, table_name, index_name, columns):
+    with closing(connection.cursor()) as cursor:
+        cursor.execute("""
+            SELECT 1 FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+            LIMIT 1
+        """, (table_name, index_name))
+        if not cursor.fetchone():
+            logging.info(f'{table_name}: create index {index_name} ({", ".join(columns)})')
+            cursor.execute(f"CREATE INDEX {index_name} ON {table_name} ({', '.join(columns)})")
+        connection.commit()
+
+
+def ensure_column(connection, table_name, column, definition):
+    with closing(connection.cursor()) as cursor:
+        cursor.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+            LIMIT 1
+        """, (table_name, column))
+        if not cursor.fetchone():
+            logging.info(f'{table_name}: add column {column} {definition}')
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {definition}")
+        connection.commit()
+
+
+def ensure_id_column(connection, table_name):
+    # tables created before the id column, ALTER TABLE copies the whole table
+    ensure_column(connection, table_name, 'id', 'BIGINT NOT NULL AUTO_INCREMENT, ADD INDEX idx_id (id)')
+
+
+def seed_latest_table(connection, table_name):
+    # fill the new latest table from the history once, so readers are not empty until the next snapshot
+    latest = latest_table_name(table_name)
+    columns = ', '.join(FUTURES_COLUMNS)
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(f"SELECT 1 FROM {latest} LIMIT 1")
+        if not cursor.fetchone():
+            cursor.execute(f"""
+                INSERT IGNORE INTO {latest} ({columns})
+                SELECT {columns} FROM {table_name}
+                WHERE time_insert = (SELECT max(time_insert) FROM {table_name})
+            """)
+        connection.commit()
+
+
+def get_partitions(connection, table_name) -> list[tuple[str, str]]:
+    with closing(connection.cursor()) as cursor:
+        cursor.execute("""
+            SELECT partition_name, partition_description FROM information_schema.partitions
+            WHERE table_schema = DATABASE() AND table_name = %s AND partition_name IS NOT NULL
+            ORDER BY partition_ordinal_position
+        """, (table_name, ))
+        return list(cursor.fetchall())
+
+
+def day_partitions(first_day: int, last_day: int) -> list[str]:
+    return [
+        f"PARTITION p{datetime.fromtimestamp(day / 1000, timezone.utc):%Y%m%d} VALUES LESS THAN ({day + DAY_MS})"
+        for day in range(first_day, last_day + DAY_MS, DAY_MS)
+    ]
+
+
+def partition_table(connection, table_name, retention_days=None, days_ahead=None):
+    """
+    Converts the history table to daily partitions on time_insert, a one time offline step:
+    ALTER TABLE copies the whole table and blocks the writers meanwhile.
+
+        python db.py partition Binance_fut_data Bybit_fut_data
+    """
+    if get_partitions(connection, table_name):
+        logging.info(f'{table_name}: already partitioned')
+        return
+    retention_days = retention_days or HISTORY_RETENTION_DAYS
+    days_ahead = days_ahead or PARTITION_DAYS_AHEAD
+    today = time_ns() // 1_000_000 // DAY_MS * DAY_MS
+    last_day = today + days_ahead * DAY_MS
+
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(f"SELECT min(time_insert) FROM {table_name}")
+        first_insert = cursor.fetchone()[0]
+        first_day = max(first_insert // DAY_MS * DAY_MS if first_insert else today,
+                        today - retention_days * DAY_MS)
+        logging.info(f'{table_name}: partition by day from {first_day}')
+        cursor.execute(f"""
+            ALTER TABLE {table_name} PARTITION BY RANGE (time_insert) (
+                PARTITION p_history VALUES LESS THAN ({first_day}),
+                {', '.join(day_partitions(first_day, last_day))},
+                PARTITION p_future VALUES LESS THAN MAXVALUE
+            )
+        """)
+        connection.commit()
+
+
+def maintain_partitions(connection, table_name, retention_days=None, days_ahead=None):
+    """
+    Adds the partitions for the next days and drops the expired ones, which is instant and does
+    not lock writers like a DELETE does. A table which is not partitioned yet (partition_table)
+    is left as it is.
+    """
+    retention_days = retention_days or HISTORY_RETENTION_DAYS
+    days_ahead = days_ahead or PARTITION_DAYS_AHEAD
+    today = time_ns() // 1_000_000 // DAY_MS * DAY_MS
+    last_day = today + days_ahead * DAY_MS
+    partitions = get_partitions(connection, table_name)
+    if not partitions:
+        if table_name not in _unpartitioned:
+            _unpartitioned.add(table_name)
+            logging.warning(f'{table_name}: not partitioned, no retention, run python db.py partition {table_name}')
+        return
+
+    with closing(connection.cursor()) as cursor:
+        bounds = [int(bound) for _, bound in partitions if bound != 'MAXVALUE']
+        if max(bounds) <= last_day:
+            cursor.execute(f"""
+                ALTER TABLE {table_name} REORGANIZE PARTITION p_future INTO (
+                    {', '.join(day_partitions(max(bounds), last_day))},
+                    PARTITION p_future VALUES LESS THAN MAXVALUE
+                )
+            """)
+
+        expire_time = today - retention_days * DAY_MS
+        expired = [name for name, bound in partitions if bound != 'MAXVALUE' and int(bound) <= expire_time]
+        if expired:
+            logging.info(f'{table_name}: drop partitions {", ".join(expired)}')
+            cursor.execute(f"ALTER TABLE {table_name} DROP PARTITION {', '.join(expired)}")
+        connection.commit()
+
+
+def downsample_table_name(table_name, suffix):
+    return f'{table_name}_{suffix}'
+
+
+def downsample(connection, table_name, suffix, interval_ms):
+    """Aggregate the previous and the current bucket of the history into the <table>_<suffix> table"""
+    aggregate_table = downsample_table_name(table_name, suffix)
+    end_time = time_ns() // 1_000_000
+    start_time = end_time // interval_ms * interval_ms - interval_ms
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {aggregate_table} (
+                bucket BIGINT,
+                token VARCHAR(32),
+                mid_avg DOUBLE,
+                mid_min DOUBLE,
+                mid_max DOUBLE,
+                spread_percent_avg DOUBLE,
+                funding_annual_percent_avg DOUBLE,
+                openInterest_avg DOUBLE,
+                samples INT,
+                PRIMARY KEY (bucket, token)
+            )""")
+        # -1 placeholders of tokens without data are left out of the averages
+        cursor.execute(f"""
+            INSERT INTO {aggregate_table}
+                (bucket, token, mid_avg, mid_min, mid_max, spread_percent_avg, funding_annual_percent_avg,
+                 openInterest_avg, samples)
+            SELECT time_insert DIV {interval_ms} * {interval_ms} AS bucket, token,
+                avg((bidPrice + askPrice) / 2), min((bidPrice + askPrice) / 2), max((bidPrice + askPrice) / 2),
+                avg((askPrice - bidPrice) / ((bidPrice + askPrice) / 2) * 100),
+                avg(CASE WHEN time_funding_refresh > 0 THEN funding_annual_percent END),
+                avg(CASE WHEN time_openInterest_refresh > 0 THEN openInterest END),
+                count(*)
+            FROM {table_name}
+            WHERE time_insert >= %s AND time_insert < %s AND bidPrice > 0 AND askPrice > 0
+            GROUP BY bucket, token
+            ON DUPLICATE KEY UPDATE
+                mid_avg=VALUES(mid_avg), mid_min=VALUES(mid_min), mid_max=VALUES(mid_max),
+                spread_percent_avg=VALUES(spread_percent_avg),
+                funding_annual_percent_avg=VALUES(funding_annual_percent_avg),
+                openInterest_avg=VALUES(openInterest_avg), samples=VALUES(samples)
+        """, (start_time, end_time))
+        connection.commit()
+
 
+def maintain_storage(pool: ConnectionPool, table_name):
+    try:
+        pool.run(maintain_partitions, table_name)
+        for suffix, interval_ms in DOWNSAMPLE_INTERVALS.items():
+            pool.run(downsample, table_name, suffix, interval_ms)
+    except pymysql.err.MySQLError:
+        logging.exception(f'{table_name}: storage maintenance failed')
 
-def create_db_connection(db_config, table_name, table_structure):
+
+SPOT_COLUMNS = ('token', 'bidPrice', 'askPrice', 'volume_24h', 'time')
+FUTURES_COLUMNS = ('token', 'funding_annual_percent', 'nextFundingTime', 'funding_period', 'bidPrice', 'askPrice',
+                   'volume_24h', 'time_funding_refresh', 'time_bid_ask_refresh', 'time_insert', 'openInterest',
+                   'time_openInterest_refresh')
+if STORE_EXCHANGE_TIME:
+    FUTURES_COLUMNS += ('time_exchange', )
+
+
+def create_db_connection(db_config, table_name, table_structure, pool: ConnectionPool = None) -> ConnectionPool:
     logging.info(str(table_structure))
     # return
 
-    connection = pymysql.connect(
-        host=db_config['host'],
-        port=db_config['port'],
-        user=db_config['user'],
-        password=db_config['password'],
-        db=db_config['db']
-    )
+    # several tables of one process can share a pool
+    pool = pool or ConnectionPool(db_config)
 
-    with closing(connection.cursor()) as cursor:
-        cursor.execute(table_structure)
+    with pool.connection() as connection, closing(connection.cursor()) as cursor:
+        for statement in [table_structure] if isinstance(table_structure, str) else table_structure:
+            cursor.execute(statement)
         connection.commit()
 
     ColoredOutput.green(
         f"DB connection {db_config['user']}:{db_config['host']}/{db_config['db']} table: {table_name} has been established!")
 
-    return connection
+    return pool
+
+
+def create_spool(table_name) -> Spool:
+    return Spool(os.path.join(SPOOL_DIR, table_name), max_bytes=SPOOL_MAX_BYTES)
 
 
-def insert_or_update_spot_thread(connection, table_name, data):
-    # Create an instance of BackgroundScheduler
-    scheduler = BackgroundScheduler()
+class SnapshotWriter:
+    """
+    Runs the snapshot writes of one table, on schedule and, optionally, early on market moves.
+
+    `check` compares every token with the values of the last snapshot and flushes when a mid
+    moved more than mid_percent % or the funding more than funding_change. Writes are serialized,
+    a check while a write is running or sooner than min_interval after it is skipped.
+    The comparison values are taken at construction, a token without prices yet gets its first
+    ones as the base, so the triggers work before the first scheduled snapshot.
+    """
 
-    # Add jobs to the scheduler to be executed every minute at specific seconds
-    # Each job passes a different argument to the function
-    scheduler.add_job(insert_or_update_spot, 'cron', minute='*/5', second=5, max_instances=1, coalesce=True,
-                      args=[connection, table_name, data])
+    def __init__(self, write: Callable, data: SnapshotStore, mid_percent: float = None,
+                 funding_change: float = None, min_interval: float = SNAPSHOT_TRIGGER_MIN_INTERVAL):
+        self.write = write
+        self.data = data
+        self.mid_percent = mid_percent
+        self.funding_change = funding_change if 'funding_annual_percent' in data.columns else None
+        self.min_interval = min_interval
+        self.last_flush = 0.
+        self._lock = Lock()
+        # nan until the token has a value to compare with, any float is a valid funding
+        self._mid = array('d', [nan]) * len(data)
+        self._funding = array('d', [nan]) * len(data)
+        self._remember()
+
+    @property
+    def triggered(self):
+        return self.mid_percent is not None or self.funding_change is not None
+
+    def flush(self, blocking: bool = True) -> bool:
+        if not self._lock.acquire(blocking):
+            return False
+        try:
+            self.last_flush = monotonic()
+            self._remember()
+            self.write()
+        finally:
+            self._lock.release()
+        return True
+
+    def _columns(self):
+        # copies under the store lock, a handler may be between the bid and the ask write
+        data = self.data
+        with data.lock:
+            bid, ask = array('d', data.bidPrice), array('d', data.askPrice)
+            if self.funding_change is None:
+                return bid, ask, None, None
+            return bid, ask, array('d', data.funding_annual_percent), array('q', data.time_funding_refresh)
+
+    def _remember(self):
+        bid, ask, funding, refreshed = self._columns()
+        for slot in range(len(bid)):
+            self._mid[slot] = (bid[slot] + ask[slot]) / 2 if bid[slot] > 0 and ask[slot] > 0 else nan
+        if funding is not None:
+            for slot in range(len(funding)):
+                self._funding[slot] = funding[slot] if refreshed[slot] > 0 else nan
+
+    def moved(self) -> bool:
+        bid, ask, funding, refreshed = self._columns()
+        moved = False
+        for slot in range(len(bid)):
+            if self.mid_percent is not None and bid[slot] > 0 and ask[slot] > 0:
+                mid = (bid[slot] + ask[slot]) / 2
+                last_mid = self._mid[slot]
+                if isnan(last_mid):
+                    # the first prices of the token since the start, the base of the next checks
+                    self._mid[slot] = mid
+                elif abs(mid / last_mid - 1) * 100 > self.mid_percent:
+                    moved = True
+            if funding is not None and refreshed[slot] > 0:
+                if isnan(self._funding[slot]):
+                    self._funding[slot] = funding[slot]
+                elif abs(funding[slot] - self._funding[slot]) > self.funding_change:
+                    moved = True
+        return moved
+
+    def check(self):
+        if monotonic() - self.last_flush < self.min_interval:
+            return
+        if self.moved():
+            self.flush(blocking=False)
+
+
+def snapshot_trigger(table_name, interval: int = None) -> dict:
+    interval = max(1, int(interval or SNAPSHOT_INTERVALS.get(table_name, SNAPSHOT_INTERVAL)))
+    if interval % 60 == 0 and 60 % (interval // 60) == 0:
+        # whole minutes stay aligned to the clock, 5 seconds after the minute
+        return dict(trigger='cron', minute=f'*/{interval // 60}', second=5)
+    return dict(trigger='interval', seconds=interval)
+
+
+def start_snapshot_writer(scheduler: BackgroundScheduler, writer: SnapshotWriter, table_name, interval: int = None):
+    scheduler.add_job(writer.flush, **snapshot_trigger(table_name, interval), max_instances=1, coalesce=True)
+    if writer.triggered:
+        scheduler.add_job(writer.check, 'interval', seconds=writer.min_interval, max_instances=1, coalesce=True)
+
+
+def create_snapshot_writer(write: Callable, data: SnapshotStore) -> SnapshotWriter:
+    return SnapshotWriter(write, data, mid_percent=SNAPSHOT_TRIGGER_MID_PERCENT,
+                          funding_change=SNAPSHOT_TRIGGER_FUNDING)
+
+
+def insert_or_update_spot_thread(pool, table_name, data, interval: int = None, scheduler: BackgroundScheduler = None):
+    # Create an instance of BackgroundScheduler, unless the process shares one
+    shared_scheduler = scheduler is not None
+    scheduler = scheduler or BackgroundScheduler()
+    snapshot_stores[table_name] = data
+
+    # Snapshot every interval seconds (SNAPSHOT_INTERVALS) and early on market moves if configured
+    writer = create_snapshot_writer(partial(insert_or_update_spot, pool, table_name, data, create_spool(table_name)),
+                                    data)
+    start_snapshot_writer(scheduler, writer, table_name, interval)
 
     # Start the scheduler
-    scheduler.start()
+    if not shared_scheduler:
+        scheduler.start()
 
 
-def insert_or_update_spot(connection, table_name, data):
+def insert_or_update_spot(pool: ConnectionPool, table_name, data, spool: Spool = None):
     # for row in data.values():
     #     logging.info(str(row))
     # # return
-    values_list = [
-        (
-            values['token'],
-            values['bidPrice'],
-            values['askPrice'],
-            values['volume24h'],
-            values['time']
-        )
-        for _, values in data.items()
-    ]
+    values_list = data.rows(('token', 'bidPrice', 'askPrice', 'volume24h', 'time'))
 
-    query = f"""
-        INSERT INTO {table_name} (token, bidPrice, askPrice, volume_24h, time) 
-        VALUES (%s, %s, %s, %s, %s)
-        """
+    write_snapshot(pool, table_name, SPOT_COLUMNS, values_list, spool=spool)
 
-    with closing(connection.cursor()) as cursor:
-        cursor.executemany(query, values_list)
-        connection.commit()
 
+def insert_or_update_futures_thread(pool, table_name, data, delta: bool = None, interval: int = None,
+                                    scheduler: BackgroundScheduler = None):
+    # Create an instance of BackgroundScheduler, unless the process shares one
+    shared_scheduler = scheduler is not None
+    scheduler = scheduler or BackgroundScheduler()
+    snapshot_stores[table_name] = data
 
-def insert_or_update_futures_thread(connection, table_name, data):
-    # Create an instance of BackgroundScheduler
-    scheduler = BackgroundScheduler()
+    # Snapshot every interval seconds (SNAPSHOT_INTERVALS) and early on market moves if configured
+    writer = create_snapshot_writer(partial(insert_or_update_futures, pool, table_name, data, create_spool(table_name),
+                                            SNAPSHOT_DELTA_MODE if delta is None else delta),
+                                    data)
+    start_snapshot_writer(scheduler, writer, table_name, interval)
 
-    # Add jobs to the scheduler to be executed every minute at specific seconds
-    # Each job passes a different argument to the function
-    scheduler.add_job(insert_or_update_futures, 'cron', minute='*/5', second=5, max_instances=1, coalesce=True,
-                      args=[connection, table_name, data])
+    if STORAGE_MAINTENANCE:
+        # run once at start, then hourly between snapshots
+        scheduler.add_job(maintain_storage, 'cron', minute=32, max_instances=1, coalesce=True,
+                          next_run_time=datetime.now(), args=[pool, table_name])
 
     # Start the scheduler
-    scheduler.start()
+    if not shared_scheduler:
+        scheduler.start()
 
 
 @dataclass
@@ -147,14 +607,29 @@ class FutureData:
     time_openInterest_refresh: int
 
 
-def read_last_table_data(connection: Connection, exchange: Exchange) -> dict[str, FutureData]:
+def read_last_table_data(pool: ConnectionPool, exchange: Exchange) -> dict[str, FutureData]:
+    return pool.run(_read_last_table_data, exchange)
+
+
+def _read_last_table_data(connection: Connection, exchange: Exchange) -> dict[str, FutureData]:
     fields = ', '.join(FutureData.__dataclass_fields__)
+    # the latest table keeps the tokens removed from exchanges/ with their last prices, skip them
+    tokens = exchange.tokens
+    token_filter = f"token in ({', '.join(['%s'] * len(tokens))})" if tokens else 'false'
     sql = f"""
-        select {fields} from `{exchange.table_name}`
-        where time_insert=(SELECT max(time_insert) FROM `{exchange.table_name}`)  
+        select {fields} from `{latest_table_name(exchange.table_name)}`
+        where {token_filter}
     """
     with closing(connection.cursor(DictCursor)) as cursor:
-        cursor.execute(sql)
+        try:
+            cursor.execute(sql, tokens)
+        except pymysql.err.ProgrammingError:
+            # no latest table yet, the collector of this exchange has not been updated
+            connection.rollback()
+            cursor.execute(f"""
+                select {fields} from `{exchange.table_name}`
+                where time_insert=(SELECT max(time_insert) FROM `{exchange.table_name}`)  
+            """)
         rows = {
             exchange.token2coin(row['token']): FutureData(**row) for row in cursor.fetchall()
         }
@@ -162,7 +637,42 @@ def read_last_table_data(connection: Connection, exchange: Exchange) -> dict[str
     return rows
 
 
-def read_last_tax_table_data(connection: Connection, exchange: Exchange) -> dict[str, TaxData]:
+def read_table_state_at(pool: ConnectionPool, exchange: Exchange, time_ms: int,
+                        lookback_ms: int = None) -> dict[str, FutureData]:
+    """
+    State of every token as of time_ms: the last row of each token inserted at or before it.
+    Works for the full snapshots and for the delta mode, where unchanged tokens are not written.
+    lookback_ms limits how far back a token without changes is searched.
+    """
+    return pool.run(_read_table_state_at, exchange, time_ms, lookback_ms)
+
+
+def _read_table_state_at(connection: Connection, exchange: Exchange, time_ms: int,
+                         lookback_ms: int = None) -> dict[str, FutureData]:
+    fields = ', '.join(f'history.{field}' for field in FutureData.__dataclass_fields__)
+    start_time = time_ms - lookback_ms if lookback_ms else 0
+    sql = f"""
+        select {fields} from `{exchange.table_name}` history
+        join (
+            select token, max(time_insert) as time_insert from `{exchange.table_name}`
+            where time_insert <= %s and time_insert >= %s
+            group by token
+        ) last on history.token = last.token and history.time_insert = last.time_insert
+    """
+    with closing(connection.cursor(DictCursor)) as cursor:
+        cursor.execute(sql, (time_ms, start_time))
+        rows = {
+            exchange.token2coin(row['token']): FutureData(**row) for row in cursor.fetchall()
+        }
+        connection.commit()
+    return rows
+
+
+def read_last_tax_table_data(pool: ConnectionPool, exchange: Exchange) -> dict[str, TaxData]:
+    return pool.run(_read_last_tax_table_data, exchange)
+
+
+def _read_last_tax_table_data(connection: Connection, exchange: Exchange) -> dict[str, TaxData]:
     fields = ', '.join(TaxData.__dataclass_fields__)
     sql = f"""
         select {fields} from `{exchange.tax_table_name}`
@@ -177,35 +687,175 @@ def read_last_tax_table_data(connection: Connection, exchange: Exchange) -> dict
     return rows
 
 
-def insert_or_update_futures(connection, table_name, data):
+def insert_or_update_futures(pool: ConnectionPool, table_name, data, spool: Spool = None, delta: bool = False):
     # for row in data.values():
     #     logging.info(str(row))
     # # return
     time_insert = time_ns() // 1_000_000
 
-    values_list = [
-        (
-            values['token'],
-            values['funding_annual_percent'],
-            values['nextFundingTime'],
-            values['funding_period'],
-            values['bidPrice'],
-            values['askPrice'],
-            values['volume24h'],
-            values['time_funding_refresh'],
-            values['time_bid_ask_refresh'],
-            time_insert,
-            values['openInterest'],
-            values['time_openInterest_refresh']
-        )
-        for _, values in data.items()
+    # in delta mode only the tokens changed since the previous snapshot are written,
+    # read_table_state_at rebuilds the full state
+    snapshot = data.snapshot(changed_only=delta)
+    if not snapshot['token']:
+        return
+    columns = [
+        snapshot['token'],
+        snapshot['funding_annual_percent'],
+        snapshot['nextFundingTime'],
+        snapshot['funding_period'],
+        snapshot['bidPrice'],
+        snapshot['askPrice'],
+        snapshot['volume24h'],
+        snapshot['time_funding_refresh'],
+        snapshot['time_bid_ask_refresh'],
+        repeat(time_insert),
+        snapshot['openInterest'],
+        snapshot['time_openInterest_refresh'],
     ]
+    if STORE_EXCHANGE_TIME:
+        columns.append(snapshot['time_exchange'])
+    values_list = list(zip(*columns))
+
+    write_snapshot(pool, table_name, FUTURES_COLUMNS, values_list, latest_table_name(table_name), spool)
+
+
+def write_snapshot(pool: ConnectionPool, table_name, columns, rows, latest_table: str = None, spool: Spool = None):
+    totals = write_stats.setdefault(table_name, {'writes': 0, 'rows': 0, 'seconds': 0., 'last_seconds': 0.,
+                                                 'errors': 0})
+    start = perf_counter()
+    try:
+        stats = pool.run(write_rows, table_name, columns, rows, latest_table)
+    except pymysql.err.MySQLError:
+        totals['errors'] += 1
+        if spool is None:
+            raise
+        logging.exception(f'{table_name}: write failed, {len(rows)} rows spooled to {spool.path}')
+        spool.append(rows)
+        return
+    logging.info(f'{table_name}: {stats}')
+    totals['last_seconds'] = perf_counter() - start
+    totals['seconds'] += totals['last_seconds']
+    totals['writes'] += 1
+    totals['rows'] += len(rows)
+
+    if spool:
+        # the database is back, send the rows of the outage as a few large batches
+        # (history only, the latest table already has the newer snapshot)
+        def write_spooled(spooled_rows):
+            logging.info(f'{table_name}: replay {pool.run(write_rows, table_name, columns, spooled_rows)}')
+
+        try:
+            spool.replay(write_spooled)
+        except pymysql.err.MySQLError:
+            logging.exception(f'{table_name}: spool replay failed')
+
+
+@dataclass
+class BulkWriteStats:
+    strategy: str
+    rows: int = 0
+    bytes: int = 0
+    seconds: float = 0.
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds else 0.
+
+    def __str__(self):
+        return f'{self.strategy} {self.rows} rows {self.bytes} bytes in {self.seconds:.3f}s ({self.rows_per_sec:.0f} rows/s)'
 
-    query = f"""
-        INSERT INTO {table_name} (token, funding_annual_percent, nextFundingTime, funding_period, bidPrice, askPrice, volume_24h, time_funding_refresh, time_bid_ask_refresh, time_insert, openInterest, time_openInterest_refresh) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
 
+def bulk_insert(connection, table_name, columns, rows) -> BulkWriteStats:
+    """
+    Insert rows choosing the cheapest strategy for the batch size, the caller commits the INSERTs.
+
+    Small batches go as chunked multi-row INSERTs, large ones as LOAD DATA LOCAL INFILE on a connection
+    of its own, the only one with local_infile enabled. If the server refuses LOAD DATA (local_infile disabled) the batch falls back to INSERTs.
+    """
+    if len(rows) >= LOAD_DATA_MIN_ROWS:
+        try:
+            return load_data_insert(connection, table_name, columns, rows)
+        except (pymysql.err.OperationalError, pymysql.err.InternalError) as err:
+            logging.warning(f'{table_name}: LOAD DATA failed, fallback to INSERT: {err}')
+    return multi_row_insert(connection, table_name, columns, rows)
+
+
+def multi_row_insert(connection, table_name, columns, rows, upsert: bool = False) -> BulkWriteStats:
+    stats = BulkWriteStats('upsert' if upsert else 'insert')
+    start = perf_counter()
+    prefix = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES "
+    suffix = ' ON DUPLICATE KEY UPDATE ' + ', '.join(f'{c}=VALUES({c})' for c in columns) if upsert else ''
+    iterator = iter(rows)
     with closing(connection.cursor()) as cursor:
-        cursor.executemany(query, values_list)
-        connection.commit()
+        while chunk := list(islice(iterator, INSERT_CHUNK_ROWS)):
+            query = prefix + ','.join(map(connection.escape, chunk)) + suffix
+            cursor.execute(query)
+            stats.rows += len(chunk)
+            stats.bytes += len(query)
+    stats.seconds = perf_counter() - start
+    return stats
+
+
+def rows_to_tsv(rows) -> bytes:
+    return ''.join(
+        '\t'.join('\\N' if value is None else str(value) for value in row) + '\n'
+        for row in rows
+    ).encode()
+
+
+def local_infile_connection(connection: Connection) -> Connection:
+    # LOAD DATA LOCAL lets the server read client files, so only this short lived connection allows it
+    return pymysql.connect(host=connection.host, port=connection.port, user=connection.user,
+                           password=connection.password, database=connection.db, local_infile=True)
+
+
+def load_data_insert(connection, table_name, columns, rows) -> BulkWriteStats:
+    """Commits on its own connection, not in the transaction of `connection`"""
+    stats = BulkWriteStats('load_data')
+    start = perf_counter()
+    buffer = rows_to_tsv(rows)
+    with NamedTemporaryFile(dir=LOAD_DATA_TMP_DIR, suffix='.tsv') as file:
+        file.write(buffer)
+        file.flush()
+        query = f"""
+            LOAD DATA LOCAL INFILE %s INTO TABLE {table_name}
+            FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n'
+            ({', '.join(columns)})
+        """
+        with closing(local_infile_connection(connection)) as infile_connection:
+            with closing(infile_connection.cursor()) as cursor:
+                cursor.execute(query, (file.name, ))
+            infile_connection.commit()
+    stats.rows = len(rows)
+    stats.bytes = len(buffer)
+    stats.seconds = perf_counter() - start
+    return stats
+
+
+def write_rows(connection, table_name, columns, rows, latest_table: str = None) -> BulkWriteStats:
+    if latest_table:
+        # same transaction, readers of the latest table never see a snapshot missing from the history
+        # (so no LOAD DATA, it runs on a connection of its own)
+        stats = multi_row_insert(connection, table_name, columns, rows)
+        multi_row_insert(connection, latest_table, columns, rows, upsert=True)
+    else:
+        stats = bulk_insert(connection, table_name, columns, rows)
+    connection.commit()
+    return stats
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='offline maintenance of the history tables')
+    commands = parser.add_subparsers(dest='command', required=True)
+    partition = commands.add_parser('partition', help='convert history tables to daily partitions (copies them)')
+    partition.add_argument('tables', nargs='+')
+    args = parser.parse_args()
+
+    from sql_config import DB_CONFIG
+
+    pool = ConnectionPool(DB_CONFIG)
+    for table in args.tables:
+        pool.run(partition_table, table)
+    pool.close()
@@ -1,8 +1,12 @@
 import logging
+from itertools import count
 import orjson
 from sql_config import DB_CONFIG
 from db import create_futures_db_connection, insert_or_update_futures_thread
 from wsocket import process_websocket
+from metrics import start_metrics_server
+from subscriptions import SubscriptionManager
+from latency import latency_recorder
 from time import time_ns
 from exchanges.deribit import DeribitFuturesExchange
 
@@ -12,17 +16,25 @@ TOKENS_LIST = exchange.tokens
 
 # Dictionary to store updates
 update_dict = exchange.create_update_dict()
+latency = latency_recorder(exchange.table_name)
 
-message_id = 0
+message_ids = count(1)
+
+# the subscribe requests share the json-rpc ids with the other requests
+subscriptions = SubscriptionManager('Deribit', max_args=100,
+                                    build_frame=lambda args, request_id: {"jsonrpc": "2.0",
+                                                                          "method": "public/subscribe",
+                                                                          "id": request_id,
+                                                                          "params": {"channels": args}},
+                                    symbol_of=lambda arg: arg.split('.')[1],
+                                    ids=message_ids)
 
 
 def send_message(ws, method, params: dict = None):
-    global message_id
-    message_id += 1
     message = {
         "jsonrpc": "2.0",
         "method": method,
-        "id": message_id,
+        "id": next(message_ids),
     }
     if params:
         message["params"] = params
@@ -32,9 +44,11 @@ def send_message(ws, method, params: dict = None):
 def on_message(ws, message):
     data = orjson.loads(message)
     if 'error' in data:
+        subscriptions.ack(data.get('id'), ok=False, error=data['error'])
         logging.error(data)
         # {'jsonrpc': '2.0', 'id': 43, 'error': {'message': 'Method not found', 'code': -32601}, 'usIn': 1702019843229880, 'usOut': 1702019843230762, 'usDiff': 882}
     elif 'id' in data:
+        subscriptions.ack(data['id'])
         # it' s a subscribe message {'jsonrpc': '2.0', 'id': 42, 'result': ['ticker.BTC-PERPETUAL.raw'], 'usIn': 1701459165123251, 'usOut': 1701459165123420, 'usDiff': 169}
         logging.info(data)
     elif data.get('method') == 'heartbeat':
@@ -55,19 +69,22 @@ def handle_tickers_update(data):
 
     current_time = time_ns() // 1_000_000  # time in milliseconds
     # print(item['open_interest'])
-
-    # Preparing the updates in a single dictionary
-    update_dict[item['instrument_name']].update({
-        "funding_annual_percent": item['current_funding'] / 8 * 876000,  # Funding period is always 8
-        'funding_period': 8,
-        "bidPrice": item['best_bid_price'],
-        'askPrice': item['best_ask_price'],
-        'volume24h': item['stats']['volume_usd'],
-        'time_funding_refresh': current_time,
-        "time_bid_ask_refresh": current_time,
-        'openInterest': float(item['open_interest']),
-        'time_openInterest_refresh': current_time
-    })
+    # usOut is only sent in the request responses, the notifications carry the ticker timestamp
+    latency.record(item['timestamp'], current_time)
+
+    slot = update_dict.index[item['instrument_name']]
+    with update_dict.lock:
+        update_dict.funding_annual_percent[slot] = item['current_funding'] / 8 * 876000  # Funding period is always 8
+        update_dict.funding_period[slot] = 8
+        update_dict.bidPrice[slot] = item['best_bid_price']
+        update_dict.askPrice[slot] = item['best_ask_price']
+        update_dict.volume24h[slot] = item['stats']['volume_usd']
+        update_dict.time_funding_refresh[slot] = current_time
+        update_dict.time_bid_ask_refresh[slot] = current_time
+        update_dict.openInterest[slot] = float(item['open_interest'])
+        update_dict.time_openInterest_refresh[slot] = current_time
+        update_dict.time_exchange[slot] = item['timestamp']
+        update_dict.dirty[slot] = 1
 
 
 def on_open(ws):
@@ -75,18 +92,18 @@ def on_open(ws):
     send_message(ws, "public/set_heartbeat", {"interval": 60})
 
     # Subscribe to tickers topic
-    for token in TOKENS_LIST:
-        send_message(ws, "public/subscribe", {"channels": [f"ticker.{token}.raw"]})
+    subscriptions.subscribe(ws, [f"ticker.{token}.raw" for token in TOKENS_LIST])
 
 
 if __name__ == '__main__':
+    start_metrics_server()
     CONNECTION = create_futures_db_connection(db_config=DB_CONFIG,
                                               table_name=exchange.table_name)
 
     insert_or_update_futures_thread(CONNECTION, exchange.table_name, update_dict)
 
     process_websocket(
-        url="wss://streams.deribit.com/ws/api/v2",
+        url=exchange.ws_url,
         on_open=on_open,
         on_message=on_message
     )
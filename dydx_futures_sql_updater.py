@@ -1,4 +1,5 @@
 from datetime import datetime, timezone
+from functools import partial
 from time import time_ns
 from threading import Thread, Event, RLock
 
@@ -8,6 +9,7 @@ from sortedcontainers import SortedList
 from db import create_futures_db_connection, insert_or_update_futures_thread
 from tg import send_telegram_error, start_telegram_worker
 from wsocket import process_websocket
+from metrics import start_metrics_server
 
 from exchanges.dydx import DydxFuturesExchange
 from sql_config import DB_CONFIG
@@ -59,10 +61,15 @@ class OrderBook:
 
     def update_best_bid_ask(self, token_id, update_dict):
         book = self.order_books[token_id]
-        best_bid = next((bid[0] for bid in reversed(book['bids']) if bid[2] > 0), None)
-        best_ask = next((ask[0] for ask in book['asks'] if ask[2] > 0), None)
-        update_dict[token_id].update(
-            {'bidPrice': best_bid, 'askPrice': best_ask, 'time_bid_ask_refresh': time_ns() // 1_000_000})
+        # -1 is the placeholder for an empty side, as for a token without data
+        best_bid = next((bid[0] for bid in reversed(book['bids']) if bid[2] > 0), -1)
+        best_ask = next((ask[0] for ask in book['asks'] if ask[2] > 0), -1)
+        slot = update_dict.index[token_id]
+        with update_dict.lock:
+            update_dict.bidPrice[slot] = best_bid
+            update_dict.askPrice[slot] = best_ask
+            update_dict.time_bid_ask_refresh[slot] = time_ns() // 1_000_000
+            update_dict.dirty[slot] = 1
 
     def clear_zero_size_low_offset_orders(self):
         for token_id, book in self.order_books.items():
@@ -133,46 +140,39 @@ def handle_market_data(contents, update_dict):
         for market, values in contents['markets'].items():
             # print('\t',contents)
             if values['status'] == 'ONLINE' and values['type'] == 'PERPETUAL':
-                update_dict[market].update({"token": market})
-
-                if "nextFundingRate" in values:
-                    update_dict[market].update(
-                        {"funding_annual_percent": float(values["nextFundingRate"]) * 876000, "funding_period": 1,
-                         "time_funding_refresh": time_ns() // 1_000_000})  # * 24 * 365 * 100
-
-                if "nextFundingAt" in values:
-                    update_dict[market].update({"nextFundingTime": int(
-                        datetime.fromisoformat(values["nextFundingAt"].replace("Z", "+00:00")).replace(
-                            tzinfo=timezone.utc).timestamp() * 1000)})
-
-                if "volume24H" in values:
-                    update_dict[market].update({"volume24h": float(values["volume24H"])})
-                if "openInterest" in values:
-                    update_dict[market].update({"openInterest": float(values["openInterest"]),
-                                                "time_openInterest_refresh": time_ns() // 1_000_000})
-
+                slot = update_dict.index.get(market)
+                if slot is not None:
+                    update_market_values(update_dict, slot, values)
             else:
                 # send_telegram_error(f"{market} not ONLINE or not PERPETUAL")
                 return
     else:
         for market, values in contents.items():
-            if market in update_dict:
-                if "nextFundingRate" in values:
-                    update_dict[market].update(
-                        {"funding_annual_percent": float(values["nextFundingRate"]) * 876000, "funding_period": 1,
-                         "time_funding_refresh": time_ns() // 1_000_000})  # * 24 * 365 * 100
+            slot = update_dict.index.get(market)
+            if slot is not None:
+                update_market_values(update_dict, slot, values)
+
 
-                if "nextFundingAt" in values:
-                    update_dict[market].update({"nextFundingTime": int(
-                        datetime.fromisoformat(values["nextFundingAt"].replace("Z", "+00:00")).replace(
-                            tzinfo=timezone.utc).timestamp() * 1000)})
+def update_market_values(update_dict, slot, values):
+    with update_dict.lock:
+        if "nextFundingRate" in values:
+            update_dict.funding_annual_percent[slot] = float(values["nextFundingRate"]) * 876000  # * 24 * 365 * 100
+            update_dict.funding_period[slot] = 1
+            update_dict.time_funding_refresh[slot] = time_ns() // 1_000_000
 
-                if "volume24H" in values:
-                    update_dict[market].update({"volume24h": float(values["volume24H"])})
+        if "nextFundingAt" in values:
+            update_dict.nextFundingTime[slot] = int(
+                datetime.fromisoformat(values["nextFundingAt"].replace("Z", "+00:00")).replace(
+                    tzinfo=timezone.utc).timestamp() * 1000)
 
-                if "openInterest" in values:
-                    update_dict[market].update({"openInterest": float(values["openInterest"]),
-                                                "time_openInterest_refresh": time_ns() // 1_000_000})
+        if "volume24H" in values:
+            update_dict.volume24h[slot] = float(values["volume24H"])
+
+        if "openInterest" in values:
+            update_dict.openInterest[slot] = float(values["openInterest"])
+            update_dict.time_openInterest_refresh[slot] = time_ns() // 1_000_000
+
+        update_dict.dirty[slot] = 1
 
 
 def clear_orders_periodically(order_book: OrderBook, stop_event: Event):
@@ -191,17 +191,24 @@ def on_open(ws):
             orjson.dumps({"type": "subscribe", "channel": "v3_orderbook", "id": f"{token}", "includeOffsets": True}))
 
 
+def rest_pollers(client, stop_event):
+    # no REST here, only the order book cleanup loop
+    return [partial(clear_orders_periodically, order_book, stop_event)]
+
+
 if __name__ == '__main__':
+    start_metrics_server()
     start_telegram_worker(stop_event)
     CONNECTION = create_futures_db_connection(db_config=DB_CONFIG, table_name=exchange.table_name)
-    thread1 = Thread(target=clear_orders_periodically, args=(order_book, stop_event))
-    thread1.start()
-    active_threads.append(thread1)
+    for poller in rest_pollers(None, stop_event):
+        thread = Thread(target=poller)
+        thread.start()
+        active_threads.append(thread)
 
     insert_or_update_futures_thread(CONNECTION, exchange.table_name, update_dict)
 
     process_websocket(
-        url="wss://api.dydx.exchange/v3/ws",
+        url=exchange.ws_url,
         on_open=on_open,
         on_message=on_message,
         stop_event=stop_event,
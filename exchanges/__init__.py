@@ -1,7 +1,26 @@
 from abc import ABC
-from typing import List
+from typing import Dict, List
+from urllib.parse import urlsplit
 import re
 
+from snapshot_store import SnapshotStore
+
+MOCK_EXCHANGE_URL = None    # e.g. 'http://127.0.0.1:8765', sends every exchange url to mock_exchange.py
+
+try:
+    from local_settings import *
+except ImportError:
+    pass
+
+
+def exchange_url(url: str) -> str:
+    """url, or its place on MOCK_EXCHANGE_URL: wss://fstream.binance.com/ws -> ws://127.0.0.1:8765/fstream.binance.com/ws"""
+    if not MOCK_EXCHANGE_URL or not url:
+        return url
+    parts = urlsplit(url)
+    scheme = 'ws' if parts.scheme in ('ws', 'wss') else 'http'
+    return f'{scheme}://{urlsplit(MOCK_EXCHANGE_URL).netloc}/{parts.hostname}{parts.path}'
+
 
 class Exchange(ABC):
 
@@ -11,6 +30,27 @@ class Exchange(ABC):
     _coin_rec = None
     table_name: str = None
     tax_table_name: str = None
+    ws_url: str = None
+    rest_url: str = None
+    urls = ('ws_url', 'rest_url')   # attributes which go to the mock exchange
+    # live state columns with their array typecodes, see SnapshotStore
+    fields: Dict[str, str] = {
+        'funding_annual_percent': 'd',
+        'nextFundingTime': 'q',
+        'funding_period': 'q',
+        'bidPrice': 'd',
+        'askPrice': 'd',
+        'volume24h': 'd',
+        'time_funding_refresh': 'q',
+        'time_bid_ask_refresh': 'q',
+        'openInterest': 'd',
+        'time_openInterest_refresh': 'q',
+        'time_exchange': 'q',   # exchange event time of the last update, see latency.py
+    }
+
+    def __init__(self):
+        for name in self.urls:
+            setattr(self, name, exchange_url(getattr(self, name)))
 
     @property
     def coins(self):
@@ -34,20 +74,5 @@ class Exchange(ABC):
         assert res
         return res.group(1)
 
-    def create_update_dict(self):
-        return {
-            token: {
-                'token': token,
-                'funding_annual_percent': -1,
-                'nextFundingTime': -1,
-                'funding_period': -1,
-                'bidPrice': -1,
-                'askPrice': -1,
-                'volume24h': -1,
-                'time_funding_refresh': -1,
-                'time_bid_ask_refresh': -1,
-                'openInterest': -1.,
-                'time_openInterest_refresh': -1,
-            }
-            for token in self.tokens
-        }
+    def create_update_dict(self) -> SnapshotStore:
+        return SnapshotStore(self.tokens, self.fields)
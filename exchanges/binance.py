@@ -3,6 +3,8 @@ from . import Exchange
 
 class BinanceFuturesExchange(Exchange):
     table_name = "Binance_fut_data"
+    ws_url = "wss://fstream.binance.com/ws"
+    rest_url = "https://fapi.binance.com"
     _template = '{coin}USDT'
     _coin_re = r'^(\w+)USDT$'
     _coins = ['XRP', 'LTC', 'FLM', 'SLP', 'ETC', 'MAGIC', 'NEAR', 'ADA', 'YFI', 'TIA', 'MANA', 'FIL', 'MINA', 'BTC',
@@ -18,21 +20,17 @@ class BinanceFuturesExchange(Exchange):
 
 class BinanceSpotExchange(Exchange):
     table_name = "Binance_spot_data"
+    ws_url = "wss://stream.binance.com:9443/ws"
+    rest_url = "https://api.binance.com"
     tax_table_name = "Binance_tax_margin"
     _template = '{coin}USDT'
     _coin_re = r'^(\w+)USDT$'
+    fields = {
+        'bidPrice': 'd',
+        'askPrice': 'd',
+        'time': 'q',
+        'volume24h': 'd',
+    }
     _coins = ['BTC', 'ETH', 'SOL', 'ARB', 'XRP', 'LINK', 'CRV', 'DOGE', 'MATIC', 'RUNE', 'BCH', 'AVAX', 'NEAR', 'ATOM',
               'FIL', '1INCH', 'DOT', 'AAVE', 'ZRX', 'EOS', 'ENJ', 'ADA', 'UNI', 'ALGO', 'SNX', 'LTC', 'XTZ', 'COMP',
               'MKR', 'XLM', 'YFI', 'SUSHI', 'XMR', 'ETC', 'ZEC', 'CELO', 'TRX', 'ICP', 'UMA']
-
-    def create_update_dict(self):
-        return {
-            token: {
-                'token': token,
-                'bidPrice': -1,
-                'askPrice': -1,
-                'time': -1,
-                'volume24h': -1
-            }
-            for token in self.tokens
-        }
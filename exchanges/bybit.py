@@ -3,6 +3,8 @@ from . import Exchange
 
 class BybitFuturesExchange(Exchange):
     table_name = 'BYBIT_fut_data'
+    ws_url = 'wss://stream.bybit.com/v5/public/linear'
+    rest_url = 'https://api.bybit.com'
     _template = '{coin}USDT'
     _coin_re = r'^(\w+)USDT$'
     _coins = ['XRP', 'LTC', 'FLM', 'SLP', 'ETC', 'MAGIC', 'NEAR', 'ADA', 'YFI', 'TIA', 'MANA', 'FIL', 'MINA', 'BTC',
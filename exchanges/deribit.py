@@ -3,6 +3,7 @@ from . import Exchange
 
 class DeribitFuturesExchange(Exchange):
     table_name = 'DERIBIT_fut_data'
+    ws_url = 'wss://streams.deribit.com/ws/api/v2'
     _template = '{coin}_USDC-PERPETUAL'
     _coin_re = r'^(\w+)_USDC-PERPETUAL$'
     _coins = ['BTC', 'ETH', 'SOL', 'XRP', 'LINK', 'DOGE', 'MATIC', 'BCH', 'AVAX', 'NEAR', 'DOT', 'ADA', 'UNI', 'ALGO',
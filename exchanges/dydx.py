@@ -3,6 +3,7 @@ from . import Exchange
 
 class DydxFuturesExchange(Exchange):
     table_name = 'DYDX_data'
+    ws_url = 'wss://api.dydx.exchange/v3/ws'
     _template = '{coin}-USD'
     _coin_re = r'^(\w+)-USD$'
     _coins = ['CELO', 'LINK', 'DOGE', '1INCH', 'XMR', 'FIL', 'ETH', 'AAVE', 'ATOM', 'MKR', 'EOS', 'COMP', 'ALGO', 'XTZ',
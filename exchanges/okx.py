@@ -3,6 +3,7 @@ from . import Exchange
 
 class OkxFuturesExchange(Exchange):
     table_name = 'OKX_fut_data'
+    ws_url = 'wss://ws.okx.com:8443/ws/v5/public'
     _template = '{coin}-USDT-SWAP'
     _coin_re = r'^(\w+)-USDT-SWAP$'
     _coins = ['XRP', 'LTC', 'FLM', 'SLP', 'ETC', 'MAGIC', 'NEAR', 'ADA', 'YFI', 'TIA', 'MANA', 'FIL', 'MINA', 'BTC',
@@ -3,6 +3,10 @@ from . import Exchange
 
 class VertexprotocolFuturesExchange(Exchange):
     table_name = 'VERTEX_fut_data'
+    ws_url = 'wss://gateway.prod.vertexprotocol.com/v1/ws'
+    rest_url = 'https://gateway.prod.vertexprotocol.com'
+    archive_url = 'https://archive.prod.vertexprotocol.com'
+    urls = Exchange.urls + ('archive_url',)
     _template = '{coin}-USDC-SWAP'
     _coin_re = r'^(\w+)-USDC-SWAP$'
     _coins = ['XRP', 'LTC', 'FLM', 'SLP', 'ETC', 'MAGIC', 'NEAR', 'ADA', 'YFI', 'TIA', 'MANA', 'FIL', 'MINA', 'BTC',
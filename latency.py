@@ -0,0 +1,61 @@
+import logging
+from array import array
+from time import time_ns
+from typing import Dict
+
+LATENCY_WINDOW = 4096           # last updates kept per exchange for the percentiles
+LATENCY_LOG_INTERVAL = 60       # seconds between the summary log lines, 0 to disable
+
+try:
+    from local_settings import *
+except ImportError:
+    pass
+
+log = logging.getLogger('latency')
+
+
+class LatencyRecorder:
+    """
+    Rolling window of exchange event time -> local receive time, in milliseconds.
+
+    Handlers call record(exchange_time_ms, local_time_ms) on every update, it is an array store,
+    the percentiles are only sorted for summary(). A negative latency means the clocks disagree.
+    Concurrent shards may overwrite a sample of each other, which does not matter for percentiles.
+    """
+
+    def __init__(self, name: str, window: int = None):
+        self.name = name
+        self.window = window or LATENCY_WINDOW
+        self._samples = array('d', [0.]) * self.window
+        self.count = 0
+        self._last_log = time_ns() // 1_000_000
+
+    def record(self, exchange_time_ms, local_time_ms: int = None):
+        local_time_ms = local_time_ms or time_ns() // 1_000_000
+        self._samples[self.count % self.window] = local_time_ms - exchange_time_ms
+        self.count += 1
+
+        if LATENCY_LOG_INTERVAL and local_time_ms - self._last_log >= LATENCY_LOG_INTERVAL * 1000:
+            self._last_log = local_time_ms
+            log.info(f'{self.name} latency ms ' + ' '.join(f'{k} {v:.1f}' for k, v in self.summary().items()))
+
+    def summary(self) -> Dict[str, float]:
+        samples = sorted(self._samples[:min(self.count, self.window)])
+        if not samples:
+            return {}
+        return {
+            'p50': samples[len(samples) // 2],
+            'p99': samples[min(len(samples) - 1, len(samples) * 99 // 100)],
+            'max': samples[-1],
+            'count': self.count,
+        }
+
+
+# recorders of the process by name
+recorders: Dict[str, LatencyRecorder] = {}
+
+
+def latency_recorder(name: str) -> LatencyRecorder:
+    if name not in recorders:
+        recorders[name] = LatencyRecorder(name)
+    return recorders[name]
@@ -0,0 +1,85 @@
+import logging
+import os
+from threading import Event, Lock
+from time import time
+from typing import Callable
+
+import orjson
+
+METADATA_CACHE_DIR = 'metadata_cache'
+METADATA_CACHE_MAX_AGE = 7 * 24 * 3600     # seconds after which a cached value is not used at all
+
+try:
+    from local_settings import *
+except ImportError:
+    pass
+
+log = logging.getLogger('metadata_cache')
+
+
+class MetadataCache:
+    """
+    On-disk cache of the slow changing facts of an exchange (funding periods, product ids), one json file per name.
+
+    An updater starts from the cached values at once instead of waiting for its REST sweeps, then refreshes
+    them in the background (refresh_loop). Every set() rewrites the file atomically, so a crash leaves the
+    previous version.
+    """
+
+    def __init__(self, name: str, directory: str = None):
+        self.path = os.path.join(directory or METADATA_CACHE_DIR, f'{name}.json')
+        self._lock = Lock()
+        self._entries = None
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path, 'rb') as file:
+                    self._entries = orjson.loads(file.read())
+            except FileNotFoundError:
+                self._entries = {}
+            except (OSError, orjson.JSONDecodeError) as e:
+                log.warning(f'{self.path} is not readable, starting empty: {e!r}')
+                self._entries = {}
+        return self._entries
+
+    def age(self, key: str) -> float:
+        """Seconds since the value was stored, None when there is none"""
+        with self._lock:
+            entry = self._load().get(key)
+        return time() - entry['stored'] if entry else None
+
+    def get(self, key: str, max_age: float = None):
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is None or time() - entry['stored'] > (max_age or METADATA_CACHE_MAX_AGE):
+            return None
+        return entry['value']
+
+    def set(self, key: str, value):
+        with self._lock:
+            entries = self._load()
+            entries[key] = {'value': value, 'stored': time()}
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'wb') as file:
+                file.write(orjson.dumps(entries))
+            os.replace(tmp_path, self.path)
+
+
+def refresh_loop(cache: MetadataCache, key: str, ttl: float, fetch: Callable, stop_event: Event):
+    """
+    Stores fetch() under key every ttl seconds. A cached value younger than ttl postpones the first fetch,
+    so a restart does not repeat the sweep. fetch() returning None keeps the cached value.
+    """
+    while not stop_event.is_set():
+        age = cache.age(key)
+        if age is not None and age < ttl:
+            if stop_event.wait(ttl - age):
+                break
+            continue
+        value = fetch()
+        if value is not None:
+            cache.set(key, value)
+        elif stop_event.wait(min(ttl, 60)):  # a failed refresh is retried sooner
+            break
@@ -0,0 +1,176 @@
+"""
+Metrics of the process in the Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics
+
+Nothing is collected for it: the page is rendered on request from the counters the modules already keep
+(wsocket.connection_stats, QueueWorker.instances, latency.recorders, db.write_stats, db.pools,
+db.snapshot_stores) and the REST timings of rest.client and the sessions passed to instrument_session().
+"""
+import logging
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter, time_ns
+from urllib.parse import urlsplit
+
+import db
+from latency import recorders
+from queue_worker import QueueWorker
+from wsocket import connection_stats
+
+METRICS_HOST = '0.0.0.0'
+METRICS_PORT = None             # e.g. 9100, None disables the endpoint
+
+try:
+    from local_settings import *
+except ImportError:
+    pass
+
+log = logging.getLogger('metrics')
+
+# live state columns exported as staleness, now - refresh time
+STALENESS_FIELDS = ('time_bid_ask_refresh', 'time_funding_refresh', 'time')
+
+rest_stats: dict[str, dict] = {}    # host: totals of the requests
+timings: dict[str, dict] = {}       # name: totals of the timed() blocks
+_rest_lock = Lock()
+
+
+@contextmanager
+def timed(name: str):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        stats = timings.setdefault(name, {'count': 0, 'seconds': 0., 'last_seconds': 0.})
+        stats['last_seconds'] = perf_counter() - start
+        stats['seconds'] += stats['last_seconds']
+        stats['count'] += 1
+
+
+def record_rest(host: str, seconds: float, status: int):
+    with _rest_lock:
+        stats = rest_stats.setdefault(host, {'requests': 0, 'errors': 0, 'seconds': 0., 'max_seconds': 0.})
+        stats['requests'] += 1
+        stats['errors'] += status >= 400
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+def instrument_session(session):
+    """Times every response of a requests session by host"""
+    def record(response, *args, **kwargs):
+        record_rest(urlsplit(response.url).hostname, response.elapsed.total_seconds(), response.status_code)
+
+    session.hooks['response'].append(record)
+    return session
+
+
+def _labels(**labels) -> str:
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items()) + '}'
+
+
+class _Page:
+    # the samples of a metric must follow its # TYPE line together, they are grouped by name
+    def __init__(self):
+        self.families = {}
+
+    def add(self, metric: str, kind: str, value, **labels):
+        if metric not in self.families:
+            self.families[metric] = [f'# TYPE {metric} {kind}']
+        self.families[metric].append(f'{metric}{_labels(**labels) if labels else ""} {value}')
+
+    def text(self) -> str:
+        return ''.join(line + '\n' for lines in self.families.values() for line in lines)
+
+
+def render() -> str:
+    page = _Page()
+
+    for stats in connection_stats:
+        labels = dict(url=stats.url, shard=stats.shard)
+        page.add('ws_messages_total', 'counter', stats.messages, **labels)
+        page.add('ws_handler_seconds_total', 'counter', stats.handler_seconds, **labels)
+        page.add('ws_connects_total', 'counter', stats.connects, **labels)
+        page.add('ws_reconnects_total', 'counter', stats.reconnects, **labels)
+        page.add('ws_downtime_seconds_total', 'counter', stats.downtime_seconds, **labels)
+        if stats.first_message_seconds is not None:
+            page.add('ws_first_message_seconds', 'gauge', stats.first_message_seconds, **labels)
+
+    partitions = {id(partition) for worker in QueueWorker.instances for partition in worker.partitions}
+    for worker in QueueWorker.instances:
+        if id(worker) in partitions:
+            continue
+        for name, value in worker.stats().items():
+            kind = 'gauge' if name in ('depth', 'max_depth') else 'counter'
+            page.add(f'queue_{name}' if kind == 'gauge' else f'queue_{name}_total', kind, value, queue=worker.name)
+
+    for name, recorder in recorders.items():
+        for key, value in recorder.summary().items():
+            if key == 'count':
+                page.add('exchange_latency_updates_total', 'counter', value, exchange=name)
+            else:
+                page.add('exchange_latency_ms', 'gauge', value, exchange=name, stat=key)
+
+    for table_name, totals in list(db.write_stats.items()):
+        page.add('db_writes_total', 'counter', totals['writes'], table=table_name)
+        page.add('db_write_rows_total', 'counter', totals['rows'], table=table_name)
+        page.add('db_write_seconds_total', 'counter', totals['seconds'], table=table_name)
+        page.add('db_write_last_seconds', 'gauge', totals['last_seconds'], table=table_name)
+        page.add('db_write_errors_total', 'counter', totals['errors'], table=table_name)
+
+    for number, pool in enumerate(db.pools):
+        for name, value in pool.metrics.items():
+            kind = 'gauge' if name == 'in_use' else 'counter'
+            page.add(f'db_pool_{name}' if kind == 'gauge' else f'db_pool_{name}_total', kind, value, pool=number)
+
+    with _rest_lock:
+        for host, stats in rest_stats.items():
+            page.add('rest_requests_total', 'counter', stats['requests'], host=host)
+            page.add('rest_errors_total', 'counter', stats['errors'], host=host)
+            page.add('rest_seconds_total', 'counter', stats['seconds'], host=host)
+            page.add('rest_max_seconds', 'gauge', stats['max_seconds'], host=host)
+
+    for name, stats in list(timings.items()):
+        page.add('timed_total', 'counter', stats['count'], name=name)
+        page.add('timed_seconds_total', 'counter', stats['seconds'], name=name)
+        page.add('timed_last_seconds', 'gauge', stats['last_seconds'], name=name)
+
+    now = time_ns() // 1_000_000
+    for table_name, store in list(db.snapshot_stores.items()):
+        for field in STALENESS_FIELDS:
+            if field not in store.columns:
+                continue
+            for token, refreshed in zip(store.tokens, store.columns[field].tolist()):
+                if refreshed > 0:
+                    page.add('staleness_seconds', 'gauge', (now - refreshed) / 1000,
+                             table=table_name, token=token, field=field)
+
+    return page.text()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = None, host: str = None) -> ThreadingHTTPServer:
+    port = port or METRICS_PORT
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host or METRICS_HOST, port), MetricsHandler)
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log.info(f'metrics on http://{host or METRICS_HOST}:{port}/metrics')
+    return server
@@ -0,0 +1,530 @@
+"""
+Local stand-in of the exchanges for end-to-end and load tests of the updaters and collector.py.
+
+It speaks the websocket subscribe protocol of every exchange and serves the REST polls of the updaters,
+all on one port under the original host names:
+
+    ws://127.0.0.1:8765/fstream.binance.com/ws
+    http://127.0.0.1:8765/fapi.binance.com/fapi/v1/openInterest?symbol=BTCUSDT
+
+MOCK_EXCHANGE_URL = 'http://127.0.0.1:8765' in local_settings.py sends the exchanges there, see exchanges/__init__.py.
+
+    python mock_exchange.py                                         # 1 update/s per subscribed stream
+    python mock_exchange.py --rate 10 --disconnect-every 300 --malformed 0.001
+    python mock_exchange.py --rest-delay 0.2 --rest-errors 0.05 --weight-limit 2400
+"""
+import argparse
+import asyncio
+import logging
+import random
+import zlib
+from datetime import datetime, timezone
+from itertools import count
+from time import monotonic, time_ns
+
+import orjson
+from aiohttp import WSMsgType, web
+
+from exchanges.binance import BinanceFuturesExchange, BinanceSpotExchange
+from exchanges.bybit import BybitFuturesExchange
+from exchanges.deribit import DeribitFuturesExchange
+from exchanges.dydx import DydxFuturesExchange
+from exchanges.okx import OkxFuturesExchange
+from exchanges.vertexprotocol import VertexprotocolFuturesExchange
+
+STATS_INTERVAL = 10         # seconds between the log lines of the sent frames
+TICK = 0.01                 # seconds between the batches of updates of a connection
+
+log = logging.getLogger('mock_exchange')
+
+stats = dict(connections=0, frames=0, malformed=0, disconnects=0, rest=0, rest_errors=0, rate_limited=0)
+
+
+def now_ms() -> int:
+    return time_ns() // 1_000_000
+
+
+def path_of(url: str) -> str:
+    # the place of an exchange url on the mock, as exchange_url() makes it
+    scheme, rest = url.split('://', 1)
+    host, _, path = rest.partition('/')
+    return f"/{host.split(':')[0]}/{path}"
+
+
+def funding_hours(symbol: str) -> int:
+    # a stable mix of 8h and 4h funding periods
+    return 4 if zlib.crc32(symbol.encode()) % 4 == 0 else 8
+
+
+class Market:
+    """Random walk prices and the other numbers of the symbols, shared by the websockets and REST"""
+
+    def __init__(self, seed: int = None):
+        self.rnd = random.Random(seed)
+        self.mids = {}
+
+    def quote(self, symbol: str) -> tuple[float, float]:
+        mid = self.mids.get(symbol) or self.rnd.uniform(0.1, 50000)
+        mid = self.mids[symbol] = mid * (1 + self.rnd.gauss(0, 0.0005))
+        return mid * 0.9999, mid * 1.0001
+
+    def funding(self) -> float:
+        return self.rnd.uniform(-0.0005, 0.0005)
+
+    def amount(self) -> float:
+        return self.rnd.uniform(1e3, 1e8)
+
+
+class Connection:
+    def __init__(self):
+        self.streams = []       # subscribed streams, the updates go round robin over them
+        self.position = 0
+        self.ids = count(1)
+        self.periodic = False   # subscribed to the once a second frame of the feed
+
+
+class Feed:
+    """Websocket protocol of one exchange: answers the frames of the client and makes the updates"""
+    exchange = None
+
+    def __init__(self, market: Market):
+        self.market = market
+        self.symbols = self.exchange().tokens
+
+    @property
+    def path(self) -> str:
+        return path_of(self.exchange.ws_url)
+
+    def welcome(self, conn: Connection) -> list:
+        return []
+
+    def handle(self, conn: Connection, data) -> list:
+        raise NotImplementedError
+
+    def update(self, conn: Connection, stream):
+        raise NotImplementedError
+
+    def every_second(self, conn: Connection) -> list:
+        return []
+
+
+class BinanceFuturesFeed(Feed):
+    exchange = BinanceFuturesExchange
+
+    def handle(self, conn, data):
+        for param in data.get('params') or []:
+            if param == '!markPrice@arr@1s':
+                conn.periodic = True
+            elif param.endswith('@bookTicker'):
+                conn.streams.append(param.split('@')[0].upper())
+        return [{'result': None, 'id': data.get('id')}]
+
+    def update(self, conn, symbol):
+        bid, ask = self.market.quote(symbol)
+        now = now_ms()
+        return {'e': 'bookTicker', 'u': next(conn.ids), 's': symbol, 'b': f'{bid:.6f}', 'B': '1.000',
+                'a': f'{ask:.6f}', 'A': '1.000', 'T': now, 'E': now}
+
+    def every_second(self, conn):
+        if not conn.periodic:
+            return []
+        now = now_ms()
+        prices = []
+        for symbol in self.symbols:
+            bid, ask = self.market.quote(symbol)
+            period = funding_hours(symbol) * 3_600_000
+            prices.append({'e': 'markPriceUpdate', 'E': now, 's': symbol, 'p': f'{bid:.6f}', 'P': f'{bid:.6f}',
+                           'i': f'{ask:.6f}', 'r': f'{self.market.funding():.8f}', 'T': now // period * period + period})
+        return [prices]
+
+
+class BinanceSpotFeed(BinanceFuturesFeed):
+    exchange = BinanceSpotExchange
+
+    def update(self, conn, symbol):
+        bid, ask = self.market.quote(symbol)
+        return {'u': next(conn.ids), 's': symbol, 'b': f'{bid:.6f}', 'B': '1.000', 'a': f'{ask:.6f}', 'A': '1.000'}
+
+
+class OkxFeed(Feed):
+    exchange = OkxFuturesExchange
+
+    def handle(self, conn, data):
+        if data.get('op') != 'subscribe':
+            return [{'id': data.get('id', ''), 'event': 'error', 'code': '60012', 'msg': f'Invalid request: {data}'}]
+        conn.streams.extend((arg['channel'], arg['instId']) for arg in data['args'])
+        return [{'event': 'subscribe', 'arg': arg, 'connId': 'mock'} for arg in data['args']]
+
+    def update(self, conn, stream):
+        channel, symbol = stream
+        now = str(now_ms())
+        if channel == 'tickers':
+            bid, ask = self.market.quote(symbol)
+            item = {'instType': 'SWAP', 'instId': symbol, 'bidPx': f'{bid:.6f}', 'askPx': f'{ask:.6f}',
+                    'volCcy24h': f'{self.market.amount():.2f}', 'ts': now}
+        elif channel == 'funding-rate':
+            period = funding_hours(symbol) * 3_600_000
+            funding_time = now_ms() // period * period
+            item = {'instType': 'SWAP', 'instId': symbol, 'fundingRate': f'{self.market.funding():.8f}',
+                    'fundingTime': str(funding_time), 'nextFundingTime': str(funding_time + period), 'ts': now}
+        else:
+            item = {'instType': 'SWAP', 'instId': symbol, 'oi': f'{self.market.amount():.2f}', 'ts': now}
+        return {'arg': {'channel': channel, 'instId': symbol}, 'data': [item]}
+
+
+class BybitFeed(Feed):
+    exchange = BybitFuturesExchange
+
+    def handle(self, conn, data):
+        if data.get('op') == 'ping':
+            return [{'success': True, 'ret_msg': 'pong', 'conn_id': 'mock', 'op': 'ping'}]
+        conn.streams.extend(arg.split('.', 1)[1] for arg in data.get('args') or [])
+        return [{'success': True, 'ret_msg': '', 'conn_id': 'mock', 'req_id': data.get('req_id'), 'op': data.get('op')}]
+
+    def update(self, conn, symbol):
+        bid, ask = self.market.quote(symbol)
+        period = funding_hours(symbol) * 3_600_000
+        return {'topic': f'tickers.{symbol}', 'type': 'delta', 'cs': next(conn.ids), 'ts': now_ms(), 'data': {
+            'symbol': symbol, 'bid1Price': f'{bid:.6f}', 'ask1Price': f'{ask:.6f}',
+            'volume24h': f'{self.market.amount():.2f}', 'turnover24h': f'{self.market.amount():.2f}',
+            'fundingRate': f'{self.market.funding():.6f}', 'nextFundingTime': str(now_ms() // period * period + period),
+            'openInterest': f'{self.market.amount():.2f}',
+        }}
+
+
+class DeribitFeed(Feed):
+    exchange = DeribitFuturesExchange
+
+    def handle(self, conn, data):
+        if data.get('method') == 'public/subscribe':
+            channels = data['params']['channels']
+            conn.streams.extend(channel.split('.')[1] for channel in channels)
+            return [{'jsonrpc': '2.0', 'id': data['id'], 'result': channels}]
+        return [{'jsonrpc': '2.0', 'id': data.get('id'), 'result': 'ok'}]
+
+    def update(self, conn, symbol):
+        bid, ask = self.market.quote(symbol)
+        return {'jsonrpc': '2.0', 'method': 'subscription', 'params': {'channel': f'ticker.{symbol}.raw', 'data': {
+            'instrument_name': symbol, 'timestamp': now_ms(), 'current_funding': self.market.funding(),
+            'best_bid_price': bid, 'best_ask_price': ask, 'stats': {'volume_usd': self.market.amount()},
+            'open_interest': self.market.amount(),
+        }}}
+
+
+class DydxFeed(Feed):
+    exchange = DydxFuturesExchange
+    BOOK_LEVELS = 20
+
+    def welcome(self, conn):
+        conn.offsets = count(1000)
+        return [{'type': 'connected', 'connection_id': 'mock', 'message_id': 0}]
+
+    def market_values(self, symbol):
+        next_hour = (now_ms() // 3_600_000 + 1) * 3_600
+        return {'market': symbol, 'status': 'ONLINE', 'type': 'PERPETUAL',
+                'nextFundingRate': f'{self.market.funding() / 8:.10f}',
+                'nextFundingAt': datetime.fromtimestamp(next_hour, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'volume24H': f'{self.market.amount():.2f}', 'openInterest': f'{self.market.amount():.2f}'}
+
+    def handle(self, conn, data):
+        if data.get('channel') == 'v3_markets':
+            conn.periodic = True
+            return [{'type': 'subscribed', 'connection_id': 'mock', 'message_id': next(conn.ids),
+                     'channel': 'v3_markets', 'contents': {'markets': {s: self.market_values(s) for s in self.symbols}}}]
+        symbol = data.get('id')
+        conn.streams.append(symbol)
+        bid, ask = self.market.quote(symbol)
+        offset = str(next(conn.offsets))
+        step = (ask - bid) / 2
+        return [{'type': 'subscribed', 'connection_id': 'mock', 'message_id': next(conn.ids), 'channel': 'v3_orderbook',
+                 'id': symbol, 'contents': {
+                     'bids': [{'price': f'{bid - level * step:.6f}', 'offset': offset, 'size': '1'}
+                              for level in range(self.BOOK_LEVELS)],
+                     'asks': [{'price': f'{ask + level * step:.6f}', 'offset': offset, 'size': '1'}
+                              for level in range(self.BOOK_LEVELS)]}}]
+
+    def update(self, conn, symbol):
+        bid, ask = self.market.quote(symbol)
+        size = lambda: self.market.rnd.choice(('0', '0.5', '2'))
+        return {'type': 'channel_data', 'connection_id': 'mock', 'message_id': next(conn.ids),
+                'channel': 'v3_orderbook', 'id': symbol,
+                'contents': {'offset': str(next(conn.offsets)), 'bids': [[f'{bid:.6f}', size()]],
+                             'asks': [[f'{ask:.6f}', size()]]}}
+
+    def every_second(self, conn):
+        if not conn.periodic:
+            return []
+        return [{'type': 'channel_data', 'connection_id': 'mock', 'message_id': next(conn.ids),
+                 'channel': 'v3_markets', 'contents': {s: {'nextFundingRate': f'{self.market.funding() / 8:.10f}',
+                                                           'openInterest': f'{self.market.amount():.2f}'}
+                                                       for s in self.symbols}}]
+
+
+class VertexFeed(Feed):
+    exchange = VertexprotocolFuturesExchange
+
+    def __init__(self, market):
+        super().__init__(market)
+        coins = [coin for coin in self.exchange().coins if coin != 'USDC']
+        self.product_ids = {'USDC': 0, **{coin: product_id for product_id, coin in enumerate(coins, 1)}}
+
+    def handle(self, conn, data):
+        if data.get('type') != 'market_prices':
+            return [{'status': 'failure', 'error': f'unknown request {data}'}]
+        conn.streams = list(data['product_ids'])
+        return [self.prices(data['product_ids'])]
+
+    def prices(self, product_ids):
+        prices = []
+        for product_id in product_ids:
+            bid, ask = self.market.quote(f'vertex{product_id}')
+            prices.append({'product_id': product_id, 'bid_x18': str(int(bid * 1e18)), 'ask_x18': str(int(ask * 1e18))})
+        return {'status': 'success', 'data': {'market_prices': prices}, 'request_type': 'query_market_prices'}
+
+    def update(self, conn, product_id):
+        return self.prices([product_id])
+
+
+FEEDS = [BinanceFuturesFeed, BinanceSpotFeed, OkxFeed, BybitFeed, DeribitFeed, DydxFeed, VertexFeed]
+
+
+async def send(ws: web.WebSocketResponse, frame, options):
+    frame = frame if isinstance(frame, str) else orjson.dumps(frame).decode()
+    if options.malformed and random.random() < options.malformed:
+        frame = frame[:random.randrange(1, len(frame))]
+        stats['malformed'] += 1
+    stats['frames'] += 1
+    await ws.send_str(frame)
+
+
+async def disconnect(request: web.Request, ws: web.WebSocketResponse):
+    stats['disconnects'] += 1
+    if random.random() < 0.5:
+        await ws.close(code=1001, message=b'mock disconnect')
+    else:  # the connection is lost without a close frame
+        request.transport.close()
+
+
+async def stream(request: web.Request, ws: web.WebSocketResponse, feed: Feed, conn: Connection, options):
+    lifetime = random.expovariate(1 / options.disconnect_every) if options.disconnect_every else None
+    started = last = last_second = monotonic()
+    due = 0.
+    while not ws.closed:
+        await asyncio.sleep(TICK)
+        now = monotonic()
+        if lifetime and now - started > lifetime:
+            await disconnect(request, ws)
+            return
+        if now - last_second >= 1:
+            last_second = now
+            for frame in feed.every_second(conn):
+                await send(ws, frame, options)
+
+        due += options.rate * len(conn.streams) * (now - last)
+        last = now
+        for _ in range(int(due)):
+            conn.position = (conn.position + 1) % len(conn.streams)
+            await send(ws, feed.update(conn, conn.streams[conn.position]), options)
+        due -= int(due)
+
+
+def websocket_handler(feed: Feed):
+    async def handler(request: web.Request):
+        options = request.app['options']
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        conn = Connection()
+        stats['connections'] += 1
+        for frame in feed.welcome(conn):
+            await send(ws, frame, options)
+        sender = asyncio.create_task(stream(request, ws, feed, conn, options))
+        try:
+            async for message in ws:
+                if message.type not in (WSMsgType.TEXT, WSMsgType.BINARY):
+                    continue
+                if message.data == 'ping':  # OKX text ping
+                    await ws.send_str('pong')
+                    continue
+                try:
+                    data = orjson.loads(message.data)
+                except orjson.JSONDecodeError:
+                    log.warning(f'{feed.path}: not json {message.data!r}')
+                    continue
+                for reply in feed.handle(conn, data):
+                    await send(ws, reply, options)
+        finally:
+            sender.cancel()
+            stats['connections'] -= 1
+        return ws
+    return handler
+
+
+class WeightBudget:
+    """Binance request weight per minute, over the limit the requests get 429"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.minute = 0
+        self.used = 0
+
+    def use(self, weight: int) -> bool:
+        minute = now_ms() // 60_000
+        if minute != self.minute:
+            self.minute, self.used = minute, 0
+        self.used += weight
+        return self.used <= self.limit
+
+
+def rest_routes(market: Market, options) -> web.RouteTableDef:
+    routes = web.RouteTableDef()
+    futures = BinanceFuturesExchange()
+    bybit = BybitFuturesExchange()
+    vertex = VertexFeed(market)
+    binance_weight = WeightBudget(options.weight_limit)
+    # instruments-info lists more symbols than the updaters use, so the paging is exercised
+    bybit_symbols = bybit.tokens + [f'MOCK{n}USDT' for n in range(options.extra_symbols)]
+
+    def binance(weight: int, data):
+        limited = not binance_weight.use(weight)
+        headers = {'x-mbx-used-weight-1m': str(binance_weight.used)}
+        if limited:
+            stats['rate_limited'] += 1
+            return web.json_response({'code': -1003, 'msg': 'Too many requests'}, status=429,
+                                     headers=dict(headers, **{'Retry-After': str(60 - time_ns() // 10 ** 9 % 60)}))
+        return web.json_response(data, headers=headers, dumps=lambda value: orjson.dumps(value).decode())
+
+    futures_path = path_of(BinanceFuturesExchange.rest_url)
+    spot_path = path_of(BinanceSpotExchange.rest_url)
+
+    @routes.get(f'{futures_path}fapi/v1/ticker/24hr')
+    async def futures_ticker(request):
+        return binance(40, [{'symbol': symbol, 'quoteVolume': f'{market.amount():.2f}'} for symbol in futures.tokens])
+
+    @routes.get(f'{futures_path}fapi/v1/openInterest')
+    async def open_interest(request):
+        symbol = request.query['symbol']
+        return binance(1, {'symbol': symbol, 'openInterest': f'{market.amount():.3f}', 'time': now_ms()})
+
+    @routes.get(f'{futures_path}fapi/v1/fundingRate')
+    async def funding_rate(request):
+        symbol = request.query['symbol']
+        period = funding_hours(symbol) * 3_600_000
+        last = now_ms() // period * period
+        limit = int(request.query.get('limit', 100))
+        return binance(1, [{'symbol': symbol, 'fundingTime': last - n * period, 'fundingRate': f'{market.funding():.8f}'}
+                           for n in reversed(range(limit))])
+
+    @routes.get(f'{spot_path}api/v3/ticker/24hr')
+    async def spot_ticker(request):
+        symbols = orjson.loads(request.query['symbols'])
+        return binance(40, [{'symbol': symbol, 'quoteVolume': f'{market.amount():.2f}'} for symbol in symbols])
+
+    @routes.get(f'{path_of(BybitFuturesExchange.rest_url)}v5/market/instruments-info')
+    async def instruments_info(request):
+        if 'symbol' in request.query:
+            symbols = [s for s in bybit_symbols if s == request.query['symbol']]
+            cursor = ''
+        else:
+            limit = min(int(request.query.get('limit', 500)), 1000)
+            start = int(request.query.get('cursor') or 0)
+            symbols = bybit_symbols[start:start + limit]
+            cursor = str(start + limit) if start + limit < len(bybit_symbols) else ''
+        items = [{'symbol': symbol, 'contractType': 'LinearPerpetual', 'status': 'Trading',
+                  'baseCoin': symbol[:-4], 'quoteCoin': 'USDT', 'fundingInterval': funding_hours(symbol) * 60}
+                 for symbol in symbols]
+        return web.json_response({'retCode': 0, 'retMsg': 'OK', 'time': now_ms(), 'result': {
+            'category': 'linear', 'list': items, 'nextPageCursor': cursor}})
+
+    @routes.get(f'{path_of(VertexprotocolFuturesExchange.rest_url)}v1/symbols')
+    async def vertex_symbols(request):
+        return web.json_response([{'product_id': product_id, 'symbol': coin}
+                                  for coin, product_id in vertex.product_ids.items()])
+
+    archive_path = path_of(VertexprotocolFuturesExchange.archive_url)
+
+    @routes.get(f'{archive_path}v2/tickers')
+    async def vertex_tickers(request):
+        return web.json_response({f'{coin}_USDC': {
+            'ticker_id': f'{coin}_USDC', 'base_currency': coin, 'quote_currency': 'USDC',
+            'last_price': market.quote(f'vertex{product_id}')[0], 'base_volume': market.amount(),
+            'quote_volume': market.amount()} for coin, product_id in vertex.product_ids.items() if product_id})
+
+    @routes.post(f'{archive_path}v1')
+    async def vertex_archive(request):
+        query = await request.json(loads=orjson.loads)
+        if 'funding_rates' in query:
+            return web.json_response({str(product_id): {
+                'product_id': product_id, 'funding_rate_x18': str(int(market.funding() * 1e18)),
+                'update_time': str(now_ms() // 1000)} for product_id in query['funding_rates']['product_ids']})
+        if 'market_snapshots' in query:
+            product_ids = query['market_snapshots']['product_ids']
+            return web.json_response({'snapshots': [{'timestamp': str(now_ms() // 1000), 'open_interests': {
+                str(product_id): str(int(market.amount() * 1e18)) for product_id in product_ids}}]})
+        return web.json_response({'error': f'unknown query {list(query)}'}, status=400)
+
+    return routes
+
+
+@web.middleware
+async def rest_faults(request: web.Request, handler):
+    if request.headers.get('Upgrade', '').lower() == 'websocket':
+        return await handler(request)
+    options = request.app['options']
+    stats['rest'] += 1
+    if options.rest_delay:
+        await asyncio.sleep(random.expovariate(1 / options.rest_delay))
+    if options.rest_errors and random.random() < options.rest_errors:
+        stats['rest_errors'] += 1
+        return web.json_response({'error': 'mock failure'}, status=503)
+    return await handler(request)
+
+
+async def log_stats(app: web.Application):
+    async def run():
+        frames = rest = 0
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            log.info(f"{stats['connections']} connections, {(stats['frames'] - frames) / STATS_INTERVAL:.0f} frames/s, "
+                     f"{(stats['rest'] - rest) / STATS_INTERVAL:.1f} rest/s, {stats['malformed']} malformed, "
+                     f"{stats['disconnects']} disconnects, {stats['rest_errors']} rest errors, "
+                     f"{stats['rate_limited']} rate limited")
+            frames, rest = stats['frames'], stats['rest']
+
+    task = asyncio.create_task(run())
+    yield
+    task.cancel()
+
+
+def create_app(options) -> web.Application:
+    app = web.Application(middlewares=[rest_faults])
+    app['options'] = options
+    market = Market(options.seed)
+    for feed_class in FEEDS:
+        feed = feed_class(market)
+        app.router.add_get(feed.path, websocket_handler(feed))
+    app.add_routes(rest_routes(market, options))
+    app.cleanup_ctx.append(log_stats)
+    return app
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='local mock of the exchanges')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rate', type=float, default=1., help='updates per second per subscribed stream')
+    parser.add_argument('--disconnect-every', type=float, default=0,
+                        help='mean seconds before a connection is dropped, 0 never')
+    parser.add_argument('--malformed', type=float, default=0., help='share of truncated websocket frames')
+    parser.add_argument('--rest-delay', type=float, default=0., help='mean seconds of a REST response')
+    parser.add_argument('--rest-errors', type=float, default=0., help='share of REST responses with 503')
+    parser.add_argument('--weight-limit', type=int, default=2400, help='Binance request weight per minute')
+    parser.add_argument('--extra-symbols', type=int, default=400, help='Bybit instruments beyond the tokens')
+    parser.add_argument('--seed', type=int, default=None)
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level='INFO', format='%(asctime)s %(levelname)s: %(message)s')
+    options = parse_args()
+    log.info(f'mock exchanges on http://{options.host}:{options.port}')
+    web.run_app(create_app(options), host=options.host, port=options.port, print=None, access_log=None)
@@ -0,0 +1,10 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class SpotData:
+    token: str
+    bidPrice: float
+    askPrice: float
+    volume_24h: int
+    time: int
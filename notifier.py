@@ -5,10 +5,11 @@ from time import time, sleep
 from typing import Union
 from threading import Thread, Event
 
+import pymysql
 import pytz
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from db import pymysql, read_last_table_data, read_last_tax_table_data
+from db import ConnectionPool, ensure_index, read_last_table_data, read_last_tax_table_data
 from models.future_data import FutureData
 from models.tax_data import TaxData
 from models.notify import NotifyRule, Notify, NotifyType, NotifyState
@@ -20,6 +21,7 @@ from exchanges.bybit import BybitFuturesExchange
 from exchanges.okx import OkxFuturesExchange
 from exchanges.dydx import DydxFuturesExchange
 from gs_parser import get_rules
+from metrics import start_metrics_server, timed
 
 from tg import send_telegram_message
 from tg_bot_config import TG_CHAT_ID_MESSAGES
@@ -79,7 +81,8 @@ ExchangesTaxDataDict = dict[str, dict[str, TaxData]]
 class Notifier:
     _notifies: dict[str: Notify] = None
     _load_rules_thread: Thread = None
-    _connection: pymysql.Connection = None
+    _pool: ConnectionPool = None
+    _tax_indexes_checked: bool = False
     db_config: dict = None
     data: ExchangesFutureDataDict = None
     tax_data: ExchangesTaxDataDict = None
@@ -91,16 +94,10 @@ class Notifier:
         self._notifies = {}
 
     @property
-    def connection(self):
-        if not self._connection:
-            self._connection = pymysql.connect(
-            host=self.db_config['host'],
-            port=self.db_config['port'],
-            user=self.db_config['user'],
-            password=self.db_config['password'],
-            db=self.db_config['db']
-        )
-        return self._connection
+    def pool(self) -> ConnectionPool:
+        if not self._pool:
+            self._pool = ConnectionPool(self.db_config)
+        return self._pool
 
     @staticmethod
     def notify_key(notify: Notify):
@@ -318,26 +315,40 @@ class Notifier:
     def main(self):
         log.debug('start iteration')
         try:
-            rules = get_rules()
+            with timed('notifier_rules'):
+                rules = get_rules()
             notifies = rules_to_notifies(rules)
             self.update_notifies(notifies)
         except Exchange as err:
             log.exception('Error while update notify rules')
             send_telegram_message(f'Error while update notify rules {str(err)}')
 
-        self.reload_data()
-        self.check_notifies()
+        with timed('notifier_reload'):
+            self.reload_data()
+        with timed('notifier_check'):
+            self.check_notifies()
+
+    def ensure_tax_indexes(self):
+        # tax tables are filled outside of this repo, index them so the last timestamp lookup does not scan
+        for exchange_obj in tax_exchanges_map.values():
+            try:
+                self.pool.run(ensure_index, exchange_obj.tax_table_name, 'idx_timestamp_token', ('timestamp', 'token'))
+            except pymysql.err.MySQLError:
+                log.exception('can not create index for %s', exchange_obj.tax_table_name)
+        self._tax_indexes_checked = True
 
     def reload_data(self):
         log.debug('start reload')
+        if not self._tax_indexes_checked:
+            self.ensure_tax_indexes()
         try:
             for exchange, exchange_obj in futures_exchanges_map.items():
-                self.data.setdefault(exchange, {}).update(read_last_table_data(self.connection, exchange_obj))
+                self.data.setdefault(exchange, {}).update(read_last_table_data(self.pool, exchange_obj))
             for exchange, exchange_obj in tax_exchanges_map.items():
-                self.tax_data.setdefault(exchange, {}).update(read_last_tax_table_data(self.connection, exchange_obj))
+                self.tax_data.setdefault(exchange, {}).update(read_last_tax_table_data(self.pool, exchange_obj))
             log.debug('finish reload')
         except:
-            log.exception('reload failed')
+            log.exception('reload failed %s', self.pool.metrics)
 
 
 def rules_to_notifies(rules: list[NotifyRule]):
@@ -368,6 +379,7 @@ def setup_logging():
 
 if __name__ == '__main__':
     setup_logging()
+    start_metrics_server()
 
     from sql_config import DB_CONFIG
 
@@ -1,45 +1,129 @@
 import atexit
 import logging
-from queue import Queue, Empty
-from threading import Thread, Event
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from itertools import count
+from threading import Condition, Lock, Thread, Event
 from typing import Callable
 
 log = logging.getLogger('queue_worker')
 
+# what put_message does when the queue is full
+BLOCK = 'block'              # wait for the consumer
+DROP_OLDEST = 'drop_oldest'  # drop the oldest queued message
+DROP_NEWEST = 'drop_newest'  # drop the new message
+
+_unkeyed = object()
+
+
+def _decode_or_none(decode: Callable, message):
+    # runs in the decode processes too, an exception would stop the whole batch
+    try:
+        return decode(message)
+    except Exception:
+        log.exception(f'error while decode message {message!r:.200}')
+        return None
+
 
 class QueueWorker:
     # class properties
     stop_events = []            # events to stop all the QueueWorker instances
+    instances = []              # the started instances, for metrics.py
     complete_events = []        # events to wait for graceful shutdown after notify workers about exit
 
     stop_event: Event = None
     complete_event: Event = None
     on_message: Callable = None
+    name: str = 'queue'
     queue_full_warning_limit: int = 100
-    _queue: Queue = None
+    maxsize: int = 0            # 0 is unbounded
+    policy: str = BLOCK
+    key: Callable = None        # key(*args, **kwargs) of put_message, only the newest message of a key is kept
+    workers: int = 1            # threads calling on_message
+    partition: Callable = None  # partition(*args, **kwargs), messages of one partition key keep their order
+    decode: Callable = None     # decode(last arg) before on_message, decode_processes > 0 runs it in processes
+    # with decode, key and partition get the decoded message as on_message does
+    decode_processes: int = 0
     started: bool = False
 
-    def __init__(self, on_message: Callable = None, stop_event: Event = None, queue_full_warning_limit: int = None):
+    def __init__(self, on_message: Callable = None, stop_event: Event = None, queue_full_warning_limit: int = None,
+                 maxsize: int = None, policy: str = None, key: Callable = None, workers: int = None,
+                 partition: Callable = None, decode: Callable = None, decode_processes: int = None,
+                 name: str = None):
         self.stop_event = stop_event or Event()
         self.on_message = on_message
+        self.name = name or self.name
         self.queue_full_warning_limit = queue_full_warning_limit or self.queue_full_warning_limit
-        self._queue = Queue()
+        self.maxsize = maxsize or self.maxsize
+        self.policy = policy or self.policy
+        self.key = key or self.key
+        self.workers = workers or self.workers
+        self.partition = partition or self.partition
+        self.decode = decode or self.decode
+        self.decode_processes = decode_processes or self.decode_processes
+        assert self.policy in (BLOCK, DROP_OLDEST, DROP_NEWEST)
         self.complete_event = Event()
+        self.threads = []
 
-    def do_iteration(self, block=True, timeout=None):
-        try:
-            batch = [self._queue.get(block=block, timeout=timeout)]
-        except Empty:
-            return
+        # With several workers or decoding this queue only feeds the partitions: a batch is decoded
+        # (in the pool) in arrival order and every message is routed to the partition of its key.
+        # Every partition is a QueueWorker with one thread, the conflation is done there, on the decoded messages.
+        self.partitions = []
+        self._decode_pool = None
+        if self.workers > 1 or self.decode:
+            self.partitions = [
+                QueueWorker(on_message, self.stop_event, self.queue_full_warning_limit, self.maxsize, self.policy,
+                            self.key, name=f'{self.name}/{i}')
+                for i in range(self.workers)
+            ]
+            self.key = None
 
-        try:
-            while True:
-                batch.append(self._queue.get_nowait())
-        except Empty:
-            pass
+        # queued messages by key, the unkeyed ones get a unique key
+        self._items = OrderedDict()
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._sequence = count()
+        self._warned = False
+
+        # counters
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
 
-        if len(batch) > 100:
-            log.warning(f'queue size = {len(batch)}')
+    def stats(self) -> dict:
+        stats = {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'dequeued': self.dequeued,
+            'dropped': self.dropped,
+            'conflated': self.conflated,
+        }
+        if self.partitions:
+            # enqueued counts the incoming messages, dequeued the ones passed to on_message
+            stats['dequeued'] = 0
+            for worker in self.partitions:
+                for name, value in worker.stats().items():
+                    if name == 'max_depth':
+                        stats[name] = max(stats[name], value)
+                    elif name != 'enqueued':
+                        stats[name] += value
+        return stats
+
+    def handle_batch(self, batch: list):
+        if self.partitions:
+            self.route_batch(batch)
+            return
 
         for data in batch:
             try:
@@ -48,6 +132,52 @@ class QueueWorker:
             except:
                 log.exception('error while process message')
 
+    def decode_batch(self, messages: list) -> list:
+        decode = partial(_decode_or_none, self.decode)
+        if self._decode_pool:
+            try:
+                chunksize = max(1, len(messages) // (self.decode_processes * 4))
+                return list(self._decode_pool.map(decode, messages, chunksize=chunksize))
+            except BrokenProcessPool:
+                log.exception(f'{self.name}: decode processes died, restarting them')
+                self._decode_pool.shutdown(wait=False, cancel_futures=True)
+                self._decode_pool = self.create_decode_pool()
+            except Exception:
+                # e.g. decode is not picklable, it would fail again
+                log.exception(f'{self.name}: decode processes failed, decoding in the worker thread from now on')
+                self._decode_pool.shutdown(wait=False, cancel_futures=True)
+                self._decode_pool = None
+        return [decode(message) for message in messages]
+
+    def route_batch(self, batch: list):
+        if self.decode:
+            decoded = self.decode_batch([args[-1] for args, kwargs in batch])
+            batch = [(args[:-1] + (data,), kwargs) for (args, kwargs), data in zip(batch, decoded) if data is not None]
+
+        partitions = self.partitions
+        for args, kwargs in batch:
+            try:
+                if self.partition and len(partitions) > 1:
+                    worker = partitions[hash(self.partition(*args, **kwargs)) % len(partitions)]
+                else:
+                    worker = partitions[0]
+                worker.put_message(*args, **kwargs)
+            except:
+                log.exception('error while route message')
+
+    def do_iteration(self, block=True, timeout=None):
+        with self._lock:
+            if not self._items and block:
+                self._not_empty.wait(timeout)
+            if not self._items:
+                return
+            batch = list(self._items.values())
+            self._items.clear()
+            self.dequeued += len(batch)
+            self._not_full.notify_all()
+
+        self.handle_batch(batch)
+
     def process_messages(self):
         try:
             self.complete_events.append(self.complete_event)
@@ -57,23 +187,67 @@ class QueueWorker:
             self.do_iteration(block=False)
             log.info('finish queue processing')
         finally:
+            if self._decode_pool:
+                self._decode_pool.shutdown(cancel_futures=True)
             self.complete_event.set()
 
-    def put_message(self, *args, **kwargs):
-        self._queue.put((args, kwargs))
+    def put_message(self, *args, **kwargs) -> bool:
+        """Queues the message, returns False when it was dropped"""
+        key = self.key(*args, **kwargs) if self.key else None
+        with self._lock:
+            if key is not None and key in self._items:
+                # conflation, the position of the key in the queue is kept
+                self._items[key] = (args, kwargs)
+                self.conflated += 1
+                return True
+
+            if self.maxsize and len(self._items) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                if self.policy == DROP_OLDEST:
+                    self._items.popitem(last=False)
+                    self.dropped += 1
+                else:
+                    while len(self._items) >= self.maxsize and not self.stop_event.is_set():
+                        self._not_full.wait(0.1)
+
+            self._items[(_unkeyed, next(self._sequence)) if key is None else key] = (args, kwargs)
+            self.enqueued += 1
+            depth = len(self._items)
+            self.max_depth = max(self.max_depth, depth)
+            self._not_empty.notify()
+
+        if depth >= self.queue_full_warning_limit and not self._warned:
+            self._warned = True
+            log.warning(f'{self.name} depth {depth} reached the warning limit {self.queue_full_warning_limit}')
+        elif self._warned and depth < self.queue_full_warning_limit // 2:
+            self._warned = False
+        return True
 
     def start(self, on_message: Callable = None, stop_event: Event = None) -> Thread:
         self.started = True
         self.stop_event = stop_event or self.stop_event or Event()
         self.on_message = on_message or self.on_message
         self.stop_events.append(self.stop_event)
+        self.instances.append(self)
 
         assert callable(self.on_message)
 
+        if self.decode_processes:
+            self._decode_pool = self.create_decode_pool()
+        for worker in self.partitions:
+            self.threads.append(worker.start(self.on_message, self.stop_event))
+
         thread = Thread(target=self.process_messages, daemon=True)
         thread.start()
+        self.threads.insert(0, thread)
         return thread
 
+    def create_decode_pool(self) -> ProcessPoolExecutor:
+        # not fork, the websocket and scheduler threads may hold locks at that moment
+        return ProcessPoolExecutor(self.decode_processes, mp_context=multiprocessing.get_context('forkserver'))
+
     def stop(self):
         self.stop_event.set()
 
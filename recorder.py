@@ -0,0 +1,181 @@
+"""
+Recording of raw websocket frames and their replay into the handlers of an updater.
+
+A recording is a gzip file of records: receive time (int64 ns) + frame length (uint32) + frame.
+process_websocket(record=path) or WS_RECORD_DIR in local_settings.py write one per run.
+
+    python recorder.py info recordings/fstream.binance.com-1700000000.rec.gz
+    python recorder.py replay recordings/fstream.binance.com-1700000000.rec.gz binance_futures_sql_updater
+    python recorder.py replay <file> OKX_futures_sql_updater --speed 10      # 10x the original speed
+    python recorder.py replay <file> OKX_futures_sql_updater --speed 0       # as fast as possible
+
+The replay prints messages/s and ns/message of the on_message of the module, so the handlers can be
+profiled and compared offline on the same input.
+"""
+import argparse
+import gzip
+import importlib
+import logging
+import os
+import struct
+from threading import Lock
+from time import monotonic, perf_counter_ns, sleep, time, time_ns
+from typing import Callable, Iterator, Tuple
+from urllib.parse import urlsplit
+
+MAGIC = b'WSREC1\n'
+_header = struct.Struct('<qI')
+
+log = logging.getLogger('recorder')
+
+
+def recording_path(directory: str, url: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{urlsplit(url).hostname}-{int(time())}.rec.gz')
+
+
+class FrameRecorder:
+    """
+    Appends the frames of one or several connections (shards) to a recording, thread safe.
+
+    The gzip stream is flushed at most every flush_interval seconds, so a crash loses only the
+    frames of the last interval and the rest of the file stays readable.
+    """
+
+    def __init__(self, path: str, compresslevel: int = 6, flush_interval: float = 1.):
+        self.path = path
+        self.frames = 0
+        self.flush_interval = flush_interval
+        self._flushed = monotonic()
+        self._lock = Lock()
+        self._file = gzip.open(path, 'wb', compresslevel=compresslevel)
+        self._file.write(MAGIC)
+        log.info(f'recording frames to {path}')
+
+    def write(self, message, received_ns: int = None):
+        if isinstance(message, str):
+            message = message.encode()
+        header = _header.pack(received_ns or time_ns(), len(message))
+        with self._lock:
+            self._file.write(header)
+            self._file.write(message)
+            self.frames += 1
+            if monotonic() - self._flushed >= self.flush_interval:
+                self._file.flush()
+                self._flushed = monotonic()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_frames(path: str) -> Iterator[Tuple[int, bytes]]:
+    """(receive time ns, frame) of a recording, a recording cut by a crash ends at the last whole frame"""
+    with gzip.open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a frame recording')
+        try:
+            while header := file.read(_header.size):
+                if len(header) < _header.size:
+                    break
+                received_ns, length = _header.unpack(header)
+                frame = file.read(length)
+                if len(frame) < length:
+                    break
+                yield received_ns, frame
+        except EOFError:
+            log.warning(f'{path} is truncated')
+
+
+def prepare_replay(module):
+    """
+    Loads what the handlers of the module need besides the frames, e.g. the Vertex product ids.
+    prepare() takes them from the metadata cache of any age, the network is used only without one.
+    """
+    if hasattr(module, 'prepare'):
+        from rest import client
+        module.prepare(client, max_age=float('inf'))
+
+
+class ReplaySocket:
+    """Stands for the websocket in the handlers, the frames they send are only counted"""
+
+    def __init__(self, url: str = 'replay'):
+        self.url = url
+        self.sent = 0
+
+    def send(self, data):
+        self.sent += 1
+
+
+def replay(path: str, on_message: Callable, speed: float = 1., ws=None) -> dict:
+    """
+    Feeds a recording to on_message(ws, frame) as str.
+
+    speed 1 keeps the original gaps between the frames, 10 is ten times faster, 0 as fast as possible.
+    Returns the number of frames and the time spent in on_message.
+    """
+    ws = ws or ReplaySocket(path)
+    frames = 0
+    handler_ns = 0
+    errors = 0
+    first_received = started = None
+    for received_ns, frame in read_frames(path):
+        if speed:
+            if first_received is None:
+                first_received, started = received_ns, perf_counter_ns()
+            delay = (received_ns - first_received) / speed - (perf_counter_ns() - started)
+            if delay > 0:
+                sleep(delay / 1e9)
+
+        message = frame.decode()
+        start = perf_counter_ns()
+        try:
+            on_message(ws, message)
+        except Exception:
+            errors += 1
+            log.exception('error while replay frame')
+        handler_ns += perf_counter_ns() - start
+        frames += 1
+
+    return {
+        'frames': frames,
+        'errors': errors,
+        'handler_seconds': handler_ns / 1e9,
+        'ns_per_message': handler_ns / frames if frames else 0,
+        'messages_per_second': frames / handler_ns * 1e9 if handler_ns else 0,
+    }
+
+
+def main():
+    logging.basicConfig(level='INFO', format='%(asctime)s %(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser(description='websocket frame recordings')
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info')
+    info.add_argument('path')
+    play = commands.add_parser('replay')
+    play.add_argument('path')
+    play.add_argument('module', help='updater module with on_message, e.g. binance_futures_sql_updater')
+    play.add_argument('--speed', type=float, default=0, help='1 original speed, 0 as fast as possible (default)')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        count = size = 0
+        first = last = None
+        for received_ns, frame in read_frames(args.path):
+            first = first or received_ns
+            last = received_ns
+            count += 1
+            size += len(frame)
+        duration = (last - first) / 1e9 if count else 0
+        print(f'{count} frames, {size} bytes, {duration:.1f}s')
+    else:
+        module = importlib.import_module(args.module)
+        prepare_replay(module)
+        result = replay(args.path, module.on_message, args.speed)
+        print(' '.join(f'{name} {value:.1f}' if isinstance(value, float) else f'{name} {value}'
+                       for name, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+REST client of the updaters and collector.py.
+
+One keep-alive connection pool for the process with, per host, a bound of the requests in flight, the rate
+budgets of the exchange (WeightLimiter, registered by url prefix) and retries bounded by count and deadline.
+Every response is timed in metrics.rest_stats.
+
+    data = client.get_json(f'{exchange.rest_url}/fapi/v1/ticker/24hr', weight=40)       # None on failure
+    for params, data in client.fetch_each(url, [{'symbol': s} for s in symbols]):      # concurrent sweep
+        ...
+
+Binance counts the weight per IP, so the limiters follow the used weight the responses report
+(x-mbx-used-weight-1m) and stop the requests for Retry-After on a 429 or 418.
+"""
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import BoundedSemaphore, Condition, Event, Lock
+from time import monotonic, sleep, time
+from typing import Iterator, List, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import instrument_session
+
+REST_WORKERS = 8                    # concurrent requests of a sweep
+REST_HOST_CONCURRENCY = 8           # requests in flight per host
+REST_TIMEOUT = 10                   # seconds of one attempt
+REST_RETRIES = 3                    # retries after a connection error, 5xx, 418 or 429
+REST_DEADLINE = 60                  # seconds a request may take with its retries
+REST_BACKOFF_MIN = 0.5              # seconds before the first retry, doubled by every next one, with jitter
+REST_BACKOFF_MAX = 10
+BINANCE_WEIGHT_LIMIT = 2400         # request weight per minute of fapi
+BINANCE_WEIGHT_SHARE = 0.5          # share of it the process uses, the rest is left to the other requests of the IP
+BINANCE_FUNDING_RATE_LIMIT = 500    # /fapi/v1/fundingRate requests per 5 minutes
+
+try:
+    from local_settings import *
+except ImportError:
+    pass
+
+log = logging.getLogger('rest')
+
+RETRY_STATUSES = (418, 429, 500, 502, 503, 504)
+
+
+class WeightLimiter:
+    """
+    Request weight budget of a fixed window, the way Binance counts it.
+
+    acquire() blocks until the weight fits into the current window. With `header` the budget follows the
+    weight the exchange reports, which includes the requests of other processes on the same IP.
+    """
+
+    def __init__(self, name: str, limit: int, window: float = 60, header: str = None):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.header = header
+        self.used = 0
+        self.waits = 0
+        self._window_start = self._current_window()
+        self._blocked_until = 0.
+        self._condition = Condition()
+
+    def _current_window(self) -> float:
+        # windows are aligned to the wall clock as on the exchange
+        return time() // self.window * self.window
+
+    def _roll(self):
+        window_start = self._current_window()
+        if window_start != self._window_start:
+            self._window_start = window_start
+            self.used = 0
+
+    def try_acquire(self, weight: int = 1) -> float:
+        """0 when the weight is taken, otherwise the seconds to wait before trying again"""
+        with self._condition:
+            self._roll()
+            now = time()
+            if now >= self._blocked_until and self.used + weight <= self.limit:
+                self.used += weight
+                return 0
+            self.waits += 1
+            return max(self._blocked_until, self._window_start + self.window) - now
+
+    def acquire(self, weight: int = 1, stop_event: Event = None, deadline: float = None) -> bool:
+        """False when stop_event was set while waiting or the monotonic() deadline passed, nothing is taken then"""
+        with self._condition:
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                remaining = deadline - monotonic() if deadline is not None else 1.
+                if remaining <= 0:
+                    return False
+                wait = self.try_acquire(weight)
+                if not wait:
+                    return True
+                self._condition.wait(min(max(wait, 0.01), 1., remaining))
+
+    def observe(self, status: int, headers):
+        with self._condition:
+            if self.header and self.header in headers:
+                self._roll()
+                self.used = max(self.used, int(headers[self.header]))
+            if status in (418, 429):
+                retry_after = int(headers.get('Retry-After', self.window))
+                self._blocked_until = max(self._blocked_until, time() + retry_after)
+                log.warning(f'{self.name}: {status}, requests paused for {retry_after}s')
+            self._condition.notify_all()
+
+
+class RestClient:
+    """
+    request() and the json helpers return None after the retries, at the deadline or on a 4xx,
+    the callers keep their previous values then.
+    """
+
+    def __init__(self, host_concurrency: int = None, timeout: float = None, retries: int = None,
+                 deadline: float = None):
+        self.host_concurrency = host_concurrency or REST_HOST_CONCURRENCY
+        self.timeout = timeout or REST_TIMEOUT
+        self.retries = REST_RETRIES if retries is None else retries
+        self.deadline = deadline or REST_DEADLINE
+        self.session = instrument_session(requests.Session())
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=self.host_concurrency, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._limits: List[Tuple[str, WeightLimiter]] = []
+        self._host_slots = {}
+        self._lock = Lock()
+
+    def limit(self, url_prefix: str, limiter: WeightLimiter):
+        """Every request to a url starting with url_prefix takes its weight from limiter"""
+        self._limits.append((url_prefix, limiter))
+
+    def limiters(self, url: str) -> List[WeightLimiter]:
+        return [limiter for prefix, limiter in self._limits if url.startswith(prefix)]
+
+    def _host_slot(self, host: str) -> BoundedSemaphore:
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = BoundedSemaphore(self.host_concurrency)
+            return self._host_slots[host]
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(REST_BACKOFF_MAX, REST_BACKOFF_MIN * 2 ** attempt))
+
+    def _retry_delay(self, attempt: int, status: int, headers, limiters) -> float:
+        if status in (418, 429) and not limiters and 'Retry-After' in headers:
+            return float(headers['Retry-After'])
+        return self._backoff(attempt)
+
+    def request(self, method: str, url: str, params: dict = None, json=None, weight: int = 1,
+                stop_event: Event = None, deadline: float = None) -> requests.Response:
+        """The 200 response, None after the retries, at the deadline or on a 4xx other than 418/429"""
+        end = monotonic() + (deadline or self.deadline)
+        limiters = self.limiters(url)
+        slot = self._host_slot(urlsplit(url).hostname)
+        for attempt in range(self.retries + 1):
+            # the deadline is checked before the weight is taken, a late request does not use the budget
+            if not all(limiter.acquire(weight, stop_event, deadline=end) for limiter in limiters):
+                if stop_event is not None and stop_event.is_set():
+                    return None
+                break
+            remaining = end - monotonic()
+            if remaining <= 0:
+                break
+            status, headers = None, {}
+            try:
+                with slot:
+                    response = self.session.request(method, url, params=params, json=json,
+                                                    timeout=min(self.timeout, remaining))
+                status, headers = response.status_code, response.headers
+                for limiter in limiters:
+                    limiter.observe(status, headers)
+                if status == 200:
+                    return response
+                if status not in RETRY_STATUSES:
+                    log.warning(f'{method} {url} {params or json}: {status} {response.text[:200]}')
+                    return None
+                log.info(f'{method} {url}: {status}, attempt {attempt + 1}')
+            except requests.RequestException as e:
+                log.warning(f'{method} {url}: {e!r}, attempt {attempt + 1}')
+
+            delay = self._retry_delay(attempt, status, headers, limiters)
+            if attempt == self.retries or monotonic() + delay >= end:
+                break
+            if stop_event is not None:
+                if stop_event.wait(delay):
+                    return None
+            else:
+                sleep(delay)
+        log.warning(f'{method} {url} {params or json}: failed')
+        return None
+
+    @staticmethod
+    def _json(response: requests.Response):
+        if response is None:
+            return None
+        try:
+            return response.json()
+        except ValueError as e:
+            log.warning(f'{response.url}: bad json {e!r} {response.text[:200]}')
+            return None
+
+    def get_json(self, url: str, params: dict = None, **kwargs):
+        return self._json(self.request('GET', url, params=params, **kwargs))
+
+    def post_json(self, url: str, json, **kwargs):
+        return self._json(self.request('POST', url, json=json, **kwargs))
+
+    def fetch_each(self, url: str, params_list: List[dict], weight: int = 1, stop_event: Event = None,
+                   workers: int = None) -> Iterator[Tuple[dict, object]]:
+        """(params, json or None) of a GET per params in the order they complete"""
+        started = monotonic()
+        failed = 0
+        with ThreadPoolExecutor(workers or REST_WORKERS, thread_name_prefix='rest') as executor:
+            futures = {executor.submit(self.get_json, url, params, weight=weight, stop_event=stop_event): params
+                       for params in params_list}
+            for future in as_completed(futures):
+                data = future.result()
+                failed += data is None
+                yield futures[future], data
+        log.info(f'{url}: {len(params_list)} requests in {monotonic() - started:.1f}s, {failed} failed')
+
+
+# Binance futures budgets of the process, registered for the urls by binance_futures_sql_updater
+binance_weight = WeightLimiter('binance fapi weight', int(BINANCE_WEIGHT_LIMIT * BINANCE_WEIGHT_SHARE), 60,
+                               header='x-mbx-used-weight-1m')
+binance_funding_rate = WeightLimiter('binance fundingRate', BINANCE_FUNDING_RATE_LIMIT, 300)
+
+# the client of the process
+client = RestClient()
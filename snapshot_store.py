@@ -0,0 +1,104 @@
+from array import array
+from threading import Lock, RLock
+from typing import Dict, Iterable
+
+
+class SnapshotStore:
+    """
+    Columnar live state of an exchange: one typed array per field, one slot per token.
+
+    Handlers resolve the slot once and write straight into the columns under `lock`:
+
+        slot = update_dict.index[symbol]
+        with update_dict.lock:
+            update_dict.bidPrice[slot] = float(data['b'])
+            update_dict.dirty[slot] = 1
+
+    so no dict is allocated per message. Writers mark touched tokens in `dirty`, and
+    `snapshot(changed_only=True)` returns those whose values differ from the row it returned last
+    time. The `time*` refresh stamps alone do not make a row changed, so a mark price stream that
+    resends the same funding every second does not rewrite the token.
+
+    `snapshot()` holds the lock only to copy the columns into back buffers (a memcpy per column)
+    and builds the rows outside of it, so a row is never torn between two ticks and the
+    websocket threads never wait for the database.
+    """
+
+    def __init__(self, tokens: Iterable[str], fields: Dict[str, str], default=-1):
+        self.tokens = list(tokens)
+        self.index = {token: slot for slot, token in enumerate(self.tokens)}
+        self.fields = tuple(fields)
+        self.lock = RLock()
+        self.dirty = bytearray(len(self.tokens))
+        self._back_dirty = bytearray(len(self.tokens))
+        self.columns = {}
+        self._back = {}
+        self._written = {}  # values of the last changed_only rows, per slot
+        self._snapshot_lock = Lock()
+        for field, typecode in fields.items():
+            column = array(typecode, [default]) * len(self.tokens)
+            self.columns[field] = column
+            self._back[field] = array(typecode, column)
+            if not field.startswith('time'):
+                self._written[field] = array(typecode, column)
+            setattr(self, field, column)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.index
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def slot(self, token: str):
+        return self.index.get(token)
+
+    def get(self, token: str, field: str):
+        return self.columns[field][self.index[token]]
+
+    def update(self, token: str, **values):
+        # convenience for the cold REST paths, hot paths write the columns directly
+        slot = self.index[token]
+        columns = self.columns
+        with self.lock:
+            for field, value in values.items():
+                columns[field][slot] = value
+            self.dirty[slot] = 1
+
+    def snapshot(self, changed_only: bool = False) -> Dict[str, list]:
+        with self._snapshot_lock:
+            back = self._back
+            with self.lock:
+                for field, column in self.columns.items():
+                    back[field][:] = column
+                dirty = self.dirty
+                if changed_only:
+                    # swap the dirty flags, the handlers start marking a clean buffer
+                    self.dirty, self._back_dirty = self._back_dirty, dirty
+
+            if not changed_only:
+                snapshot = {'token': list(self.tokens)}
+                for field, column in back.items():
+                    snapshot[field] = column.tolist()
+                return snapshot
+
+            slots = []
+            written = self._written
+            for slot in range(len(dirty)):
+                if not dirty[slot]:
+                    continue
+                dirty[slot] = 0
+                if any(back[field][slot] != column[slot] for field, column in written.items()):
+                    for field, column in written.items():
+                        column[slot] = back[field][slot]
+                    slots.append(slot)
+            snapshot = {'token': [self.tokens[slot] for slot in slots]}
+            for field, column in back.items():
+                snapshot[field] = [column[slot] for slot in slots]
+            return snapshot
+
+    def rows(self, fields: Iterable[str], changed_only: bool = False) -> list:
+        snapshot = self.snapshot(changed_only)
+        return list(zip(*(snapshot[field] for field in fields)))
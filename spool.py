@@ -0,0 +1,81 @@
+import logging
+import os
+from threading import Lock
+from time import time_ns
+from typing import Callable
+
+import orjson
+
+log = logging.getLogger('spool')
+
+
+class Spool:
+    """
+    On-disk queue of row batches which could not be written to the database.
+
+    Batches are appended as json lines to segment files. When the total size is over
+    max_bytes the oldest segments are dropped, so an outage can not fill the disk.
+    `replay` sends whole segments in large batches and removes them only after the write
+    succeeded, so a failure during replay does not lose or duplicate rows.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024, segment_bytes: int = 8 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self._lock = Lock()
+        self._segment: str = None
+        os.makedirs(path, exist_ok=True)
+
+    def _segments(self) -> list[str]:
+        return sorted(
+            os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith('.jsonl')
+        )
+
+    def __bool__(self):
+        return bool(self._segments())
+
+    def size(self) -> int:
+        return sum(os.path.getsize(segment) for segment in self._segments())
+
+    def append(self, rows: list):
+        line = orjson.dumps(rows) + b'\n'
+        with self._lock:
+            if not self._segment or os.path.getsize(self._segment) >= self.segment_bytes:
+                self._segment = os.path.join(self.path, f'{time_ns()}.jsonl')
+            with open(self._segment, 'ab') as file:
+                file.write(line)
+            self._trim()
+
+    def _trim(self):
+        segments = self._segments()
+        total = sum(os.path.getsize(segment) for segment in segments)
+        while total > self.max_bytes and len(segments) > 1:
+            oldest = segments.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+            log.error(f'spool {self.path} is over {self.max_bytes} bytes, dropped {oldest}')
+
+    def replay(self, write: Callable[[list], object], batch_rows: int = 100_000) -> int:
+        """Write all the spooled rows with write(rows), return the number of rows replayed"""
+        with self._lock:
+            # the next append starts a new segment, the existing ones are not changed while replaying
+            self._segment = None
+            segments = self._segments()
+
+        replayed = 0
+        batch, batch_segments = [], []
+        for segment in segments:
+            with open(segment, 'rb') as file:
+                for line in file:
+                    batch.extend(map(tuple, orjson.loads(line)))
+            batch_segments.append(segment)
+            if len(batch) >= batch_rows or segment == segments[-1]:
+                write(batch)
+                for done in batch_segments:
+                    os.remove(done)
+                replayed += len(batch)
+                batch, batch_segments = [], []
+        if replayed:
+            log.info(f'spool {self.path} replayed {replayed} rows')
+        return replayed
@@ -0,0 +1,125 @@
+import logging
+from dataclasses import dataclass, field
+from itertools import count
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, Iterator
+
+import orjson
+
+from tg import send_telegram_error
+
+log = logging.getLogger('subscriptions')
+
+
+@dataclass
+class SubscribeBatch:
+    label: str
+    total: int
+    started: float
+    remaining: int = None
+    frames: int = 0
+
+    def __post_init__(self):
+        self.remaining = self.total
+
+
+@dataclass
+class SubscribeRequest:
+    args: list
+    batch: SubscribeBatch
+    remaining: int = None
+
+    def __post_init__(self):
+        self.remaining = len(self.args)
+
+
+@dataclass
+class SubscriptionManager:
+    """
+    Packs the subscriptions of a connection into as few frames as the exchange allows and matches the acks.
+
+    build_frame(args, request_id) makes one subscribe frame of at most max_args args. The exchange
+    answers either per request (ack(request_id=...), Bybit, Deribit) or per arg (ack(arg=...), OKX).
+    `latency` keeps the seconds from sending to the ack of the last subscribe of every symbol and
+    `coverage_seconds` the time until the whole last batch was acked.
+
+    subscribe() is called from on_open, so it first drops the requests still pending from the previous
+    connection with the same label (shard), their acks will never come.
+    """
+    name: str
+    build_frame: Callable[[list, int], dict]
+    max_args: int
+    symbol_of: Callable = lambda arg: arg
+    arg_key: Callable = lambda arg: arg
+    ids: Iterator[int] = field(default_factory=lambda: count(1))
+    pending: Dict[int, SubscribeRequest] = field(default_factory=dict)
+    latency: Dict[str, float] = field(default_factory=dict)
+    acked: int = 0
+    failed: int = 0
+    frames: int = 0
+    coverage_seconds: float = None
+    _arg_requests: dict = field(default_factory=dict)
+    _lock: Lock = field(default_factory=Lock)
+
+    def reset(self, label: str = ''):
+        with self._lock:
+            dropped = [request_id for request_id, request in self.pending.items() if request.batch.label == label]
+            for request_id in dropped:
+                for arg in self.pending.pop(request_id).args:
+                    if self._arg_requests.get(self.arg_key(arg)) == request_id:
+                        del self._arg_requests[self.arg_key(arg)]
+        if dropped:
+            log.warning(f'{self.name}{label}: {len(dropped)} subscribe requests unacked before the reconnect')
+
+    def subscribe(self, ws, args: list, label: str = ''):
+        self.reset(label)
+        batch = SubscribeBatch(label, len(args), monotonic())
+        for i in range(0, len(args), self.max_args):
+            chunk = args[i:i + self.max_args]
+            with self._lock:
+                request_id = next(self.ids)
+                self.pending[request_id] = SubscribeRequest(chunk, batch)
+                for arg in chunk:
+                    self._arg_requests[self.arg_key(arg)] = request_id
+                self.frames += 1
+            batch.frames += 1
+            ws.send(orjson.dumps(self.build_frame(chunk, request_id)))
+
+    def ack(self, request_id: int = None, arg=None, ok: bool = True, error=None) -> bool:
+        """Returns False when the message does not answer a subscribe of this manager"""
+        now = monotonic()
+        with self._lock:
+            if arg is not None:
+                request_id = self._arg_requests.pop(self.arg_key(arg), None)
+            request = self.pending.get(request_id)
+            if request is None:
+                return False
+
+            if arg is None:
+                # the args not acked one by one yet (OKX answers an error per request, the rest per arg)
+                args = [done for done in request.args if self._arg_requests.get(self.arg_key(done)) == request_id]
+            else:
+                args = [arg]
+            request.remaining -= len(args)
+            if request.remaining <= 0:
+                del self.pending[request_id]
+                for done in request.args:
+                    self._arg_requests.pop(self.arg_key(done), None)
+
+            batch = request.batch
+            batch.remaining -= len(args)
+            if ok:
+                self.acked += len(args)
+                for done in args:
+                    self.latency[self.symbol_of(done)] = now - batch.started
+            else:
+                self.failed += len(args)
+
+        if not ok:
+            send_telegram_error(f"{self.name}{batch.label} subscribe failed\n{error}\n{args}")
+        if batch.remaining == 0:
+            self.coverage_seconds = now - batch.started
+            log.info(f'{self.name}{batch.label}: {batch.total} subscriptions in {batch.frames} frames '
+                     f'acked in {self.coverage_seconds:.3f}s')
+        return True
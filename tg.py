@@ -1,7 +1,7 @@
 from functools import partial
 import logging
 from telebot import TeleBot
-from queue_worker import  QueueWorker
+from queue_worker import  QueueWorker, DROP_NEWEST
 
 from tg_bot_config import TG_TOKEN, TG_CHAT_ID_ERRORS, TG_TOKEN_MESSAGES, TG_CHAT_ID_MESSAGES
 
@@ -9,7 +9,8 @@ from tg_bot_config import TG_TOKEN, TG_CHAT_ID_ERRORS, TG_TOKEN_MESSAGES, TG_CHA
 message_bot = TeleBot(TG_TOKEN_MESSAGES)
 error_bot = TeleBot(TG_TOKEN)
 
-tg_worker = QueueWorker()
+# an error storm must not eat the memory, a repeated message waiting in the queue is sent once
+tg_worker = QueueWorker(name='telegram', maxsize=1000, policy=DROP_NEWEST, key=lambda bot, message, chat_id: (chat_id, message))
 
 
 def send_telegram_error(message: str):
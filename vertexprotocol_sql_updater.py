@@ -1,15 +1,16 @@
-from time import sleep, time_ns
+from functools import partial
+from time import time_ns
 from datetime import datetime, timedelta
-from threading import Event, Thread, RLock
+from threading import Event, Thread
 
 import orjson
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 
 from db import create_futures_db_connection, insert_or_update_futures_thread
 from tg import send_telegram_error, start_telegram_worker
 from wsocket import process_websocket, WebSocketApp
+from metrics import start_metrics_server
+from rest import client
+from metadata_cache import MetadataCache, refresh_loop
 
 
 from sql_config import DB_CONFIG
@@ -23,8 +24,15 @@ update_dict = exchange.create_update_dict()
 
 active_threads = []
 stop_event = Event()
-lock = RLock()
+lock = update_dict.lock  # guards the columns against a torn snapshot
 ws_app: WebSocketApp = None
+WS_PING_INTERVAL = 28
+PRODUCT_IDS_TTL = 24 * 3600  # seconds, the product ids are kept in the metadata cache between the runs
+metadata = MetadataCache(exchange.table_name)
+
+# id/token pairs, loaded by prepare()
+key_to_id = {}
+id_to_key = {}
 
 
 def next_hour_timestamp():
@@ -33,33 +41,10 @@ def next_hour_timestamp():
     return int(next_hour.timestamp() * 1000)
 
 
-def make_vertexprotocol_API_request(session, vertexprotocol_api_endpoint, retry_attempts: int = 5, params=None,
-                                    type='get'):
-    for i in range(retry_attempts):
-        try:
-            if type == 'get':
-                response = session.get(vertexprotocol_api_endpoint, params=params, timeout=10)
-            else:
-                response = session.post(vertexprotocol_api_endpoint, json=params, timeout=10)
-
-            if response.status_code == 200:
-                return response
-            if response.status_code == 400:
-                return None
-        except requests.RequestException as e:
-            print(f"Request failed due to {e}. Retrying...")
-
-        # Exponential back-off logic
-        sleep(0.5 * (2 ** i))
-
-    return None
-
-
-def thread_volume24h_data(session, update_dict, stop_event):
+def thread_volume24h_data(client, update_dict, stop_event):
     while not stop_event.is_set():
-        data = make_vertexprotocol_API_request(session,
-                                               vertexprotocol_api_endpoint='https://archive.prod.vertexprotocol.com/v2/tickers',
-                                               params={'market': 'perp'}).json()
+        data = client.get_json(f'{exchange.archive_url}/v2/tickers', params={'market': 'perp'},
+                               stop_event=stop_event) or {}
         # {   "ETH_USDC": {
         #                     "ticker_id": "ETH_USDC",         "base_currency": "ETH",
         #                     "quote_currency": "USDC",        "last_price": 1619.1,
@@ -70,18 +55,19 @@ def thread_volume24h_data(session, update_dict, stop_event):
         with lock:
             for token in data.keys():
                 element = data[token]
-                if token in TOKENS_LIST:
-                    update_dict[token].update({"volume24h": element['quote_volume']})
+                if token in update_dict:
+                    update_dict.update(token, volume24h=element['quote_volume'])
 
         if stop_event.wait(3600):
             break
 
 
-def get_ids():
-    data = make_vertexprotocol_API_request(session,
-                                           vertexprotocol_api_endpoint='https://gateway.prod.vertexprotocol.com/v1/symbols',
-                                           ).json()
+def fetch_symbols(client):
     # [{"product_id": 0, "symbol": "USDC"},]
+    return client.get_json(f'{exchange.rest_url}/v1/symbols')
+
+
+def get_ids(data):
     key_to_id = {}
     id_to_key = {}
     for element in data:
@@ -90,6 +76,12 @@ def get_ids():
     return key_to_id, id_to_key
 
 
+def load_ids(data):
+    ids = get_ids(data)
+    key_to_id.update(ids[0])
+    id_to_key.update(ids[1])
+
+
 def on_message(ws, message):
     data = orjson.loads(message)
     # {
@@ -111,12 +103,11 @@ def on_message(ws, message):
             market_prices = data['data']['market_prices']
             with lock:
                 for element in market_prices:
-                    symbol = id_to_key[element['product_id']] + '_USDC'
-                    update_dict[symbol].update({
-                        'bidPrice': float(element['bid_x18']) / 1e18,
-                        'askPrice': float(element['ask_x18']) / 1e18,
-                        'time_bid_ask_refresh': time_ns() // 1_000_000  # time in milliseconds
-                    })
+                    slot = update_dict.index[id_to_key[element['product_id']] + '_USDC']
+                    update_dict.bidPrice[slot] = float(element['bid_x18']) / 1e18
+                    update_dict.askPrice[slot] = float(element['ask_x18']) / 1e18
+                    update_dict.time_bid_ask_refresh[slot] = time_ns() // 1_000_000  # time in milliseconds
+                    update_dict.dirty[slot] = 1
         elif data['status'] != "success":  # Request error
             send_telegram_error(f"vertexprotocol_futures_sql_updater.py\nws request error'\n{data}")
     else:
@@ -150,13 +141,11 @@ def on_open(ws):
     ws_send_bid_ask_update_signal()
 
 
-def thread_funding_rate_data(session, update_dict, stop_event):
+def thread_funding_rate_data(client, update_dict, stop_event):
     while not stop_event.is_set():
         product_ids = create_id_list(TOKENS_LIST)
-        data = make_vertexprotocol_API_request(session,
-                                               vertexprotocol_api_endpoint='https://archive.prod.vertexprotocol.com/v1',
-                                               params={"funding_rates": {"product_ids": product_ids}},
-                                               type='post').json()
+        data = client.post_json(f'{exchange.archive_url}/v1', {"funding_rates": {"product_ids": product_ids}},
+                                stop_event=stop_event) or {}
         # {
         #   "2": {
         #     "product_id": 2,
@@ -169,19 +158,18 @@ def thread_funding_rate_data(session, update_dict, stop_event):
             for id in data.keys():
                 element = data[id]
                 symbol = id_to_key[element['product_id']] + '_USDC'
-                update_dict[symbol].update({
-                    'funding_period': 1,
-                    'funding_annual_percent': float(element['funding_rate_x18']) / 1e18 * 365 * 100,
-                    'time_funding_refresh': time_ns() // 1_000_000,  # time in milliseconds
-                    'nextFundingTime': timestamp_next_hour,
-                })
+                update_dict.update(symbol,
+                                   funding_period=1,
+                                   funding_annual_percent=float(element['funding_rate_x18']) / 1e18 * 365 * 100,
+                                   time_funding_refresh=time_ns() // 1_000_000,  # time in milliseconds
+                                   nextFundingTime=timestamp_next_hour)
             ws_send_bid_ask_update_signal()
 
         if stop_event.wait(60 * 5):
             break
 
 
-def thread_openInterest_data(session, update_dict, stop_event):
+def thread_openInterest_data(client, update_dict, stop_event):
     while not stop_event.is_set():
         product_ids = create_id_list(TOKENS_LIST)
         param = {
@@ -194,63 +182,72 @@ def thread_openInterest_data(session, update_dict, stop_event):
                 "product_ids": product_ids
             }
         }
-        data = make_vertexprotocol_API_request(session,
-                                               vertexprotocol_api_endpoint='https://archive.prod.vertexprotocol.com/v1',
-                                               params=param,
-                                               type='post').json()
+        data = client.post_json(f'{exchange.archive_url}/v1', param, stop_event=stop_event)
 
         with lock:
-            data = data["snapshots"][0]["open_interests"]
+            data = data["snapshots"][0]["open_interests"] if data else {}
             for id in data.keys():
                 symbol = id_to_key[int(id)] + '_USDC'
                 value = data[id]
-                update_dict[symbol].update({
-                    'openInterest': float(value) / 1e18,
-                    'time_openInterest_refresh': time_ns() // 1_000_000})  # time in milliseconds
+                update_dict.update(symbol,
+                                   openInterest=float(value) / 1e18,
+                                   time_openInterest_refresh=time_ns() // 1_000_000)  # time in milliseconds
 
 
         if stop_event.wait(60 * 5):
             break
 
 
-if __name__ == '__main__':
-    start_telegram_worker(stop_event)
-    CONNECTION = create_futures_db_connection(db_config=DB_CONFIG,
-                                              table_name=exchange.table_name)
+def prepare(client, max_age: float = None):
+    # the product ids are needed before subscribing and polling, the cached ones do not wait for the request
+    data = metadata.get('symbols', max_age)
+    if data is None:
+        data = fetch_symbols(client)
+        if data is None:
+            raise ConnectionError('vertexprotocol symbols request failed')
+        metadata.set('symbols', data)
+    load_ids(data)
+
 
-    session = requests.Session()
-    retry_strategy = Retry(
-        total=1,  # Number of retries
-        backoff_factor=10,  # Delay between retries
-        status_forcelist=[401, 402, 403, 500, 502, 503, 504])
+def thread_product_ids(client, stop_event):
+    def refresh():
+        data = fetch_symbols(client)
+        if data is not None:
+            load_ids(data)
+        return data
 
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
+    refresh_loop(metadata, 'symbols', PRODUCT_IDS_TTL, refresh, stop_event)
 
-    # Dictionary to store id/token pairs
-    key_to_id, id_to_key = get_ids()
 
+def rest_pollers(client, stop_event):
+    # blocking REST loops, started as threads here or on the executor of collector.py
+    return [
+        partial(thread_volume24h_data, client, update_dict, stop_event),
+        partial(thread_funding_rate_data, client, update_dict, stop_event),
+        partial(thread_openInterest_data, client, update_dict, stop_event),
+        partial(thread_product_ids, client, stop_event),
+    ]
 
 
-    thread1 = Thread(target=thread_volume24h_data, args=(session, update_dict, stop_event))
-    thread1.start()
-    active_threads.append(thread1)
+if __name__ == '__main__':
+    start_metrics_server()
+    start_telegram_worker(stop_event)
+    CONNECTION = create_futures_db_connection(db_config=DB_CONFIG,
+                                              table_name=exchange.table_name)
 
-    thread2 = Thread(target=thread_funding_rate_data, args=(session, update_dict, stop_event))
-    thread2.start()
-    active_threads.append(thread2)
+    prepare(client)
 
-    thread3 = Thread(target=thread_openInterest_data, args=(session, update_dict, stop_event))
-    thread3.start()
-    active_threads.append(thread3)
+    for poller in rest_pollers(client, stop_event):
+        thread = Thread(target=poller)
+        thread.start()
+        active_threads.append(thread)
 
     insert_or_update_futures_thread(CONNECTION, exchange.table_name, update_dict)
 
     process_websocket(
-        url="wss://gateway.prod.vertexprotocol.com/v1/ws",
+        url=exchange.ws_url,
         on_open=on_open,
         on_message=on_message,
-        ping_interval=28,
+        ping_interval=WS_PING_INTERVAL,
         active_threads=active_threads,
     )
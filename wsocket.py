@@ -1,5 +1,10 @@
 import logging
-from threading import Event, Thread
+import random
+import signal
+from dataclasses import dataclass
+from functools import partial
+from threading import Event, Thread, current_thread, main_thread
+from time import monotonic, perf_counter
 from traceback import format_exception
 from typing import Callable, List
 
@@ -7,12 +12,71 @@ from websocket import WebSocketApp, WebSocketBadStatusException
 
 from tg import send_telegram_error
 from queue_worker import QueueWorker
+from recorder import FrameRecorder, recording_path
 
 
+RECONNECT_DELAY_MIN = 1     # seconds, doubled after every failed connect
+RECONNECT_DELAY_MAX = 60
+QUEUE_MAXSIZE = 100_000     # messages waiting for on_message with use_queue
+WS_RECORD_DIR = None        # record the raw frames of every run here, see recorder.py
+
+try:
+    from local_settings import *
+except ImportError:
+    pass
+
+log = logging.getLogger('wsocket')
+
 _stop_event: Event = None
 _active_threads: List[Thread] = None
 
 
+@dataclass
+class ConnectionStats:
+    url: str
+    shard: int = 0
+    connects: int = 0
+    reconnects: int = 0
+    messages: int = 0
+    handler_seconds: float = 0          # total time in on_message
+    connected_at: float = None          # monotonic time of the last on_open
+    disconnected_at: float = None
+    first_message_seconds: float = None  # from on_open to the first message of the last connection
+    downtime_seconds: float = 0         # total time without a connection after the first one
+
+    # the bookkeeping of run_connection and collector.run_feed
+
+    def on_connect(self):
+        self.connects += 1
+        self.connected_at = monotonic()
+        self.first_message_seconds = None
+        if self.disconnected_at:
+            self.downtime_seconds += self.connected_at - self.disconnected_at
+            self.disconnected_at = None
+
+    def on_frame(self):
+        self.messages += 1
+        if self.first_message_seconds is None:
+            self.first_message_seconds = monotonic() - self.connected_at
+            if self.reconnects:
+                log.info(f'{self.url} shard {self.shard} reconnect #{self.reconnects}: '
+                         f'first message in {self.first_message_seconds:.3f}s')
+
+    def on_disconnect(self):
+        self.disconnected_at = self.disconnected_at or monotonic()
+
+
+# stats of every websocket connection of the process, see process_websocket
+connection_stats: List[ConnectionStats] = []
+
+
+def reconnect_delay(attempt: int) -> float:
+    # exponential backoff with equal jitter (half fixed, half random), so the collectors do not reconnect
+    # all at once after an outage and still wait at least half of the step
+    delay = min(RECONNECT_DELAY_MAX, RECONNECT_DELAY_MIN * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
 def default_on_error(ws, error):
     if isinstance(error, WebSocketBadStatusException):
         exc = str(error)
@@ -23,16 +87,18 @@ def default_on_error(ws, error):
 
 
 def default_on_close(ws: WebSocketApp, close_status_code=None, close_msg=None):
+    # process_websocket reconnects, the threads and the state stay alive
+    log.warning(f'WebSocket {ws.url} closed: {close_status_code} {close_msg}')
+
+
+def stop_all(url: str):
     if _stop_event:
         _stop_event.set()
 
     for t in _active_threads or []:
         t.join(timeout=5.0)
 
-    error_messsage = f"### WebSocket closed ###\n{ws.url}\nAll threads are closed. {close_status_code} {close_msg}"
-
-    send_telegram_error(error_messsage)
-
+    send_telegram_error(f"### WebSocket closed ###\n{url}\nAll threads are closed.")
 
 
 def proccess_messages(on_message: Callable, stop_event):
@@ -57,26 +123,121 @@ def proccess_messages(on_message: Callable, stop_event):
             on_message(None, data)
 
 
+def split_shards(symbols: List[str], shard_size: int = None) -> List[List[str]]:
+    symbols = list(symbols)
+    if not shard_size:
+        return [symbols]
+    return [symbols[i:i + shard_size] for i in range(0, len(symbols), shard_size)] or [[]]
+
+
+def run_connection(url: str, on_open: Callable, on_message: Callable, on_error: Callable, on_close: Callable,
+                   stats: ConnectionStats, sockets: dict, run_forever: dict, recorder: FrameRecorder = None):
+    # one connection with its reconnect loop, returns when _stop_event is set
+    def stats_on_open(ws):
+        stats.on_connect()
+        if on_open:
+            on_open(ws)
+
+    def stats_on_message(ws, message):
+        if recorder:
+            recorder.write(message)
+        stats.on_frame()
+        start = perf_counter()
+        try:
+            on_message(ws, message)
+        finally:
+            stats.handler_seconds += perf_counter() - start
+
+    attempt = 0
+    while not _stop_event.is_set():
+        ws = sockets[stats.shard] = WebSocketApp(
+            url,
+            on_open=stats_on_open,
+            on_message=stats_on_message,
+            on_error=on_error or default_on_error,
+            on_close=on_close or default_on_close,
+        )
+        messages = stats.messages
+        ws.run_forever(**run_forever)
+        stats.on_disconnect()
+        if _stop_event.is_set():
+            break
+
+        # a connection which delivered data resets the backoff
+        attempt = 0 if stats.messages > messages else attempt + 1
+        delay = reconnect_delay(attempt)
+        log.warning(f'{url} shard {stats.shard} disconnected, reconnect #{stats.reconnects + 1} in {delay:.1f}s')
+        if _stop_event.wait(delay):
+            break
+        stats.reconnects += 1
+
+
 def process_websocket(url: str, on_open: Callable = None, on_message: Callable = None, on_error: Callable = None,
                       on_close: Callable = None, stop_event: Event = None, active_threads: List[Thread] = None,
-                      use_queue: bool = False):
+                      use_queue: bool = False, queue_options: dict = None, symbols: List[str] = None,
+                      shard_size: int = None, record: str = None, **run_forever):
+    """
+    Runs the websocket until stop_event is set (or SIGINT/SIGTERM).
+
+    A dropped connection is reopened after reconnect_delay() and on_open is called again to
+    subscribe, the REST threads and update_dict are kept. Extra keyword arguments go to
+    WebSocketApp.run_forever (ping_interval, ...).
+
+    With symbols the subscriptions are split into connections of shard_size symbols, each one
+    received by its own thread, and on_open is called as on_open(ws, tokens=..., shard=...).
+
+    use_queue moves on_message to a QueueWorker thread, queue_options (maxsize, policy, key)
+    bound it and can spread it over several workers and decode processes, see queue_worker.py.
+    With a decode option on_message gets the decoded message.
+
+    record (or WS_RECORD_DIR) writes the raw frames of all connections to a recording for recorder.py.
+    """
     global _stop_event, _active_threads
 
     _stop_event = stop_event or Event()
     _active_threads = active_threads or []
+    sockets = {}
 
     if use_queue:
-        worker = QueueWorker(on_message=on_message, stop_event=_stop_event)
-        _active_threads.append(worker.start())
+        worker = QueueWorker(on_message=on_message, stop_event=_stop_event, name=url,
+                             **{'maxsize': QUEUE_MAXSIZE, **(queue_options or {})})
+        worker.start()
+        _active_threads.extend(worker.threads)
 
         def on_message(ws, message):
             worker.put_message(ws, message)
 
-    ws = WebSocketApp(
-        url,
-        on_open=on_open,
-        on_message=on_message,
-        on_error=on_error or default_on_error,
-        on_close=on_close or default_on_close,
-    )
-    ws.run_forever()
+    def stop(signum, frame):
+        _stop_event.set()
+        for ws in list(sockets.values()):
+            ws.close()
+
+    if current_thread() is main_thread():
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+    run_forever.setdefault('reconnect', 0)  # the reconnects are done here, with backoff and stats
+    record = record or (recording_path(WS_RECORD_DIR, url) if WS_RECORD_DIR else None)
+    recorder = FrameRecorder(record) if record else None
+    connections = []
+    for shard, tokens in enumerate(split_shards(symbols or [], shard_size)):
+        stats = ConnectionStats(url, shard=shard)
+        connection_stats.append(stats)
+        shard_on_open = partial(on_open, tokens=tokens, shard=shard) if symbols is not None and on_open else on_open
+        connections.append(Thread(target=run_connection, name=f'ws-{shard}', args=(
+            url, shard_on_open, on_message, on_error, on_close, stats, sockets, run_forever, recorder)))
+
+    if len(connections) == 1:
+        connections[0].run()
+    else:
+        log.info(f'{url}: {len(symbols)} symbols in {len(connections)} connections')
+        for thread in connections:
+            thread.start()
+        while not _stop_event.wait(1):
+            pass
+        for thread in connections:
+            thread.join(timeout=5.0)
+
+    if recorder:
+        recorder.close()
+    stop_all(url)